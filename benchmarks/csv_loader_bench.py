@@ -0,0 +1,71 @@
+'''
+Compares rows/sec of the csv loaders on a generated int -> float csv cache.
+
+    python benchmarks/csv_loader_bench.py --rows 1000000 --processes 4
+'''
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import multiprocessing
+import tempfile
+
+# Add parent import capabilities
+parentdir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if parentdir not in sys.path:
+    sys.path.insert(0, parentdir)
+
+from cacheman import registers
+
+def typed_row_reader(row):
+    return int(row[0]), float(row[1])
+
+def write_csv(cache_dir, cache_name, rows):
+    registers.csv_saver(cache_dir, cache_name, dict((i, i * 0.5) for i in range(rows)))
+
+def time_rows(label, rows, func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('{:<32} {:>8.3f}s {:>14,.0f} rows/sec'.format(label, best, rows / best))
+    return best
+
+def run(rows, chunk_size, repeat, processes):
+    cache_dir = tempfile.mkdtemp(prefix='cacheman_bench')
+    cache_name = 'bench'
+    try:
+        write_csv(cache_dir, cache_name, rows)
+        print('{:,} rows, best of {}'.format(rows, repeat))
+        time_rows('csv_loader (strings)', rows,
+            lambda: registers.csv_loader(cache_dir, cache_name), repeat)
+        time_rows('csv_loader (row_reader types)', rows,
+            lambda: registers.csv_loader(cache_dir, cache_name, typed_row_reader), repeat)
+        time_rows('csv_typed_loader', rows,
+            lambda: registers.csv_typed_loader(cache_dir, cache_name, ['int', 'float'], chunk_size=chunk_size),
+            repeat)
+        time_rows('csv_row_stream', rows,
+            lambda: sum(1 for _ in registers.csv_row_stream(cache_dir, cache_name, ['int', 'float'], chunk_size)),
+            repeat)
+        for count in sorted(set([2, processes])):
+            time_rows('csv_parallel_loader ({} procs)'.format(count), rows,
+                lambda: registers.csv_parallel_loader(cache_dir, cache_name, processes=count), repeat)
+            time_rows('csv_parallel_loader typed ({})'.format(count), rows,
+                lambda: registers.csv_parallel_loader(cache_dir, cache_name, schema=['int', 'float'],
+                    processes=count, chunk_size=chunk_size), repeat)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+    run(args.rows, args.chunk_size, args.repeat, args.processes)
@@ -0,0 +1,277 @@
+'''
+Benchmarks cache persistence and access over parameterized content sizes and value shapes,
+writing machine-readable JSON which can be compared between versions.
+
+    python benchmarks/suite.py run --sizes 10000 100000 --output before.json
+    python benchmarks/suite.py run --sizes 10000 100000 --output after.json
+    python benchmarks/suite.py compare before.json after.json --threshold 0.1
+'''
+from __future__ import print_function
+
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import psutil
+from timeit import default_timer
+
+# Add parent import capabilities
+parentdir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if parentdir not in sys.path:
+    sys.path.insert(0, parentdir)
+
+from cacheman import registers
+from cacheman.cacher import CacheManager
+from cacheman.cachewrap import NonPersistentCache, PersistentCache
+from cacheman.autosync import AutoSyncCache, TimeCount
+from cacheman import lazypickle
+
+VALUE_SHAPES = {
+    'int': lambda i: i,
+    'float': lambda i: i * 0.5,
+    'str': lambda i: 'value-{:010d}'.format(i),
+    'record': lambda i: { 'id': i, 'name': 'name-{}'.format(i), 'score': i * 0.25, 'tags': ['a', 'b'] },
+}
+
+def build_contents(size, shape):
+    make_value = VALUE_SHAPES[shape]
+    return dict((i, make_value(i)) for i in range(size))
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = default_timer()
+        func()
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_pickle(cache_dir, contents, repeat):
+    save_seconds = best_time(lambda: registers.pickle_saver(cache_dir, 'bench', contents), repeat)
+    load_seconds = best_time(lambda: registers.pickle_loader(cache_dir, 'bench'), repeat)
+    return {
+        'save_seconds': save_seconds,
+        'load_seconds': load_seconds,
+        'bytes': os.path.getsize(registers.generate_pickle_path(cache_dir, 'bench')),
+    }
+
+def bench_csv(cache_dir, contents, repeat):
+    save_seconds = best_time(lambda: registers.csv_saver(cache_dir, 'bench', contents), repeat)
+    load_seconds = best_time(lambda: registers.csv_loader(cache_dir, 'bench'), repeat)
+    return {
+        'save_seconds': save_seconds,
+        'load_seconds': load_seconds,
+        'bytes': os.path.getsize(registers.generate_csv_path(cache_dir, 'bench')),
+    }
+
+def bench_lazy_pickle(cache_dir, contents, repeat):
+    # Opening is compared against a full pickle load, then 1% of values are read
+    lazypickle.lazy_pickle_saver(cache_dir, 'bench', contents)
+    sample = list(contents)[::100]
+    def open_and_sample():
+        lazy = lazypickle.lazy_pickle_loader(cache_dir, 'bench')
+        for key in sample:
+            lazy[key]
+        lazy.close()
+    def open_only():
+        lazypickle.lazy_pickle_loader(cache_dir, 'bench').close()
+    return {
+        'open_seconds': best_time(open_only, repeat),
+        'open_sample_seconds': best_time(open_and_sample, repeat),
+        'save_seconds': best_time(lambda: lazypickle.lazy_pickle_saver(cache_dir, 'bench', contents), repeat),
+        'bytes': os.path.getsize(lazypickle.generate_lazy_pickle_path(cache_dir, 'bench')),
+    }
+
+def bench_wrap_access(manager, contents, repeat):
+    cache = NonPersistentCache('bench_access', cache_manager=manager, contents=contents)
+    keys = list(contents)
+    def read_all(mapping):
+        for key in keys:
+            mapping[key]
+    def contains_all(mapping):
+        for key in keys:
+            key in mapping
+    raw_seconds = best_time(lambda: read_all(contents), repeat)
+    wrap_seconds = best_time(lambda: read_all(cache), repeat)
+    contains_seconds = best_time(lambda: contains_all(cache), repeat)
+    manager.deregister_cache(cache.name)
+    return {
+        'dict_get_per_sec': len(keys) / raw_seconds,
+        'wrap_get_per_sec': len(keys) / wrap_seconds,
+        'wrap_contains_per_sec': len(keys) / contains_seconds,
+        'wrap_overhead_ratio': wrap_seconds / raw_seconds,
+    }
+
+def bench_track_edit(manager, contents, repeat):
+    # Default windows and bucket size, but thresholds no run can reach so only bookkeeping is measured
+    cache = AutoSyncCache('bench_autosync', cache_manager=manager, contents={},
+        time_checks=[TimeCount(60, 1 << 62), TimeCount(900, 1 << 62)])
+    items = list(contents.items())
+    def set_all():
+        for key, value in items:
+            cache[key] = value
+    def track_all():
+        for _ in range(len(items)):
+            cache.track_edit()
+    set_seconds = best_time(set_all, repeat)
+    track_seconds = best_time(track_all, repeat)
+    manager.deregister_cache(cache.name)
+    registers.pickle_deleter(manager.cache_directory, cache.name)
+    return {
+        'setitem_per_sec': len(items) / set_seconds,
+        'track_edit_per_sec': len(items) / track_seconds,
+    }
+
+def bench_fork_save(manager, contents, repeat):
+    process = psutil.Process()
+    cache = PersistentCache('bench_fork', cache_manager=manager, contents=contents, async=True)
+    handoffs, completions, child_peaks, parent_deltas = [], [], [], []
+    for _ in range(repeat):
+        gc.collect()
+        rss_before = process.memory_info().rss
+        start = default_timer()
+        cache.save()
+        handoffs.append(default_timer() - start)
+        parent_deltas.append(process.memory_info().rss - rss_before)
+        children = process.children(recursive=False)
+        peak = 0
+        while children:
+            children = [child for child in children if child.is_running() and
+                child.status() != psutil.STATUS_ZOMBIE]
+            for child in children:
+                try:
+                    peak = max(peak, child.memory_info().rss)
+                except psutil.Error:
+                    pass
+            time.sleep(0.001)
+        psutil.wait_procs(process.children(recursive=False), timeout=60)
+        completions.append(default_timer() - start)
+        child_peaks.append(peak)
+    cache.delete_triggered = True # Otherwise __del__ forks one more save into the removed directory
+    manager.deregister_cache(cache.name)
+    registers.pickle_deleter(manager.cache_directory, cache.name)
+    return {
+        'handoff_seconds': min(handoffs),
+        'complete_seconds': min(completions),
+        'child_peak_rss_bytes': max(child_peaks), # Sampled, so 0 when the child finishes first
+        'parent_rss_delta_bytes': max(parent_deltas),
+    }
+
+BENCHMARKS = ['pickle', 'csv', 'lazy_pickle', 'wrap_access', 'track_edit', 'fork_save']
+
+def run(sizes, shapes, benchmarks, repeat, label=None):
+    base_dir = tempfile.mkdtemp(prefix='cacheman_bench')
+    manager = CacheManager('bench', base_dir)
+    results = []
+    try:
+        for size in sizes:
+            for shape in shapes:
+                contents = build_contents(size, shape)
+                for name in benchmarks:
+                    if name == 'pickle':
+                        metrics = bench_pickle(manager.cache_directory, contents, repeat)
+                    elif name == 'csv':
+                        metrics = bench_csv(manager.cache_directory, contents, repeat)
+                    elif name == 'lazy_pickle':
+                        metrics = bench_lazy_pickle(manager.cache_directory, contents, repeat)
+                    elif name == 'wrap_access':
+                        metrics = bench_wrap_access(manager, contents, repeat)
+                    elif name == 'track_edit':
+                        metrics = bench_track_edit(manager, contents, repeat)
+                    else:
+                        metrics = bench_fork_save(manager, contents, repeat)
+                    result = { 'benchmark': name, 'size': size, 'shape': shape, 'metrics': metrics }
+                    print(format_result(result), file=sys.stderr) # Keeps stdout for the JSON
+                    results.append(result)
+    finally:
+        manager.deregister_all_caches()
+        shutil.rmtree(base_dir, ignore_errors=True)
+    return {
+        'meta': {
+            'label': label,
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': psutil.cpu_count(),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+def format_result(result):
+    metrics = ', '.join('{}={:.6g}'.format(name, value) for name, value in sorted(result['metrics'].items()))
+    return '{:<12} {:>9} {:<7} {}'.format(result['benchmark'], result['size'], result['shape'], metrics)
+
+def lower_is_better(metric):
+    return not metric.endswith('_per_sec')
+
+def compare(base, new, threshold):
+    '''
+    Prints the relative change of every metric present in both result sets, returning
+    the (benchmark, size, shape, metric, change) entries which regressed beyond threshold.
+    '''
+    base_results = dict(((r['benchmark'], r['size'], r['shape']), r['metrics']) for r in base['results'])
+    regressions = []
+    print('{:<12} {:>9} {:<7} {:<26} {:>14} {:>14} {:>8}'.format(
+        'benchmark', 'size', 'shape', 'metric', 'base', 'new', 'change'))
+    for result in new['results']:
+        key = (result['benchmark'], result['size'], result['shape'])
+        if key not in base_results:
+            continue
+        for metric, value in sorted(result['metrics'].items()):
+            base_value = base_results[key].get(metric)
+            if not base_value:
+                continue
+            change = (value - base_value) / float(base_value)
+            worse = change > threshold if lower_is_better(metric) else change < -threshold
+            if worse:
+                regressions.append(key + (metric, change))
+            print('{:<12} {:>9} {:<7} {:<26} {:>14.6g} {:>14.6g} {:>+7.1%}{}'.format(
+                key[0], key[1], key[2], metric, base_value, value, change, ' !' if worse else ''))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help='run benchmarks and write JSON results')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    run_parser.add_argument('--shapes', nargs='+', choices=sorted(VALUE_SHAPES), default=['int', 'str', 'record'])
+    run_parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--label')
+    run_parser.add_argument('--output', help='JSON results path, printed to stdout when missing')
+
+    compare_parser = commands.add_parser('compare', help='compare two JSON results')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+        help='relative change counted as a regression')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        report = run(args.sizes, args.shapes, args.benchmarks, args.repeat, args.label)
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+        else:
+            print(json.dumps(report, indent=2, sort_keys=True))
+        return 0
+    if args.command == 'compare':
+        with open(args.base) as base_file, open(args.new) as new_file:
+            regressions = compare(json.load(base_file), json.load(new_file), args.threshold)
+        if regressions:
+            print('{} metric(s) regressed by more than {:.0%}'.format(len(regressions), args.threshold))
+            return 1
+        return 0
+    parser.print_help()
+    return 2
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,24 +1,149 @@
+import sys
+import time
+import threading
 from collections import namedtuple, deque
+from collections import MutableMapping
+from contextlib import contextmanager
 from datetime import datetime
 from operator import attrgetter
 from builtins import range
 
-from .cachewrap import PersistentCache
+from .cachewrap import PersistentCache, item_pairs
+from .dirtytrack import DirtyKeyTracker, ChangeLog
 
 TimeCount = namedtuple('TimeCount', ['time_length', 'count'])
 MANY_WRITE_TIME_COUNTS = [TimeCount(60, 1000000), TimeCount(300, 10000), TimeCount(900, 1)]
+EDIT_COUNT_MODES = ('edits', 'keys')
+
+def value_size_weigher(key, value):
+    '''
+    An edit_weigher which weights edits by the shallow size of the value (deletes weigh 1).
+    '''
+    return sys.getsizeof(value) if value is not None else 1
+
+SaveDecision = namedtuple('SaveDecision', ['time', 'save', 'reason', 'interval', 'pending_edits', 'unsaved_seconds'])
+
+class AdaptiveSyncPolicy(object):
+    '''
+    Replaces fixed time_checks with a save frequency derived from the measured cost of
+    previous saves. The interval between saves is stretched until save time stays under
+    target_fraction of wall time, but unsaved edits are never held longer than
+    max_loss_window seconds. Recent decisions are kept in `decisions` for inspection.
+
+    Durations of async saves only cover the fork, so this is most useful on sync saves.
+    '''
+    def __init__(self, target_fraction=0.05, max_loss_window=900, min_interval=1, smoothing=0.3,
+                 history_size=100):
+        self.target_fraction = target_fraction
+        self.max_loss_window = max_loss_window
+        self.min_interval = min_interval
+        self.smoothing = smoothing
+        self.save_seconds = None # Exponentially smoothed save duration
+        self.save_bytes = None # Exponentially smoothed save size
+        self.save_count = 0
+        self.last_save_time = None
+        self.first_unsaved_edit = None
+        self.pending_edits = 0
+        self.decisions = deque(maxlen=history_size)
+
+    def _smooth(self, average, measured):
+        if average is None:
+            return measured
+        return self.smoothing * measured + (1 - self.smoothing) * average
+
+    def save_interval(self):
+        if self.save_seconds is None:
+            interval = self.min_interval
+        else:
+            interval = max(self.min_interval, self.save_seconds / self.target_fraction)
+        return min(interval, self.max_loss_window)
+
+    def record_edit(self, count, edit_time):
+        if count and self.first_unsaved_edit is None:
+            self.first_unsaved_edit = edit_time
+        self.pending_edits += count
+
+    def clear_pending(self):
+        self.first_unsaved_edit = None
+        self.pending_edits = 0
+
+    def record_save(self, duration, size_bytes, save_time):
+        self.save_seconds = self._smooth(self.save_seconds, duration)
+        if size_bytes is not None:
+            self.save_bytes = self._smooth(self.save_bytes, size_bytes)
+        self.save_count += 1
+        self.last_save_time = save_time
+
+    def should_save(self, now):
+        if not self.pending_edits:
+            return False
+
+        interval = self.save_interval()
+        unsaved_seconds = (now - self.first_unsaved_edit).total_seconds()
+        if unsaved_seconds >= self.max_loss_window:
+            save, reason = True, 'max_loss_window'
+        elif self.last_save_time is None or (now - self.last_save_time).total_seconds() >= interval:
+            save, reason = True, 'interval'
+        else:
+            save, reason = False, 'waiting'
+        self.decisions.append(SaveDecision(now, save, reason, interval, self.pending_edits, unsaved_seconds))
+        return save
+
+    def stats(self):
+        interval = self.save_interval()
+        return {
+            'save_count': self.save_count,
+            'save_seconds': self.save_seconds,
+            'save_bytes': self.save_bytes,
+            'save_interval': interval,
+            'bytes_per_second': self.save_bytes / interval if self.save_bytes is not None else None,
+            'pending_edits': self.pending_edits
+        }
 
 class AutoSyncCacheBase(object):
-    def __init__(self, base_class, cache_name, time_checks=None, time_bucket_size=None, **kwargs):
+    '''
+    Tracks edit counts in time buckets and saves once any time_checks threshold is crossed.
+
+    With background_sync enabled, edits only record counts and the manager's autosync
+    scheduler checks the thresholds on a timer, so saves happen outside of the write path
+    and quiet caches still save their trailing edits. Edits hold the sync lock while they
+    change contents and background saves hold it while saving, so saves never read contents
+    mid-edit. A failed save is retried on the next check.
+
+    Passing an AdaptiveSyncPolicy as policy makes it decide when to save instead of time_checks.
+
+    A count_mode of 'keys' makes thresholds apply to distinct keys changed since the last
+    save rather than to raw edits, so rewriting one hot key counts once. Counts can also be
+    weighted by an edit_weigher(key, value) callable such as value_size_weigher.
+
+    With track_changes enabled, every set and delete made through the cache is recorded
+    in change_log for savers which only persist what changed.
+    '''
+    def __init__(self, base_class, cache_name, time_checks=None, time_bucket_size=None,
+                 background_sync=False, policy=None, count_mode='edits', edit_weigher=None,
+                 max_exact_dirty_keys=100000, track_changes=False, **kwargs):
+        if count_mode not in EDIT_COUNT_MODES:
+            raise ValueError("Unknown count_mode '{}', expected one of {}".format(count_mode, EDIT_COUNT_MODES))
         # These are sorted from shortest time frame to longest
         self.time_checks = sorted(time_checks or [TimeCount(60, 10000), TimeCount(300, 10), TimeCount(900, 1)],
             key=attrgetter('time_length'))
         self.time_bucket_size = time_bucket_size or 15 # Seconds
         self.time_counts = deque(0 for _ in range(self.bucket_count()))
         self.last_shift_time = datetime.now()
+        self.background_sync = background_sync
+        self.policy = policy
+        self.dirty_keys = DirtyKeyTracker(max_exact_dirty_keys) if count_mode == 'keys' else None
+        self.edit_weigher = edit_weigher
+        self.change_log = ChangeLog() if track_changes else None
+        self.sync_lock = threading.RLock()
+        self.batch_depth = 0
+        self.batch_edits = 0
+        self.save_failed = False # Its edits were uncounted by the save, so retry regardless of counts
         self.base_class = base_class
 
         self.base_class.__init__(self, cache_name, **kwargs)
+        if self.background_sync:
+            self.manager.autosync_scheduler.register(self)
 
     def bucket_count(self):
         return self.time_checks[-1].time_length // self.time_bucket_size
@@ -55,44 +180,227 @@ class AutoSyncCacheBase(object):
         return len(self.time_counts) - 1 - bucket < time_check.time_length // self.time_bucket_size
 
     def clear_bucket_counts(self):
-        for i in range(self.bucket_count()):
-            self.time_counts[i] = 0
+        with self.sync_lock:
+            for i in range(self.bucket_count()):
+                self.time_counts[i] = 0
+            if self.policy is not None:
+                self.policy.clear_pending()
+            if self.dirty_keys is not None:
+                self.dirty_keys.clear()
 
-    def check_save_conditions(self):
+    def save_conditions_met(self):
+        if self.policy is not None:
+            return self.policy.should_save(datetime.now())
         bucket = len(self.time_counts) - 1
         for check in self.time_checks:
             time_count = 0
             while bucket >= 0 and self.bucket_within_time(bucket, check):
                 time_count += self.time_counts[bucket]
                 if time_count >= check.count:
-                    self.save()
                     return True
                 bucket -= 1
         return False
 
+    def check_save_conditions(self):
+        with self.sync_lock:
+            self.time_shift_buckets()
+            should_save = self.save_failed or self.save_conditions_met()
+        if should_save:
+            self.manager.metrics.inc('autosync_triggers', self.name)
+            self.save()
+        return should_save
+
     def track_edit(self, count=1, edit_time=None):
-        self.time_shift_buckets()
-        if edit_time is None:
-            edit_time = self.last_shift_time
+        with self.sync_lock:
+            self.time_shift_buckets()
+            if edit_time is None:
+                edit_time = self.last_shift_time
 
-        try:
-            self.time_counts[self.find_bucket(edit_time)] += count
+            try:
+                self.time_counts[self.find_bucket(edit_time)] += count
+            except IndexError:
+                return # Edit is too far back or in the future, skip it
+            if self.policy is not None:
+                self.policy.record_edit(count, edit_time)
+
+        if not self.background_sync:
             self.check_save_conditions()
-        except IndexError:
-            pass # Edit is too far back or in the future, skip it
 
-    def __setitem__(self, *args, **kwargs):
+    def edit_weight(self, key, value=None):
+        '''
+        How much a single edit of key counts towards the save thresholds.
+        '''
+        if self.dirty_keys is None:
+            count = 1
+        else:
+            with self.sync_lock:
+                count = self.dirty_keys.add(key)
+        if count and self.edit_weigher:
+            count *= self.edit_weigher(key, value)
+        return count
+
+    def has_unsaved_edits(self):
+        with self.sync_lock:
+            return bool(self.edited or self.save_failed or self.batch_edits or any(self.time_counts))
+
+    def _swap_reloaded(self, contents):
+        # Writes hold the sync lock, so none can land between the check and the swap
+        with self.sync_lock:
+            return self.base_class._swap_reloaded(self, contents)
+
+    def edit_weights(self, pairs):
+        '''
+        The combined edit_weight of (key, value) pairs, taking the sync lock once.
+        '''
+        if self.dirty_keys is None:
+            counts = [1] * len(pairs)
+        else:
+            with self.sync_lock:
+                counts = [self.dirty_keys.add(key) for key, _ in pairs]
+        if self.edit_weigher:
+            return sum(count * self.edit_weigher(key, value) for count, (key, value) in zip(counts, pairs) if count)
+        return sum(counts)
+
+    def dirty_key_count(self):
+        '''
+        Distinct keys changed since the last save, or None when not counting keys.
+        '''
+        return len(self.dirty_keys) if self.dirty_keys is not None else None
+
+    def record_edits(self, count=1):
+        '''
+        Tracks edits immediately, or defers them to the end of the enclosing batch.
+        '''
+        if self.batch_depth:
+            self.batch_edits += count
+        elif count:
+            self.track_edit(count)
+
+    @contextmanager
+    def batch(self):
+        '''
+        Groups all edits made inside the context into a single weighted track_edit, so
+        save conditions are only checked once the outermost batch exits.
+        '''
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if not self.batch_depth:
+                count, self.batch_edits = self.batch_edits, 0
+                self.record_edits(count)
+
+    def __setitem__(self, key, value):
         self._check_contents_present()
-        ret_val = self.contents.__setitem__(*args, **kwargs)
-        self.track_edit()
+        with self.sync_lock:
+            if self.change_log is not None:
+                self.change_log.set(key)
+            self._bloom_add(key)
+            self.edited = True
+            ret_val = self.contents.__setitem__(key, value)
+            self._bloom_written()
+        self.record_edits(self.edit_weight(key, value))
         return ret_val
 
-    def __delitem__(self, *args, **kwargs):
+    def __delitem__(self, key):
         self._check_contents_present()
-        ret_val = self.contents.__delitem__(*args, **kwargs)
-        self.track_edit()
+        with self.sync_lock:
+            if self.change_log is not None:
+                self.change_log.delete(key, self.contents[key])
+            self.edited = True
+            ret_val = self.contents.__delitem__(key)
+            self._bloom_written()
+        self.record_edits(self.edit_weight(key))
         return ret_val
 
+    def set_many(self, items):
+        '''
+        Sets every (key, value) pair from a mapping or iterable as one weighted edit.
+        '''
+        self._check_contents_present()
+        pairs = item_pairs(items)
+        with self.sync_lock:
+            if self.change_log is not None:
+                for key, _ in pairs:
+                    self.change_log.set(key)
+            self._set_many_contents(pairs)
+        self.record_edits(self.edit_weights(pairs))
+
+    def delete_many(self, keys):
+        '''
+        Deletes each of keys which is present as one weighted edit, returning how many were deleted.
+        '''
+        self._check_contents_present()
+        keys = list(keys)
+        with self.sync_lock:
+            if self.change_log is not None:
+                batch_get = getattr(self.contents, 'get_many', None)
+                if batch_get is not None:
+                    found = batch_get(keys)
+                else:
+                    found = dict((key, self.contents[key]) for key in keys if key in self.contents)
+                for key, value in found.items():
+                    self.change_log.delete(key, value)
+            deleted = self._delete_many_contents(keys)
+        self.record_edits(self.edit_weights([(key, None) for key in deleted]))
+        return len(deleted)
+
+    def update(self, *args, **kwargs):
+        if len(args) > 1:
+            raise TypeError('update expected at most 1 arguments, got {}'.format(len(args)))
+        with self.batch():
+            if args:
+                self.set_many(args[0])
+            if kwargs:
+                self.set_many(kwargs)
+
+    def clear(self):
+        self._check_contents_present()
+        if hasattr(self.contents, 'clear'):
+            with self.sync_lock:
+                if self.change_log is not None:
+                    self.change_log.clear_all()
+                if self.dirty_keys is None and self.edit_weigher is None:
+                    count = len(self.contents)
+                else:
+                    count = sum(self.edit_weight(key) for key in self.contents)
+                self.contents.clear()
+            self.record_edits(count)
+        else:
+            if self.change_log is not None:
+                self.change_log.clear_all()
+            with self.batch():
+                MutableMapping.clear(self)
+
+    def pop(self, key, *default):
+        self._check_contents_present()
+        try:
+            value = self.contents[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        with self.sync_lock:
+            if self.change_log is not None:
+                self.change_log.delete(key, value)
+            del self.contents[key]
+        self.record_edits(self.edit_weight(key))
+        return value
+
+    def setdefault(self, key, default=None):
+        self._check_contents_present()
+        try:
+            return self[key]
+        except KeyError:
+            with self.sync_lock:
+                if self.change_log is not None:
+                    self.change_log.set(key)
+                self._bloom_add(key)
+                self.contents[key] = default
+            self.record_edits(self.edit_weight(key, default))
+            return default
+
     def _build(self, *args, **kwargs):
         self.clear_bucket_counts()
         return self.base_class._build(self, *args, **kwargs)
@@ -102,8 +410,24 @@ class AutoSyncCacheBase(object):
         return self.base_class.load(self, *args, **kwargs)
 
     def save(self, *args, **kwargs):
+        if not self.background_sync:
+            return self._counted_save(*args, **kwargs)
+        # Saves run on the scheduler thread, so edits from other threads wait out the save
+        with self.sync_lock:
+            return self._counted_save(*args, **kwargs)
+
+    def _counted_save(self, *args, **kwargs):
         self.clear_bucket_counts()
-        return self.base_class.save(self, *args, **kwargs)
+        start = time.time()
+        try:
+            ret_val = self.base_class.save(self, *args, **kwargs)
+        except:
+            self.save_failed = True
+            raise
+        self.save_failed = False
+        if self.policy is not None:
+            self.policy.record_save(time.time() - start, self.saved_size(), datetime.now())
+        return ret_val
 
     def delete_saved_content(self, *args, **kwargs):
         self.clear_bucket_counts()
@@ -0,0 +1,129 @@
+import struct
+import hashlib
+import numbers
+from math import ceil, exp, log
+from six import text_type, binary_type
+from builtins import range
+
+def stable_key_bytes(key):
+    '''
+    Encodes a key identically in every process, as str hashes are randomized per process.
+    Keys which compare equal share an encoding so they hit the same bits, which only holds
+    for strings, numbers, None and tuples of them. Returns None for any other key.
+    '''
+    if isinstance(key, float) and key.is_integer():
+        key = int(key)
+    if isinstance(key, numbers.Integral):
+        return ('%d' % key).encode('ascii')
+    if isinstance(key, float):
+        return repr(key).encode('ascii')
+    if isinstance(key, text_type):
+        return key.encode('utf-8')
+    if isinstance(key, binary_type):
+        return key
+    if key is None:
+        return b'None'
+    if isinstance(key, tuple):
+        parts = [stable_key_bytes(part) for part in key]
+        if any(part is None for part in parts):
+            return None
+        return b'(' + b''.join(struct.pack('<I', len(part)) + part for part in parts) + b')'
+    return None
+
+class BloomFilter(object):
+    '''
+    A Bloom filter sized for capacity keys at the given false positive rate. Keys are never
+    reported missing once added, so a negative answer can skip the backing contents entirely.
+    Once a key without a stable encoding is added the filter stops ruling keys out, as it
+    could equal a key of another type (Decimal(2) == 2).
+    '''
+    def __init__(self, capacity=1024, error_rate=0.01):
+        if not 0 < error_rate < 1:
+            raise ValueError("Bloom error_rate must be between 0 and 1, got {}".format(error_rate))
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.bit_count = max(int(ceil(-self.capacity * log(error_rate) / (log(2) ** 2))), 8)
+        self.hash_count = max(int(round(float(self.bit_count) / self.capacity * log(2))), 1)
+        self.bits = bytearray((self.bit_count + 7) >> 3)
+        self.count = 0
+        self.exact = True
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.checks = 0
+        self.negatives = 0
+        self.false_positives = 0
+
+    def _positions(self, encoded):
+        first, second = struct.unpack('<QQ', hashlib.md5(encoded).digest())
+        second |= 1
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.bit_count
+
+    def add(self, key):
+        self.count += 1
+        encoded = stable_key_bytes(key)
+        if encoded is None:
+            self.exact = False
+            return
+        bits = self.bits
+        for position in self._positions(encoded):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        encoded = stable_key_bytes(key) if self.exact else None
+        if encoded is None:
+            return True
+        bits = self.bits
+        for position in self._positions(encoded):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def check(self, key):
+        '''
+        Like `key in filter`, but counted towards the filter's stats.
+        '''
+        self.checks += 1
+        if key in self:
+            return True
+        self.negatives += 1
+        return False
+
+    def record_false_positive(self):
+        self.false_positives += 1
+
+    def saturated(self):
+        return self.count > self.capacity
+
+    def estimated_false_positive_rate(self):
+        return (1 - exp(-float(self.hash_count) * self.count / self.bit_count)) ** self.hash_count
+
+    def stats(self):
+        positives = self.checks - self.negatives
+        return {
+            'capacity': self.capacity,
+            'count': self.count,
+            'bits': self.bit_count,
+            'hashes': self.hash_count,
+            'exact': self.exact,
+            'checks': self.checks,
+            'negatives': self.negatives,
+            'false_positives': self.false_positives,
+            'observed_false_positive_rate': float(self.false_positives) / positives if positives else 0.0,
+            'estimated_false_positive_rate': self.estimated_false_positive_rate(),
+        }
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+        # Hit counters describe this process' lookups, not the saved filter
+        state = self.__dict__.copy()
+        for name in ['checks', 'negatives', 'false_positives']:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reset_stats()
@@ -4,6 +4,14 @@ from collections import defaultdict
 
 from .cachewrap import CacheWrap, NonPersistentCache, PersistentCache
 from .autosync import AutoSyncCache
+from .sharedmem import SharedMemoryCache
+from .tiered import TieredCache
+from .lazypickle import LazyPersistentCache, AutoSyncLazyPersistentCache
+from .scheduler import AutoSyncScheduler
+from .metrics import CacheMetrics, write_prometheus_file, serve_prometheus
+from .tracing import Tracer
+from .memory import deep_sizeof
+from .chunkstore import collect_garbage
 
 DEFAULT_CACHEMAN = 'general_cacher'
 
@@ -23,8 +31,15 @@ class CacheManager():
         self.cache_directory = os.path.join(base_cache_directory or tempfile.gettempdir(), self.name)
         self.cache_by_name = {}
         self.async_pid_cache = defaultdict(set) # Used for async cache tracking
+        self.autosync_scheduler = AutoSyncScheduler() # Only starts once a background_sync cache registers
+        self.metrics = CacheMetrics()
+        self.tracer = None # Set by enable_tracing
+        self.memory_budget = None # Bytes, checked whenever a cache loads or builds
+        self.memory_sample_size = 64
+        self.enforcing_budget = False
 
     def __del__(self):
+        self.autosync_scheduler.stop(wait=False)
         self.save_all_cache_contents()
 
     def __enter__(self):
@@ -52,12 +67,24 @@ class CacheManager():
     def register_cache(self, cache_name, contents=None):
         return self.register_custom_cache(cache_name, contents, persistent=True, autosync=True, nowrapper=False)
 
-    def register_custom_cache(self, cache_name, contents=None, persistent=True, autosync=True, nowrapper=False, **kwargs):
+    def register_custom_cache(self, cache_name, contents=None, persistent=True, autosync=True, nowrapper=False,
+                              shared=False, tiered=False, lazy_values=False, **kwargs):
         if nowrapper or isinstance(contents, CacheWrap):
             cache = contents
+        elif shared:
+            # Shared contents are read-only, so there are no edits to autosync
+            cache = SharedMemoryCache(cache_name, cache_manager=self, contents=contents, **kwargs)
+        elif tiered:
+            if autosync:
+                raise ValueError("Tiered cache '{}' persists entry by entry and flushes on save, "
+                    "so can't autosync; register it with autosync=False".format(cache_name))
+            cache = TieredCache(cache_name, cache_manager=self, contents=contents, **kwargs)
         elif not persistent:
             # Replace default pickle loader/saver/deleter
             cache = NonPersistentCache(cache_name, cache_manager=self, contents=contents, **kwargs)
+        elif lazy_values:
+            cache_class = AutoSyncLazyPersistentCache if autosync else LazyPersistentCache
+            cache = cache_class(cache_name, cache_manager=self, contents=contents, **kwargs)
         elif autosync:
             cache = AutoSyncCache(cache_name, cache_manager=self, contents=contents, **kwargs)
         else:
@@ -104,9 +131,9 @@ class CacheManager():
         cache.validator = validator
         return cache
 
-    def register_dependent_cache(self, cache_name, dependent_cache):
+    def register_dependent_cache(self, cache_name, dependent_cache, key_mapper=None):
         cache = self.retrieve_cache(cache_name)
-        cache.add_dependent(dependent_cache)
+        cache.add_dependent(dependent_cache, key_mapper)
         return cache
 
     def deregister_cache(self, cache_name, apply_to_dependents=False):
@@ -118,6 +145,7 @@ class CacheManager():
         if apply_to_dependents:
             for dependent in cache._retrieve_dependent_caches():
                 self.deregister_cache(dependent.name, apply_to_dependents)
+        self.autosync_scheduler.deregister(cache_name)
         del self.cache_by_name[cache_name]
 
     def deregister_all_caches(self):
@@ -150,6 +178,14 @@ class CacheManager():
         cache.invalidate(apply_to_dependents)
         return cache
 
+    def invalidate_cache_keys(self, cache_name, keys, apply_to_dependents=True):
+        '''
+        Invalidates keys of a cache and the entries they map to in its dependents, returning
+        the report of entries touched per cache.
+        '''
+        cache = self.retrieve_cache(cache_name)
+        return cache.invalidate_keys(keys, apply_to_dependents)
+
     def invalidate_and_rebuild_cache(self, cache_name, apply_to_dependents=True):
         cache = self.retrieve_cache(cache_name)
         cache.invalidate_and_rebuild(apply_to_dependents)
@@ -173,6 +209,109 @@ class CacheManager():
         cache.load_or_build(apply_to_dependents)
         return cache
 
+    def stats(self):
+        '''
+        Returns the collected metrics for each cache, along with its current size and bloom filter
+        or tier stats.
+        '''
+        stats = self.metrics.stats()
+        for cache_name, cache in list(self.cache_by_name.items()):
+            cache_stats = stats.setdefault(cache_name, {})
+            # Avoid len(cache) so lazy caches aren't built just to be counted
+            contents = cache.contents if isinstance(cache, CacheWrap) else cache
+            try:
+                cache_stats['entries'] = len(contents)
+            except TypeError:
+                pass
+            if isinstance(cache, CacheWrap) and cache.bloom_enabled and contents is not None:
+                cache_stats['bloom'] = cache.bloom_stats()
+            if isinstance(cache, CacheWrap) and cache.unloaded:
+                cache_stats['unloaded'] = True
+            if isinstance(cache, TieredCache):
+                cache_stats['tiers'] = cache.tier_stats()
+            if isinstance(cache, CacheWrap) and cache.build_report is not None:
+                cache_stats['partitions'] = cache.build_report
+        return stats
+
+    def set_memory_budget(self, budget_bytes, sample_size=64):
+        '''
+        Caps the estimated memory of all caches, unloading the least recently used persistent
+        caches when exceeded. Unloaded caches reload transparently on their next access.
+        Recency is only tracked while a budget is set, unless metrics or other features
+        already route lookups through the tracked path. Returns the names of any caches unloaded to get under the new budget.
+        '''
+        self.memory_budget = budget_bytes
+        self.memory_sample_size = sample_size
+        return self.enforce_memory_budget()
+
+    def footprints(self):
+        '''
+        Estimated bytes held in memory by each cache, with unloaded caches at 0.
+        '''
+        sizes = {}
+        for cache_name, cache in list(self.cache_by_name.items()):
+            if isinstance(cache, CacheWrap):
+                sizes[cache_name] = cache.estimated_size(self.memory_sample_size)
+            else:
+                sizes[cache_name] = deep_sizeof(cache, self.memory_sample_size)
+        return sizes
+
+    def enforce_memory_budget(self, exclude=None):
+        '''
+        Unloads least recently used caches, other than exclude, until the estimated total fits the
+        budget. Returns the names of the caches unloaded.
+        '''
+        if self.memory_budget is None or self.enforcing_budget:
+            return []
+        self.enforcing_budget = True
+        try:
+            sizes = self.footprints()
+            total = sum(sizes.values())
+            candidates = sorted((cache for cache_name, cache in self.cache_by_name.items()
+                if cache_name != exclude and isinstance(cache, CacheWrap) and sizes[cache_name]),
+                key=lambda cache: cache.last_access)
+            unloaded = []
+            for cache in candidates:
+                if total <= self.memory_budget:
+                    break
+                if cache.unload():
+                    total -= sizes[cache.name]
+                    unloaded.append(cache.name)
+            return unloaded
+        finally:
+            self.enforcing_budget = False
+
+    def collect_snapshot_garbage(self, grace_seconds=3600):
+        '''
+        Removes snapshot chunks no remaining snapshot references, returning (chunks removed, bytes freed).
+        '''
+        return collect_garbage(self.cache_directory, grace_seconds)
+
+    def enable_tracing(self, max_events=100000):
+        '''
+        Starts recording spans of cache operations and callbacks, returning the tracer whose
+        write(path) exports them as Chrome trace JSON.
+        '''
+        if self.tracer is None:
+            self.tracer = Tracer(max_events)
+        return self.tracer
+
+    def disable_tracing(self):
+        tracer, self.tracer = self.tracer, None
+        return tracer
+
+    def write_metrics(self, path):
+        '''
+        Writes metrics in Prometheus text format, e.g. for a node exporter textfile collector.
+        '''
+        write_prometheus_file(self.metrics, path)
+
+    def serve_metrics(self, port=0, host='127.0.0.1'):
+        '''
+        Serves metrics in Prometheus text format from a background thread, returning the server.
+        '''
+        return serve_prometheus(self.metrics, port, host)
+
     def reload_or_rebuild_all_caches(self):
         for cache_name in self.cache_by_name:
             self.reload_or_rebuild_cache(cache_name, False)
@@ -1,4 +1,12 @@
+import sys
+from array import array
+from bisect import bisect_left
+from operator import index as int_index
 from collections import MutableMapping
+from collections import MutableSet
+
+# Python 2 arrays have no 'q', and its 'l' is 64 bits on the posix platforms we run on
+INT64_TYPECODE = 'q' if sys.version_info[0] > 2 else 'l'
 
 class IgnoredDict(MutableMapping):
     '''
@@ -43,7 +51,7 @@ class SetAsDictWrap(MutableMapping):
         return self.wrapped_set.__len__()
 
     def __delitem__(self, key):
-        self.wrapped_set.__delitem__(key)
+        self.wrapped_set.remove(key)
 
     def __contains__(self, key):
         return self.wrapped_set.__contains__(key)
@@ -52,6 +60,9 @@ class SetAsDictWrap(MutableMapping):
         '''
         If a method or attribute is missing, use the content's attributes
         '''
+        if name == 'wrapped_set':
+            # Not yet set while unpickling
+            raise AttributeError(name)
         for getter in ['__getattribute__', '__getattr__']:
             if hasattr(self.wrapped_set, getter):
                 try:
@@ -60,3 +71,206 @@ class SetAsDictWrap(MutableMapping):
                     pass
         raise AttributeError("'{}' and '{}' objects have no attribute '{}'".format(
             self.__class__.__name__, self.wrapped_set.__class__.__name__, name))
+
+def _array_to_bytes(values):
+    return values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+
+def _array_from_bytes(typecode, data):
+    values = array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    return values
+
+def _as_int_key(key):
+    '''
+    Returns key as a non-negative int, or None when it can't be one.
+    '''
+    try:
+        key = int_index(key)
+    except TypeError:
+        return None
+    return key if key >= 0 else None
+
+class DenseIntMap(MutableMapping):
+    '''
+    Maps dense, non-negative int keys to values held in an array of the given typecode
+    ('l' for ints, 'd' for floats), with a bytearray marking which keys are present.
+    Memory grows with the largest key rather than the number of keys.
+    '''
+    def __init__(self, items=None, typecode='l'):
+        self.typecode = typecode
+        self.values = array(typecode)
+        self.present = bytearray()
+        self.count = 0
+        if items:
+            self.update(items)
+
+    def _grow(self, key):
+        capacity = max(key + 1, 2 * len(self.values))
+        extra = capacity - len(self.values)
+        self.values.extend(array(self.typecode, [0]) * extra)
+        self.present.extend(bytearray(extra))
+
+    def __getitem__(self, key):
+        index = _as_int_key(key)
+        if index is None or index >= len(self.present) or not self.present[index]:
+            raise KeyError(key)
+        return self.values[index]
+
+    def __setitem__(self, key, value):
+        index = _as_int_key(key)
+        if index is None:
+            raise KeyError("DenseIntMap keys must be non-negative ints, got {}".format(repr(key)))
+        if index >= len(self.values):
+            self._grow(index)
+        self.values[index] = value
+        if not self.present[index]:
+            self.present[index] = 1
+            self.count += 1
+
+    def __delitem__(self, key):
+        index = _as_int_key(key)
+        if index is None or index >= len(self.present) or not self.present[index]:
+            raise KeyError(key)
+        self.present[index] = 0
+        self.count -= 1
+
+    def __contains__(self, key):
+        index = _as_int_key(key)
+        return index is not None and index < len(self.present) and bool(self.present[index])
+
+    def __iter__(self):
+        index = self.present.find(b'\x01')
+        while index >= 0:
+            yield index
+            index = self.present.find(b'\x01', index + 1)
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+        # Drop the unused capacity past the largest key
+        size = self.present.rfind(b'\x01') + 1
+        return (self.typecode, _array_to_bytes(self.values[:size]), bytes(self.present[:size]), self.count)
+
+    def __setstate__(self, state):
+        typecode, values, present, self.count = state
+        self.typecode = typecode
+        self.values = _array_from_bytes(typecode, values)
+        self.present = bytearray(present)
+
+class SortedArrayMap(MutableMapping):
+    '''
+    Holds int keys and values in sorted parallel arrays, looking keys up by bisection.
+    Meant for maps which are built once: updating existing keys is cheap, but inserting
+    or deleting keys shifts the arrays.
+    '''
+    def __init__(self, items=None, key_typecode=INT64_TYPECODE, value_typecode='d'):
+        self.key_typecode = key_typecode
+        self.value_typecode = value_typecode
+        pairs = sorted(dict(items or {}).items())
+        self.keys_array = array(key_typecode, [key for key, _ in pairs])
+        self.values = array(value_typecode, [value for _, value in pairs])
+
+    def _find(self, key):
+        try:
+            index = bisect_left(self.keys_array, key)
+        except TypeError:
+            return None, -1
+        found = index < len(self.keys_array) and self.keys_array[index] == key
+        return found, index
+
+    def __getitem__(self, key):
+        found, index = self._find(key)
+        if not found:
+            raise KeyError(key)
+        return self.values[index]
+
+    def __setitem__(self, key, value):
+        found, index = self._find(key)
+        if found is None:
+            raise KeyError("SortedArrayMap keys must be ints, got {}".format(repr(key)))
+        if found:
+            self.values[index] = value
+        else:
+            self.keys_array.insert(index, key)
+            self.values.insert(index, value)
+
+    def __delitem__(self, key):
+        found, index = self._find(key)
+        if not found:
+            raise KeyError(key)
+        self.keys_array.pop(index)
+        self.values.pop(index)
+
+    def __contains__(self, key):
+        return bool(self._find(key)[0])
+
+    def __iter__(self):
+        return iter(self.keys_array)
+
+    def __len__(self):
+        return len(self.keys_array)
+
+    def __getstate__(self):
+        return (self.key_typecode, self.value_typecode,
+                _array_to_bytes(self.keys_array), _array_to_bytes(self.values))
+
+    def __setstate__(self, state):
+        self.key_typecode, self.value_typecode, keys, values = state
+        self.keys_array = _array_from_bytes(self.key_typecode, keys)
+        self.values = _array_from_bytes(self.value_typecode, values)
+
+class CompactIntSet(MutableSet):
+    '''
+    A set of dense, non-negative ints stored as a bitmap, using one bit per possible id.
+    Wrap it in SetAsDictWrap to use it as cache contents.
+    '''
+    def __init__(self, values=None):
+        self.bits = bytearray()
+        self.count = 0
+        for value in values or []:
+            self.add(value)
+
+    def __contains__(self, value):
+        index = _as_int_key(value)
+        if index is None or (index >> 3) >= len(self.bits):
+            return False
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def add(self, value):
+        index = _as_int_key(value)
+        if index is None:
+            raise ValueError("CompactIntSet values must be non-negative ints, got {}".format(repr(value)))
+        byte = index >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytearray(max(byte + 1, 2 * len(self.bits)) - len(self.bits)))
+        mask = 1 << (index & 7)
+        if not self.bits[byte] & mask:
+            self.bits[byte] |= mask
+            self.count += 1
+
+    def discard(self, value):
+        if value in self:
+            index = _as_int_key(value)
+            self.bits[index >> 3] &= ~(1 << (index & 7)) & 0xff
+            self.count -= 1
+
+    def __iter__(self):
+        for byte_index, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield (byte_index << 3) | bit
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+        return (bytes(self.bits), self.count)
+
+    def __setstate__(self, state):
+        bits, self.count = state
+        self.bits = bytearray(bits)
@@ -1,20 +1,94 @@
+import os
+import threading
+from itertools import count
+from functools import partial
 from collections import MutableMapping
+from timeit import default_timer
 from past.builtins import basestring
 
 from .registers import *
+from .bloom import BloomFilter
+from .tracing import traced_cascade
+from .memory import deep_sizeof
+from .coherence import FileCoherence, file_signature, stamp_deleter
+from .chunkstore import snapshot_saver, snapshot_loader, list_snapshots, prune_snapshots
+from .partitions import build_partitions
+
+access_ticks = count() # Orders cache accesses for least-recently-used unloading
+WRITE_CONFLICTS = ('overwrite', 'skip', 'merge')
+REBUILD = object() # Returned by an incremental_builder to ask for a full rebuild
+
+def item_pairs(items):
+    '''
+    Lists (key, value) pairs from a mapping or an iterable of pairs.
+    '''
+    if hasattr(items, 'keys'):
+        return [(key, items[key]) for key in items.keys()]
+    return list(items)
+
+def dict_merger(saved, contents):
+    '''
+    Default merger for conflicting saves, keeping keys from both with ours winning.
+    '''
+    merged = dict(saved)
+    merged.update(contents)
+    return merged
 
 class CacheWrap(MutableMapping, object):
     '''
     A class designed to immitate the contents it holds with a capability to reload,
     rebuild, destroy, or save it's contents without disrupting any references to
     the cache object.
+
+    With coherent enabled, every save stamps the file with a generation and reads stat
+    the file at most once per coherence_interval seconds, reloading contents (in a
+    background thread unless coherence_background is False) when another process
+    replaced it. Caches with edits made through the wrapper since they last loaded or saved
+    keep their contents until they save.
+
+    With locked_saves enabled, the commit of each save (the move of the finished temporary
+    file into place) holds an advisory lock so processes sharing a cache directory commit
+    one at a time, while reads stay lock free. When another process committed a newer
+    generation since this one last loaded or saved, write_conflict decides between
+    'overwrite', 'skip' (the other save wins) or 'merge' via merger(saved, contents). Saved
+    keys this process deleted since it last loaded or saved are dropped before merging.
+
+    With bloom_filter enabled, lookups of keys the filter rules out skip contents. Keys
+    written around the wrapper (through cache.contents or mutators like update) only reach
+    the filter when they change the number of entries, so such edits should replace
+    contents or go through the wrapper.
+
+    Caches built from independent partitions can define partitioner(name), returning the
+    partitions, and partition_builder(name, partition) in place of builder. Partitions are
+    then built in a pool of build_processes processes and merged into contents, with
+    failed partitions retried partition_retries times. build_report holds the timings and
+    errors of each partition from the last build.
+
+    apply_changes(changes) updates contents from a change set of upstream records through
+    incremental_builder(name, contents, changes), which either edits contents in place and
+    returns None, returns new contents, or returns REBUILD to fall back to a full rebuild.
+    The same change set then goes to each dependent, and caches without an
+    incremental_builder rebuild in full.
+
+    Dependents added with a key_mapper(key), returning the dependent keys a parent key
+    affects, are invalidated key by key: invalidate_keys(keys) evicts the keys, or
+    recomputes them when key_builder(name, key) is defined (raising KeyError to drop the
+    key), then does the same for the mapped keys of each dependent. Dependents without a
+    key_mapper rebuild in full.
     '''
 
     CALLBACK_NAMES = ['loader', 'async_presaver', 'async_saver', 'async_cleaner', 'saver', 'builder', 'deleter',
-                      'pre_processor', 'post_processor', 'validator']
+                      'pre_processor', 'post_processor', 'validator', 'partitioner', 'partition_builder',
+                      'incremental_builder', 'key_builder']
 
     def __init__(self, cache_name, contents=None, dependents=None, cache_manager=None,
-                 async=False, async_timeout=60, save_on_blank_cache=True, **kwargs):
+                 async=False, async_timeout=60, save_on_blank_cache=True, bloom_filter=False,
+                 bloom_error_rate=0.01, bloom_capacity=None, coherent=False, coherence_interval=1.0,
+                 coherence_background=True, locked_saves=False, write_conflict='overwrite', merger=None,
+                 build_processes=None, partition_retries=1, **kwargs):
+        if write_conflict not in WRITE_CONFLICTS:
+            self.delete_triggered = True # Nothing to save on del
+            raise ValueError("Unknown write_conflict '{}', expected one of {}".format(write_conflict, WRITE_CONFLICTS))
         if cache_manager:
             self.manager = cache_manager
         else:
@@ -23,13 +97,40 @@ class CacheWrap(MutableMapping, object):
         self.contents = contents
         self.name = cache_name
         self.dependents = set([self._convert_dependent_to_name(d) for d in dependents] if dependents else [])
+        self.key_mappers = {} # Dependent name: key_mapper
         self.async = async
         self.async_timeout = async_timeout
         self.save_on_blank = save_on_blank_cache
+        self.bloom_enabled = bloom_filter
+        self.bloom_error_rate = bloom_error_rate
+        self.bloom_capacity = bloom_capacity
+        self.bloom = None
+        self.bloom_contents = None # The contents object the bloom filter was built from
+        self.bloom_entries = None # Entries in contents when the filter last saw a write
+        self.access_countdown = self.manager.metrics.sample_every
+        self.unloaded = False
+        self.edited = False # Written through the wrapper since the last load or save
+        self.last_access = next(access_ticks)
+        self.coherence = None
+        self.coherence_background = coherence_background
+        self.coherence_thread = None
+        self.write_conflict = write_conflict
+        self.locked_saves = locked_saves or write_conflict != 'overwrite'
+        self.merger = merger or dict_merger
+        self.merge_base = None # Keys as of the last load or save, for merges to spot local deletes
+        self.build_processes = build_processes
+        self.partition_retries = partition_retries
+        self.build_report = None
 
         for name in CacheWrap.CALLBACK_NAMES:
             setattr(self, name, kwargs[name] if name in kwargs else getattr(self, name, None))
 
+        if coherent or self.locked_saves:
+            path = self.persisted_path()
+            if path is None:
+                raise ValueError("Cache '{}' has no saved file to keep coherent".format(self.name))
+            self.coherence = FileCoherence(path, coherence_interval if coherent else None)
+
         if not self.manager.cache_registered(self.name):
             self.manager.register_cache(self.name, contents=self)
 
@@ -54,6 +155,8 @@ class CacheWrap(MutableMapping, object):
         '''
         If a method or attribute is missing, use the content's attributes
         '''
+        if self.__dict__.get('unloaded') and name != 'contents':
+            self._reload()
         for getter in ['__getattribute__', '__getattr__']:
             if hasattr(self.contents, getter):
                 try:
@@ -67,25 +170,294 @@ class CacheWrap(MutableMapping, object):
         raise AttributeError("'{}' and '{}' objects have no attribute '{}'".format(self.__class__.__name__, self.contents.__class__.__name__, name))
 
     def _check_contents_present(self):
+        self.last_access = next(access_ticks)
+        if self.coherence is not None and default_timer() >= self.coherence.next_check:
+            self._check_coherence()
         if self.contents is None:
-            raise AttributeError("No cache contents defined for '{}'".format(self.name))
+            if self.unloaded:
+                self._reload()
+            if self.contents is None:
+                raise AttributeError("No cache contents defined for '{}'".format(self.name))
 
-    def __contains__(self, *args, **kwargs):
+    def has_unsaved_edits(self):
+        '''
+        Whether contents hold changes a reload would lose.
+        '''
+        return self.edited
+
+    def _swap_reloaded(self, contents):
+        '''
+        Swaps in contents reloaded by coherence unless edits landed while they loaded,
+        returning whether it did.
+        '''
+        if self.has_unsaved_edits():
+            return False
+        self.contents = contents
+        return True
+
+    def _check_coherence(self):
+        coherence = self.coherence
+        if coherence.reloading or self.contents is None:
+            return
+        self.manager.metrics.inc('coherence_checks', self.name)
+        if coherence.stale() is None or self.has_unsaved_edits():
+            return
+        coherence.reloading = True
+        if self.coherence_background:
+            self.coherence_thread = threading.Thread(target=self._coherent_reload,
+                name='cacheman-coherence-{}'.format(self.name))
+            self.coherence_thread.daemon = True
+            self.coherence_thread.start()
+        else:
+            self._coherent_reload()
+
+    def _coherent_reload(self):
+        '''
+        Loads the newer saved contents and swaps them in, leaving current contents to serve
+        reads until then.
+        '''
+        coherence = self.coherence
+        try:
+            signature = file_signature(coherence.path)
+            contents = self._load_contents()
+            if contents is not None:
+                if not self._swap_reloaded(contents):
+                    return # Reloaded again once the edits are saved
+                self._load_bloom()
+                self._mark_merge_base()
+                coherence.unread_reload = True
+                coherence.reloads += 1
+                self.manager.metrics.inc('coherence_reloads', self.name)
+            coherence.mark_loaded(signature)
+        except Exception as e:
+            print("Warning: ignored error in '{}' coherence reload - {}".format(self.name, repr(e)))
+        finally:
+            coherence.reloading = False
+
+    def can_unload(self):
+        '''
+        Only caches which can save and load their contents from a file can be dropped from memory.
+        '''
+        return bool(self.saver and self.loader and self.persisted_path())
+
+    def unload(self):
+        '''
+        Synchronously saves contents and then drops them from memory, to be reloaded on next access.
+        Returns False if the cache can't be unloaded.
+        '''
+        if self.contents is None or not self.can_unload():
+            return False
+        if not self.save_on_blank and not self.contents:
+            return False # The save would be skipped and the reload bring back older contents
+        # Let earlier async saves land first so they can't overwrite this one
+        wait_async_saves(self.name, self.manager.async_pid_cache, self.async_timeout)
+        async_save, self.async = self.async, False
+        try:
+            self.save()
+        finally:
+            self.async = async_save
+        self.contents = None
+        self.bloom = None
+        self.bloom_contents = None
+        self.unloaded = True
+        self.manager.metrics.inc('unloads', self.name)
+        return True
+
+    def _reload(self):
+        self.unloaded = False
+        self.manager.metrics.inc('reloads', self.name)
+        self.load_or_build(False)
+
+    def estimated_size(self, sample_size=64):
+        '''
+        Estimated bytes held in memory by the contents, from a sampled deep sizeof.
+        '''
         if self.contents is None:
+            return 0
+        return deep_sizeof(self.contents, sample_size)
+
+    def _bloom_filter(self):
+        '''
+        The bloom filter for the current contents, rebuilt if contents were swapped out.
+        '''
+        if not self.bloom_enabled or self.contents is None:
+            return None
+        if self.bloom is None or self.bloom_contents is not self.contents:
+            self._rebuild_bloom()
+        return self.bloom
+
+    def _rebuild_bloom(self, capacity=None):
+        if capacity is None:
+            capacity = self.bloom_capacity or max(2 * len(self.contents), 1024)
+        bloom = BloomFilter(capacity, self.bloom_error_rate)
+        for key in self.contents:
+            bloom.add(key)
+        if self.bloom is not None and self.bloom_contents is self.contents:
+            # Keep counting across resizes of the same contents
+            bloom.checks, bloom.negatives = self.bloom.checks, self.bloom.negatives
+            bloom.false_positives = self.bloom.false_positives
+        self.bloom = bloom
+        self.bloom_contents = self.contents
+        self.bloom_entries = self._entry_count()
+
+    def _bloom_add(self, key):
+        bloom = self._bloom_filter()
+        if bloom is not None:
+            bloom.add(key)
+            if bloom.saturated():
+                self._rebuild_bloom(2 * max(bloom.capacity, len(self.contents)))
+                # The key might not have reached contents yet
+                self.bloom.add(key)
+
+    def _bloom_written(self):
+        if self.bloom is not None:
+            self.bloom_entries = self._entry_count()
+
+    def _bloom_excludes(self, key):
+        '''
+        True when the bloom filter proves key is absent, so contents needn't be checked.
+        '''
+        bloom = self._bloom_filter()
+        if bloom is None or bloom.check(key):
             return False
-        return self.contents.__contains__(*args, **kwargs)
+        if self._entry_count() != self.bloom_entries:
+            # Contents were written around the wrapper, so the filter may be missing keys
+            self._rebuild_bloom()
+            return key not in self.bloom
+        return True
+
+    def _load_bloom(self):
+        if not self.bloom_enabled or self.contents is None:
+            return
+        bloom = None
+        path = self.persisted_path()
+        if path is not None:
+            bloom = bloom_loader(self.manager.cache_directory, self.name, len(self.contents),
+                file_signature(path))
+        if bloom is not None and bloom.error_rate == self.bloom_error_rate:
+            self.bloom = bloom
+            self.bloom_contents = self.contents
+            self.bloom_entries = len(self.contents)
+        else:
+            self._rebuild_bloom()
 
-    def __getitem__(self, *args, **kwargs):
-        self._check_contents_present()
-        return self.contents.__getitem__(*args, **kwargs)
+    def _save_bloom(self):
+        '''
+        Saves the bloom filter stamped with the signature of the file just saved. Async saves
+        land later, so their filter is rebuilt on load instead.
+        '''
+        bloom = self._bloom_filter()
+        path = self.persisted_path()
+        if bloom is not None and path is not None and not self.async:
+            try:
+                bloom_saver(self.manager.cache_directory, self.name, bloom, len(self.contents),
+                    file_signature(path))
+            except (IOError, OSError) as e:
+                # The filter is rebuilt from contents on load when it's missing
+                print("Warning: ignored error saving '{}' bloom filter - {}".format(self.name, repr(e)))
+
+    def bloom_stats(self):
+        '''
+        Returns how well the bloom filter is short-circuiting lookups, or None when disabled.
+        '''
+        bloom = self._bloom_filter()
+        return bloom.stats() if bloom is not None else None
+
+    def _sample_access(self, lookup, key, membership=False):
+        '''
+        Runs a lookup while measuring it, with each sample standing in for sample_every accesses.
+        Membership lookups are hits when they return True, and others when they don't raise.
+        '''
+        metrics = self.manager.metrics
+        self.access_countdown = metrics.sample_every
+        start = default_timer()
+        try:
+            found = lookup(key)
+        except KeyError:
+            metrics.inc('misses', self.name, metrics.sample_every)
+            raise
+        finally:
+            metrics.observe('access_seconds', self.name, default_timer() - start)
+        hit = found if membership else True
+        metrics.inc('hits' if hit else 'misses', self.name, metrics.sample_every)
+        return found
+
+    def _reload_read(self):
+        '''
+        Counts the first read of reloaded contents, which would otherwise have seen the older
+        generation. Reads after it would be served the same contents either way.
+        '''
+        self.coherence.unread_reload = False
+        self.manager.metrics.inc('stale_reads_prevented', self.name)
 
-    def __setitem__(self, *args, **kwargs):
+    def _contains(self, key):
+        if not self.bloom_enabled:
+            return key in self.contents
+        if self._bloom_excludes(key):
+            return False
+        found = self.contents.__contains__(key)
+        if not found and self.bloom is not None:
+            self.bloom.record_false_positive()
+        return found
+
+    def _getitem(self, key):
+        if not self.bloom_enabled:
+            return self.contents[key]
+        if self._bloom_excludes(key):
+            raise KeyError(key)
+        try:
+            return self.contents.__getitem__(key)
+        except KeyError:
+            if self.bloom is not None:
+                self.bloom.record_false_positive()
+            raise
+
+    def __contains__(self, key):
+        # Go straight to contents when there's no bloom filter, coherence, metrics or memory
+        # budget recency to keep up, inlined as the checks alone cost as much as a lookup
+        manager = self.manager
+        if not (self.bloom_enabled or self.coherence is not None or manager.metrics.enabled or
+                manager.memory_budget is not None or self.contents is None):
+            return key in self.contents
+        self.last_access = next(access_ticks)
+        if self.coherence is not None and default_timer() >= self.coherence.next_check:
+            self._check_coherence()
+        if self.contents is None:
+            if not self.unloaded:
+                return False
+            self._reload()
+        if self.coherence is not None and self.coherence.unread_reload:
+            self._reload_read()
+        self.access_countdown -= 1
+        if self.access_countdown <= 0:
+            return self._sample_access(self._contains, key, membership=True)
+        return self._contains(key)
+
+    def __getitem__(self, key):
+        manager = self.manager
+        if not (self.bloom_enabled or self.coherence is not None or manager.metrics.enabled or
+                manager.memory_budget is not None or self.contents is None):
+            return self.contents[key]
         self._check_contents_present()
-        return self.contents.__setitem__(*args, **kwargs)
+        if self.coherence is not None and self.coherence.unread_reload:
+            self._reload_read()
+        self.access_countdown -= 1
+        if self.access_countdown <= 0:
+            return self._sample_access(self._getitem, key)
+        return self._getitem(key)
+
+    def __setitem__(self, key, value):
+        self._check_contents_present()
+        self._bloom_add(key)
+        self.edited = True
+        self.contents.__setitem__(key, value)
+        self._bloom_written()
 
     def __delitem__(self, *args, **kwargs):
         self._check_contents_present()
-        return self.contents.__delitem__(*args, **kwargs)
+        self.edited = True
+        self.contents.__delitem__(*args, **kwargs)
+        self._bloom_written()
 
     def __iter__(self):
         self._check_contents_present()
@@ -95,6 +467,72 @@ class CacheWrap(MutableMapping, object):
         self._check_contents_present()
         return self.contents.__len__()
 
+    def get_many(self, keys):
+        '''
+        Returns { key: value } for each of keys present, checking contents are present once
+        for the whole batch. Contents which can batch lookups serve it through their own get_many.
+        '''
+        self._check_contents_present()
+        keys = list(keys)
+        batch_get = getattr(self.contents, 'get_many', None)
+        if batch_get is not None:
+            found = batch_get(keys)
+        else:
+            found = {}
+            for key in keys:
+                try:
+                    found[key] = self._getitem(key)
+                except KeyError:
+                    pass
+        metrics = self.manager.metrics
+        metrics.inc('hits', self.name, len(found))
+        metrics.inc('misses', self.name, len(keys) - len(found))
+        return found
+
+    def _set_many_contents(self, pairs):
+        self.edited = True
+        for key, _ in pairs:
+            self._bloom_add(key)
+        batch_set = getattr(self.contents, 'set_many', None)
+        if batch_set is not None:
+            batch_set(pairs)
+        else:
+            contents = self.contents
+            for key, value in pairs:
+                contents[key] = value
+        self._bloom_written()
+
+    def _delete_many_contents(self, keys):
+        '''
+        Deletes the keys which are present, returning them. Contents which can batch deletes
+        serve it through their own delete_many, which returns the keys it found.
+        '''
+        self.edited = True
+        contents = self.contents
+        batch_delete = getattr(contents, 'delete_many', None)
+        if batch_delete is not None:
+            present = batch_delete(keys)
+        else:
+            present = [key for key in keys if key in contents]
+            for key in present:
+                del contents[key]
+        self._bloom_written()
+        return present
+
+    def set_many(self, items):
+        '''
+        Sets every (key, value) pair from a mapping or iterable with a single presence check.
+        '''
+        self._check_contents_present()
+        self._set_many_contents(item_pairs(items))
+
+    def delete_many(self, keys):
+        '''
+        Deletes each of keys which is present, returning how many were deleted.
+        '''
+        self._check_contents_present()
+        return len(self._delete_many_contents(list(keys)))
+
     def __str__(self):
         return "{}<{}>".format(self.__class__.__name__, self.contents.__str__())
 
@@ -105,7 +543,9 @@ class CacheWrap(MutableMapping, object):
         return pickle_loader(self.manager.cache_directory, self.name)
 
     def _manager_pickle_saver(self, name, contents):
-        return pickle_saver(self.manager.cache_directory, name, contents)
+        return pickle_saver(self.manager.cache_directory, name, contents,
+            self._locked_commit(self._manager_pickle_async_mover, self._manager_pickle_async_presaver,
+                self._manager_pickle_async_cleaner))
 
     def _manager_pickle_async_presaver(self, name, contents, extensions):
         return pickle_pre_saver(self.manager.cache_directory, name, contents, extensions)
@@ -119,6 +559,19 @@ class CacheWrap(MutableMapping, object):
     def _manager_pickle_deleter(self, name):
         return pickle_deleter(self.manager.cache_directory, name)
 
+    def persisted_path(self):
+        '''
+        The file path contents are saved to, or None when persistence isn't file based.
+        '''
+        return None
+
+    def saved_size(self):
+        path = self.persisted_path()
+        try:
+            return os.path.getsize(path) if path else None
+        except OSError:
+            return None
+
     def _retrieve_dependent_caches(self, seen_dependents=None):
         for dependent in self.dependents:
             if seen_dependents is None or dependent not in seen_dependents:
@@ -135,33 +588,204 @@ class CacheWrap(MutableMapping, object):
     def _convert_dependent_to_name(self, dependent):
         return dependent if isinstance(dependent, basestring) else dependent.name
 
+    def _callback(self, callback_name):
+        '''
+        Returns the named callback, wrapped in a trace span when the manager is tracing.
+        '''
+        callback = getattr(self, callback_name)
+        tracer = self.manager.tracer
+        if tracer is None or callback is None:
+            return callback
+        return partial(tracer.call, callback_name.lstrip('_'), self.name, callback)
+
+    def _call(self, callback_name, *args):
+        return self._callback(callback_name)(*args)
+
     def _pre_process(self, contents):
         if self.pre_processor:
-            proc_contents = self.pre_processor(contents)
+            proc_contents = self._call('pre_processor', contents)
             if proc_contents is not None:
                 contents = proc_contents
         return contents
 
     def _post_process(self, contents):
         if self.post_processor:
-            proc_contents = self.post_processor(contents)
+            proc_contents = self._call('post_processor', contents)
             if proc_contents is not None:
                 contents = proc_contents
         return contents
 
+    def has_builder(self):
+        return bool(self.builder or (self.partitioner and self.partition_builder))
+
+    def _build_partitions(self):
+        '''
+        Builds and merges every partition, raising a RuntimeError if any still failed after retries.
+        '''
+        metrics = self.manager.metrics
+        partitions = list(self._call('partitioner', self.name))
+        # The raw callback, as the traced wrapper may not pickle into the pool
+        contents, report = build_partitions(self.name, partitions, self.partition_builder,
+            self.build_processes, self.partition_retries)
+        self.build_report = report
+        failed = []
+        for entry in report:
+            metrics.observe('partition_build_seconds', self.name, entry['seconds'])
+            metrics.inc('partition_retries', self.name, entry['attempts'] - 1)
+            if entry['error'] is not None:
+                failed.append(entry['partition'])
+        if failed:
+            metrics.inc('partition_failures', self.name, len(failed))
+            raise RuntimeError("Unable to build partitions {} of {} cache".format(failed, self.name))
+        return contents
+
+    @traced_cascade
     def _build(self):
-        if not self.builder:
+        if not self.has_builder():
             self.contents = self._post_process(dict_loader())
         else:
-            self.contents = self._post_process(self.builder(self.name))
+            with self.manager.metrics.timed('build_seconds', self.name):
+                if self.builder:
+                    contents = self._call('builder', self.name)
+                else:
+                    contents = self._build_partitions()
+            self.contents = self._post_process(contents)
+        self.unloaded = False
+        self.manager.metrics.inc('builds', self.name)
+        if self.bloom_enabled:
+            self._rebuild_bloom()
         self.save()
+        self.manager.enforce_memory_budget(exclude=self.name)
 
         return self.contents
 
+    def _locked_commit(self, commit, presaver=None, cleaner=None):
+        '''
+        Wraps a commit(name, contents, extensions) callback to run under the commit lock and
+        resolve saves which raced another process by write_conflict. Merging needs the presaver
+        to rewrite the temporary file, without one a merge commits as is (as appends do).
+        '''
+        if not self.locked_saves or commit is None:
+            return commit
+        coherence = self.coherence
+        metrics = self.manager.metrics
+        writer = coherence.writer()
+        writer_pid = os.getpid()
+        def locked_commit(name, contents, extensions):
+            merged = False
+            with commit_lock(coherence.path, metrics, self.name):
+                if coherence.changed_by_other(writer) is not None:
+                    metrics.inc('write_conflicts', self.name)
+                    if self.write_conflict == 'skip':
+                        metrics.inc('skipped_saves', self.name)
+                        if cleaner:
+                            cleaner(name, extensions)
+                        if os.getpid() == writer_pid:
+                            self._adopt_winning_save()
+                        self._save_skipped()
+                        return None
+                    if self.write_conflict == 'merge' and presaver is not None:
+                        saved = self._call('loader', name)
+                        if saved is not None:
+                            for key in self.merge_base or ():
+                                if key not in contents:
+                                    saved.pop(key, None) # Deleted here since the last load or save
+                            contents = self.merger(saved, contents)
+                            presaver(name, contents, extensions)
+                            merged = True
+                            metrics.inc('merged_saves', self.name)
+                result = commit(name, contents, extensions)
+                in_writer = os.getpid() == writer_pid
+                if merged and in_writer:
+                    self.contents = self._post_process(contents)
+                # Forked savers stamp merges as themselves so the parent reloads them
+                coherence.stamp(writer if in_writer or not merged else None)
+            return result
+        return locked_commit
+
+    def _adopt_winning_save(self):
+        '''
+        Loads the save which won a skipped conflict, so later saves build on it instead of
+        conflicting with it again.
+        '''
+        signature = file_signature(self.coherence.path)
+        contents = self._load_contents()
+        if contents is not None:
+            self.contents = contents
+            self.edited = False
+            if self.bloom_enabled:
+                self._rebuild_bloom()
+            self._mark_merge_base()
+        self.coherence.mark_loaded(signature)
+
+    def _skip_async_save(self):
+        '''
+        Resolves a skip write_conflict before forking, as a child which skips can't update
+        this process and every later save would conflict again.
+        '''
+        if not self.locked_saves or self.write_conflict != 'skip' or self.coherence.changed_by_other() is None:
+            return False
+        metrics = self.manager.metrics
+        metrics.inc('write_conflicts', self.name)
+        metrics.inc('skipped_saves', self.name)
+        with commit_lock(self.coherence.path, metrics, self.name):
+            self._adopt_winning_save()
+        self._save_skipped()
+        return True
+
+    def _save_skipped(self):
+        '''
+        Called when the skip write_conflict drops a save, for caches whose later saves build
+        on this one landing.
+        '''
+        pass
+
+    def _mark_merge_base(self):
+        if self.write_conflict == 'merge' and self.contents is not None:
+            self.merge_base = set(self.contents)
+
+    def _async_commit(self, commit, presaver=None, cleaner=None):
+        '''
+        Wraps the commit callback of a forked save so the child locks and stamps it.
+        '''
+        if self.locked_saves:
+            return self._locked_commit(commit, presaver, cleaner)
+        if self.coherence is not None and commit is not None:
+            return self.coherence.stamping(commit)
+        return commit
+
     def _async_save(self, name, contents):
-        fork_content_save(name, contents, self.async_presaver, self.async_saver, self.async_cleaner,
-            self.async_timeout, self.manager.async_pid_cache)
+        if self._skip_async_save():
+            return
+        presaver = self._callback('async_presaver')
+        cleaner = self._callback('async_cleaner')
+        saver = self._async_commit(self._callback('async_saver'), presaver, cleaner)
+        fork_content_save(name, contents, presaver, saver, cleaner, self.async_timeout,
+            self.manager.async_pid_cache, self.manager.metrics)
 
+    def _load_contents(self):
+        '''
+        Runs the loader, validator and post processor, returning None for missing or invalid contents.
+        '''
+        metrics = self.manager.metrics
+        with metrics.timed('load_seconds', self.name):
+            contents = self._call('loader', self.name)
+        metrics.inc('loads', self.name)
+
+        if contents is not None and self.validator:
+            try:
+                if not self._call('validator', contents):
+                    contents = None
+            except:
+                contents = None
+
+        if contents is not None:
+            contents = self._post_process(contents)
+        else:
+            metrics.inc('load_misses', self.name)
+        return contents
+
+    @traced_cascade
     def load(self, apply_to_dependents=False, seen_caches=None):
         if seen_caches and self.name in seen_caches:
             return
@@ -171,25 +795,26 @@ class CacheWrap(MutableMapping, object):
             for dependent in self._retrieve_dependent_caches(seen_caches):
                 dependent.load(apply_to_dependents, seen_caches)
 
+        self.unloaded = False
         if self.loader:
-            self.contents = self.loader(self.name)
-
-            if self.contents is None:
-                self.contents = None
-            elif self.validator:
-                try:
-                    if not self.validator(self.contents):
-                        self.contents = None
-                except:
-                    self.contents = None
+            if self.coherence is not None:
+                # Taken before loading so a save landing mid-load still looks stale
+                signature = file_signature(self.coherence.path)
+            self.contents = self._load_contents()
+            self.edited = False
+            if self.coherence is not None:
+                self.coherence.mark_loaded(signature)
 
             if self.contents is not None:
-                self.contents = self._post_process(self.contents)
+                self._load_bloom()
+                self._mark_merge_base()
+                self.manager.enforce_memory_budget(exclude=self.name)
         else:
             self.contents = None
 
         return self.contents
 
+    @traced_cascade
     def save(self, apply_to_dependents=False, seen_caches=None):
         if seen_caches and self.name in seen_caches:
             return
@@ -199,17 +824,41 @@ class CacheWrap(MutableMapping, object):
             for dependent in self._retrieve_dependent_caches(seen_caches):
                 dependent.save(apply_to_dependents, seen_caches)
 
+        if self.unloaded:
+            return None # Contents were saved before they were dropped
+
         contents = self._pre_process(self.contents)
         if not self.save_on_blank and not contents:
             return contents
 
         # Determine if we're doing an async save or not
-        saver = self._async_save if self.async else self.saver
-        return (saver and saver(self.name, contents)) or contents
+        saver = '_async_save' if self.async else 'saver'
+        if not getattr(self, saver):
+            return contents
+        metrics = self.manager.metrics
+        # Cleared first so edits made while saving still count as unsaved
+        edited, self.edited = self.edited, False
+        try:
+            with metrics.timed('save_seconds', self.name):
+                saved = self._call(saver, self.name, contents) or contents
+        except:
+            self.edited = self.edited or edited
+            raise
+        metrics.inc('saves', self.name)
+        self._mark_merge_base()
+        if self.coherence is not None and not self.async and not self.locked_saves:
+            self.coherence.stamp() # Locked commits stamp while holding the lock
+        if not self.async:
+            size = self.saved_size()
+            if size is not None:
+                metrics.observe('save_bytes', self.name, size)
+        self._save_bloom()
+        return saved
 
     def invalidate(self, apply_to_dependents=True, seen_caches=None):
         return self.load(apply_to_dependents, seen_caches)
 
+    @traced_cascade
     def delete_saved_content(self, apply_to_dependents=True, seen_caches=None):
         '''
         Does NOT delete memory cache -- use invalidate_and_rebuild to delete both
@@ -222,9 +871,17 @@ class CacheWrap(MutableMapping, object):
             for dependent in self._retrieve_dependent_caches(seen_caches):
                 dependent.delete_saved_content(apply_to_dependents, seen_caches)
 
+        if self.unloaded:
+            # The saved copy is about to go, so bring contents back into memory first
+            self._reload()
         if self.deleter:
-            self.deleter(self.name)
+            self._call('deleter', self.name)
+        if self.bloom_enabled:
+            bloom_deleter(self.manager.cache_directory, self.name)
+        if self.coherence is not None:
+            stamp_deleter(self.coherence.path)
 
+    @traced_cascade
     def invalidate_and_rebuild(self, apply_to_dependents=True, seen_caches=None):
         if seen_caches and self.name in seen_caches:
             return
@@ -238,6 +895,103 @@ class CacheWrap(MutableMapping, object):
             for dependent in self._retrieve_dependent_caches(seen_caches):
                 dependent.invalidate_and_rebuild(apply_to_dependents, seen_caches)
 
+    def _apply_changes(self, changes):
+        '''
+        Applies a change set to this cache alone, returning 'incremental' or 'rebuild' for how.
+        '''
+        metrics = self.manager.metrics
+        if self.incremental_builder:
+            self._check_contents_present()
+            with metrics.timed('incremental_build_seconds', self.name):
+                contents = self._call('incremental_builder', self.name, self.contents, changes)
+            if contents is not REBUILD:
+                if contents is not None:
+                    self.contents = self._post_process(contents)
+                elif self.bloom_enabled:
+                    self._rebuild_bloom() # Edits in place bypassed the filter
+                metrics.inc('incremental_builds', self.name)
+                self.save()
+                return 'incremental'
+        metrics.inc('incremental_fallbacks', self.name)
+        self.invalidate_and_rebuild(False)
+        return 'rebuild'
+
+    @traced_cascade
+    def apply_changes(self, changes, apply_to_dependents=True, seen_caches=None):
+        '''
+        Updates this cache and, with apply_to_dependents, its dependents from a change set.
+        Returns { cache_name: 'incremental' or 'rebuild' } for each cache reached.
+        '''
+        if seen_caches and self.name in seen_caches:
+            return {}
+        seen_caches = self._add_seen_cache(seen_caches)
+
+        applied = { self.name: self._apply_changes(changes) }
+        if apply_to_dependents:
+            for dependent in self._retrieve_dependent_caches(seen_caches):
+                applied.update(dependent.apply_changes(changes, apply_to_dependents, seen_caches) or {})
+        return applied
+
+    def _entry_count(self):
+        try:
+            return len(self.contents) if self.contents is not None else 0
+        except TypeError:
+            return 0
+
+    def _invalidate_own_keys(self, keys):
+        '''
+        Evicts or recomputes keys in this cache alone, returning how many entries that touched.
+        '''
+        if not self.key_builder:
+            return self.delete_many(keys)
+        rebuilt, dropped = [], []
+        for key in keys:
+            try:
+                rebuilt.append((key, self._call('key_builder', self.name, key)))
+            except KeyError:
+                dropped.append(key)
+        self.set_many(rebuilt)
+        return len(rebuilt) + self.delete_many(dropped)
+
+    @traced_cascade
+    def invalidate_keys(self, keys, apply_to_dependents=True, seen_caches=None):
+        '''
+        Invalidates keys here and, with apply_to_dependents, the entries they map to downstream.
+        Returns { cache_name: { 'touched': entries evicted, recomputed or rebuilt,
+        'entries': entries a full rebuild would have touched, 'rebuilt': bool } } for each
+        cache reached, so summing touched against entries shows what the cascade saved.
+        '''
+        if seen_caches and self.name in seen_caches:
+            return {}
+        seen_caches = self._add_seen_cache(seen_caches)
+
+        self._check_contents_present()
+        keys = set(keys)
+        entries = self._entry_count()
+        touched = self._invalidate_own_keys(keys)
+        if touched:
+            self.save()
+        self.manager.metrics.inc('keys_invalidated', self.name, touched)
+        report = { self.name: { 'touched': touched, 'entries': entries, 'rebuilt': False } }
+
+        if apply_to_dependents:
+            for dependent in self._retrieve_dependent_caches(seen_caches):
+                key_mapper = self.key_mappers.get(dependent.name)
+                if key_mapper is not None:
+                    dependent_keys = set()
+                    for key in keys:
+                        dependent_keys.update(key_mapper(key))
+                    report.update(dependent.invalidate_keys(dependent_keys, apply_to_dependents, seen_caches) or {})
+                    continue
+                before = set(seen_caches)
+                dependent.invalidate_and_rebuild(apply_to_dependents, seen_caches)
+                for name in seen_caches - before:
+                    cache = self.manager.retrieve_cache(name)
+                    count = cache._entry_count() if isinstance(cache, CacheWrap) else 0
+                    report[name] = { 'touched': count, 'entries': count, 'rebuilt': True }
+        return report
+
+    @traced_cascade
     def load_or_build(self, apply_to_dependents=True, seen_caches=None):
         if seen_caches and self.name in seen_caches:
             return
@@ -253,8 +1007,48 @@ class CacheWrap(MutableMapping, object):
 
         return loaded, self.contents
 
-    def add_dependent(self, dependent):
-        self.dependents.add(dependent)
+    def snapshot(self, snapshot_id=None, keep=None):
+        '''
+        Saves mapping contents as a deduplicated snapshot for rollback, only writing chunks no
+        earlier snapshot holds. With keep, only the newest keep snapshots are kept. Returns
+        the snapshot's manifest.
+        '''
+        self._check_contents_present()
+        cache_dir = self.manager.cache_directory
+        manifest = snapshot_saver(cache_dir, self.name, self._pre_process(self.contents), snapshot_id)
+        self.manager.metrics.inc('snapshots', self.name)
+        self.manager.metrics.inc('snapshot_new_bytes', self.name, manifest['new_bytes'])
+        if keep is not None:
+            prune_snapshots(cache_dir, self.name, keep)
+        return manifest
+
+    def snapshots(self):
+        return list_snapshots(self.manager.cache_directory, self.name)
+
+    def restore_snapshot(self, snapshot_id=None):
+        '''
+        Replaces contents with a snapshot, the latest by default, and saves them.
+        Returns False if the snapshot is missing.
+        '''
+        contents = snapshot_loader(self.manager.cache_directory, self.name, snapshot_id)
+        if contents is None:
+            return False
+        self.unloaded = False
+        self.contents = self._post_process(contents)
+        self.save()
+        return True
+
+    def add_dependent(self, dependent, key_mapper=None):
+        '''
+        Adds a dependent cache, which invalidate_keys updates key by key through key_mapper(key)
+        returning the dependent keys affected, or rebuilds in full without one.
+        '''
+        dependent_name = self._convert_dependent_to_name(dependent)
+        self.dependents.add(dependent_name)
+        if key_mapper is not None:
+            self.key_mappers[dependent_name] = key_mapper
+        else:
+            self.key_mappers.pop(dependent_name, None)
 
 class NonPersistentCache(CacheWrap):
     '''
@@ -339,3 +1133,6 @@ class PersistentCache(CacheWrap):
 
     def async_cleaner(self, name, extensions):
         return self._manager_pickle_async_cleaner(name, extensions)
+
+    def persisted_path(self):
+        return generate_pickle_path(self.manager.cache_directory, self.name)
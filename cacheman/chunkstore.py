@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import zlib
+import shutil
+import struct
+import hashlib
+from six import iteritems
+from six.moves import cPickle
+from operator import itemgetter
+
+from .registers import ensure_directory
+from .utils import random_name
+
+RECORD_HEADER = struct.Struct('<II') # key length, value length
+# Fixed rather than highest so unchanged entries pickle to the same bytes across versions
+SNAPSHOT_PICKLE_PROTOCOL = 2
+DEFAULT_AVERAGE_CHUNK = 1 << 15
+CHUNK_COMPRESSION_LEVEL = 1 # Entries pickled one by one repeat a lot, so even fast levels shrink them well
+
+def generate_chunk_directory(cache_dir):
+    return os.path.join(cache_dir, 'chunks')
+
+def generate_chunk_path(cache_dir, digest):
+    return os.path.join(generate_chunk_directory(cache_dir), digest[:2], digest)
+
+def generate_snapshot_directory(cache_dir, cache_name):
+    return os.path.join(cache_dir, 'snapshots', cache_name)
+
+def generate_manifest_path(cache_dir, cache_name, snapshot_id):
+    return os.path.join(generate_snapshot_directory(cache_dir, cache_name), snapshot_id + '.manifest')
+
+def _write_atomic(path, data):
+    ensure_directory(os.path.dirname(path))
+    tmp_path = '.'.join([path, 'tmp', random_name()])
+    try:
+        with open(tmp_path, 'wb') as out_file:
+            out_file.write(data)
+        shutil.move(tmp_path, path)
+    except:
+        try: os.remove(tmp_path)
+        except OSError: pass
+        raise
+
+def snapshot_records(contents):
+    '''
+    Serializes each entry on its own, ordered by its pickled key so entries keep their
+    neighbours between snapshots no matter the order they were inserted in.
+    '''
+    records = []
+    for key, value in iteritems(contents):
+        key_data = cPickle.dumps(key, SNAPSHOT_PICKLE_PROTOCOL)
+        value_data = cPickle.dumps(value, SNAPSHOT_PICKLE_PROTOCOL)
+        records.append((key_data, RECORD_HEADER.pack(len(key_data), len(value_data)) + key_data + value_data))
+    records.sort(key=itemgetter(0))
+    return [record for _, record in records]
+
+def content_defined_chunks(records, average_chunk=DEFAULT_AVERAGE_CHUNK):
+    '''
+    Groups serialized records into chunks averaging average_chunk bytes. A chunk ends after
+    a record when that record's own checksum falls under a threshold scaled by its length,
+    so boundaries follow content and an edit only changes the chunks around it. Chunks
+    are kept between a quarter and four times the average, unless a single record is larger.
+    '''
+    threshold_per_byte = float(1 << 32) / average_chunk
+    min_chunk, max_chunk = average_chunk // 4, average_chunk * 4
+    chunk, chunk_size = [], 0
+    for record in records:
+        if chunk and chunk_size + len(record) > max_chunk:
+            yield b''.join(chunk)
+            chunk, chunk_size = [], 0
+        chunk.append(record)
+        chunk_size += len(record)
+        boundary = (zlib.crc32(record) & 0xffffffff) < len(record) * threshold_per_byte
+        if boundary and chunk_size >= min_chunk:
+            yield b''.join(chunk)
+            chunk, chunk_size = [], 0
+    if chunk:
+        yield b''.join(chunk)
+
+def parse_chunk(data):
+    offset = 0
+    while offset < len(data):
+        key_length, value_length = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        key = cPickle.loads(data[offset:offset + key_length])
+        offset += key_length
+        yield key, cPickle.loads(data[offset:offset + value_length])
+        offset += value_length
+
+def snapshot_saver(cache_dir, cache_name, contents, snapshot_id=None, average_chunk=DEFAULT_AVERAGE_CHUNK):
+    '''
+    Saves contents as a manifest of content addressed chunks, writing only chunks the
+    store doesn't hold yet. Chunks are addressed by the hash of their records and stored
+    compressed. Returns the manifest, including how many chunks were new.
+    '''
+    snapshot_id = snapshot_id or '{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'), random_name(6))
+    digests, entries, total_bytes, new_chunks, new_bytes = [], 0, 0, 0, 0
+    records = snapshot_records(contents)
+    for chunk in content_defined_chunks(records, average_chunk):
+        digest = hashlib.sha1(chunk).hexdigest()
+        path = generate_chunk_path(cache_dir, digest)
+        try:
+            os.utime(path, None) # Refreshed so garbage collection's grace period covers it
+        except OSError:
+            data = zlib.compress(chunk, CHUNK_COMPRESSION_LEVEL)
+            _write_atomic(path, data)
+            new_chunks += 1
+            new_bytes += len(data)
+        digests.append(digest)
+        total_bytes += len(chunk)
+    manifest = {
+        'cache': cache_name,
+        'snapshot': snapshot_id,
+        'created': time.time(),
+        'entries': len(records),
+        'bytes': total_bytes,
+        'chunks': digests,
+        'new_chunks': new_chunks,
+        'new_bytes': new_bytes,
+    }
+    _write_atomic(generate_manifest_path(cache_dir, cache_name, snapshot_id),
+        json.dumps(manifest).encode('utf-8'))
+    return manifest
+
+def list_snapshots(cache_dir, cache_name):
+    '''
+    Returns the manifests of a cache's snapshots, oldest first.
+    '''
+    snapshot_dir = generate_snapshot_directory(cache_dir, cache_name)
+    try:
+        file_names = os.listdir(snapshot_dir)
+    except OSError:
+        return []
+    manifests = []
+    for file_name in file_names:
+        if not file_name.endswith('.manifest'):
+            continue
+        try:
+            with open(os.path.join(snapshot_dir, file_name), 'rb') as manifest_file:
+                manifests.append(json.loads(manifest_file.read().decode('utf-8')))
+        except (IOError, OSError, ValueError):
+            pass
+    return sorted(manifests, key=itemgetter('created', 'snapshot'))
+
+def snapshot_loader(cache_dir, cache_name, snapshot_id=None):
+    '''
+    Loads the given or latest snapshot as a dict, or None if it's missing or incomplete.
+    '''
+    if snapshot_id is None:
+        manifests = list_snapshots(cache_dir, cache_name)
+        if not manifests:
+            return None
+        snapshot_id = manifests[-1]['snapshot']
+    try:
+        with open(generate_manifest_path(cache_dir, cache_name, snapshot_id), 'rb') as manifest_file:
+            manifest = json.loads(manifest_file.read().decode('utf-8'))
+        contents = {}
+        for digest in manifest['chunks']:
+            with open(generate_chunk_path(cache_dir, digest), 'rb') as chunk_file:
+                contents.update(parse_chunk(zlib.decompress(chunk_file.read())))
+    except (IOError, OSError, ValueError, zlib.error):
+        return None
+    return contents
+
+def snapshot_deleter(cache_dir, cache_name, snapshot_id):
+    try:
+        os.remove(generate_manifest_path(cache_dir, cache_name, snapshot_id))
+    except OSError:
+        pass
+
+def prune_snapshots(cache_dir, cache_name, keep):
+    '''
+    Deletes all but the newest keep snapshots, returning the ids removed. Their chunks stay
+    until collect_garbage runs.
+    '''
+    manifests = list_snapshots(cache_dir, cache_name)
+    removed = [manifest['snapshot'] for manifest in manifests[:max(len(manifests) - keep, 0)]]
+    for snapshot_id in removed:
+        snapshot_deleter(cache_dir, cache_name, snapshot_id)
+    return removed
+
+def collect_garbage(cache_dir, grace_seconds=3600):
+    '''
+    Removes chunks no snapshot of any cache references. Chunks touched within grace_seconds
+    are kept, as a save running concurrently may not have written its manifest yet.
+    Returns (chunks removed, bytes freed).
+    '''
+    referenced = set()
+    snapshots_dir = os.path.join(cache_dir, 'snapshots')
+    for cache_name in (os.listdir(snapshots_dir) if os.path.isdir(snapshots_dir) else []):
+        for manifest in list_snapshots(cache_dir, cache_name):
+            referenced.update(manifest['chunks'])
+
+    removed, freed = 0, 0
+    cutoff = time.time() - grace_seconds
+    chunk_dir = generate_chunk_directory(cache_dir)
+    for fan_out in (os.listdir(chunk_dir) if os.path.isdir(chunk_dir) else []):
+        fan_dir = os.path.join(chunk_dir, fan_out)
+        for digest in os.listdir(fan_dir):
+            if digest in referenced:
+                continue
+            path = os.path.join(fan_dir, digest)
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime > cutoff:
+                    continue
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+            freed += stat.st_size
+    return removed, freed
@@ -0,0 +1,132 @@
+import os
+import json
+import shutil
+import threading
+from timeit import default_timer
+
+from .utils import random_name
+
+def generate_stamp_path(persisted_path):
+    return '.'.join([persisted_path, 'gen'])
+
+def file_signature(path):
+    '''
+    A cheap fingerprint of a saved file which changes whenever it's replaced or rewritten.
+    '''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_ino, getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size]
+
+def stamp_saver(path, writer, generation):
+    '''
+    Records which writer produced the current version of path, alongside its file signature
+    so readers can tell if the file was replaced again after the stamp was written.
+    '''
+    stamp_path = generate_stamp_path(path)
+    tmp_path = '.'.join([stamp_path, 'tmp', random_name()])
+    stamp = { 'writer': writer, 'generation': generation, 'signature': file_signature(path) }
+    try:
+        with open(tmp_path, 'w') as stamp_file:
+            json.dump(stamp, stamp_file)
+        shutil.move(tmp_path, stamp_path)
+    except:
+        try: os.remove(tmp_path)
+        except OSError: pass
+        raise
+    return stamp
+
+def stamp_loader(path):
+    try:
+        with open(generate_stamp_path(path), 'r') as stamp_file:
+            return json.load(stamp_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+def stamp_deleter(path):
+    try:
+        os.remove(generate_stamp_path(path))
+    except OSError:
+        pass
+
+class FileCoherence(object):
+    '''
+    Tracks the generation of a cache file this process last loaded or saved. Checks are a
+    single stat at most once every check_interval seconds, and files stamped by this
+    process's own saves are never treated as stale. A check_interval of None only tracks
+    generations for save conflicts, without checking on reads.
+    '''
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.next_check = 0 if check_interval is not None else float('inf')
+        self.signature = None
+        self.generation = 0
+        self.reloads = 0
+        self.unread_reload = False # Set by each reload until a read first sees its contents
+        self.reloading = False
+        self.lock = threading.Lock()
+        self.writer_pid = None
+        self.writer_token = None
+
+    def writer(self):
+        '''
+        Identifies this process, regenerated after a fork so pre-forked workers don't share it.
+        '''
+        pid = os.getpid()
+        if pid != self.writer_pid:
+            self.writer_pid = pid
+            self.writer_token = '{}-{}'.format(pid, random_name())
+        return self.writer_token
+
+    def mark_loaded(self, signature):
+        self.signature = signature
+        if self.check_interval is not None:
+            self.next_check = default_timer() + self.check_interval
+
+    def stamp(self, writer=None):
+        '''
+        Stamps the file after a save, as writer when saving on behalf of a parent process.
+        The generation follows on from the previous stamp, whichever process wrote it.
+        '''
+        previous = stamp_loader(self.path)
+        self.generation = max(self.generation, previous.get('generation', 0) if previous else 0) + 1
+        stamp = stamp_saver(self.path, writer or self.writer(), self.generation)
+        self.mark_loaded(stamp['signature'])
+        return stamp
+
+    def stamping(self, saver):
+        '''
+        Wraps an async saver so the forked child stamps the file as this process.
+        '''
+        writer = self.writer()
+        def stamped_saver(*args):
+            result = saver(*args)
+            self.stamp(writer)
+            return result
+        return stamped_saver
+
+    def stale(self):
+        '''
+        Returns the file signature if another writer replaced the file since it was last
+        loaded, otherwise None. Rate-limited to one stat per check_interval.
+        '''
+        self.next_check = default_timer() + self.check_interval
+        return self.changed_by_other()
+
+    def changed_by_other(self, writer=None):
+        '''
+        Returns the file signature if a writer other than writer (default this process)
+        replaced the file since it was last loaded or saved here, otherwise None.
+        '''
+        signature = file_signature(self.path)
+        if signature is None or signature == self.signature:
+            return None
+        stamp = stamp_loader(self.path)
+        if stamp and stamp.get('signature') == signature and stamp.get('writer') == (writer or self.writer()):
+            # Our own (possibly async) save landed, so memory already matches it
+            self.signature = signature
+            self.generation = max(self.generation, stamp.get('generation', 0))
+            return None
+        return signature
@@ -1,29 +1,217 @@
 import os
+import sys
+import csv
+import locale
+import threading
+from collections import OrderedDict
+from collections import MutableMapping
+from six import iteritems
 
 from .registers import *
+from .registers import _csv_typed_columns
 from .cachewrap import CacheWrap
 from .autosync import AutoSyncCacheBase
 
+class LazyCSVContents(MutableMapping):
+    '''
+    Serves csv cache contents from a key to byte offset index. Rows are only read and parsed
+    when a key is accessed, with the most recent rows kept in a small LRU, and membership is
+    answered from the index alone. Writes stay in memory until the cache is saved.
+    '''
+    def __init__(self, path, offsets, row_reader=None, schema=None, lru_size=1024):
+        self.path = path
+        self.offsets = offsets
+        self.row_reader = row_reader
+        self.parsers = csv_column_parsers(schema) if schema else None
+        self.lru_size = lru_size
+        self.lru = OrderedDict()
+        self.overrides = {}
+        self.deleted = set()
+        self.row_reads = 0
+        self.encoding = locale.getpreferredencoding(False)
+        # Opened up front so a later save replacing the file can't shift our offsets
+        self.csv_file = open(path, 'rb')
+        self.pid = os.getpid()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        csv_file = getattr(self, 'csv_file', None)
+        if csv_file is not None:
+            csv_file.close()
+            self.csv_file = None
+
+    def _lines(self, csv_file):
+        while True:
+            line = csv_file.readline()
+            if not line:
+                return
+            if sys.version_info[0] == 2:
+                yield line
+            else:
+                # Match the newline translation of text_read_mode loads
+                yield line.decode(self.encoding).replace('\r\n', '\n')
+
+    def _read_value(self, offset):
+        if os.getpid() != self.pid:
+            # Forked children share the file position with the parent, so use our own handle
+            self.csv_file = open(self.path, 'rb')
+            self.pid = os.getpid()
+        self.csv_file.seek(offset)
+        row = next(csv.reader(self._lines(self.csv_file), dialect='excel', quoting=csv.QUOTE_MINIMAL))
+        self.row_reads += 1
+        if self.parsers:
+            columns = _csv_typed_columns([row], self.parsers)
+            if self.row_reader:
+                return self.row_reader(tuple(column[0] for column in columns))[1]
+            return columns[1][0] if len(columns) == 2 else tuple(column[0] for column in columns[1:])
+        return self.row_reader(row)[1] if self.row_reader else row[1]
+
+    def __getitem__(self, key):
+        if key in self.overrides:
+            return self.overrides[key]
+        if key in self.deleted or key not in self.offsets:
+            raise KeyError(key)
+        try:
+            value = self.lru.pop(key)
+        except KeyError:
+            value = self._read_value(self.offsets[key])
+            if len(self.lru) >= self.lru_size:
+                self.lru.popitem(last=False)
+        self.lru[key] = value
+        return value
+
+    def __contains__(self, key):
+        return key in self.overrides or (key in self.offsets and key not in self.deleted)
+
+    def __setitem__(self, key, value):
+        self.overrides[key] = value
+        self.deleted.discard(key)
+        self.lru.pop(key, None)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.overrides.pop(key, None)
+        self.lru.pop(key, None)
+        if key in self.offsets:
+            self.deleted.add(key)
+
+    def __iter__(self):
+        for key in self.overrides:
+            yield key
+        for key in self.offsets:
+            if key not in self.overrides and key not in self.deleted:
+                yield key
+
+    def __len__(self):
+        added = sum(1 for key in self.overrides if key not in self.offsets)
+        return len(self.offsets) + added - len(self.deleted)
+
 class CSVCache(CacheWrap):
-    def __init__(self, cache_name, row_builder=None, row_reader=None, **kwargs):
+    '''
+    A persistent cache which saves and loads from csv files.
+
+    A schema of column types ('int', 'float', 'bool', 'str') enables chunked, typed parsing
+    on load, where the first column is the key and the remaining column(s) the value. Wider
+    schemas save tuple values as separate columns unless a row_builder is given.
+
+    Setting load_processes above 1 parses large files in parallel byte ranges, which
+    requires a picklable row_reader.
+
+    With index enabled, saves also write a sidecar index of each key's byte offset. A lazy
+    cache always writes the index and loads as LazyCSVContents, which seeks to and parses
+    single rows on demand, falling back to a full load if the index is missing or stale.
+    Lazy keys are typed by the schema like a full load, but as a row_reader can only key
+    whole rows, caches with one always load in full.
+    '''
+    delete_markers = False # Only incremental csvs write CSV_DELETE_MARKER rows
+
+    def __init__(self, cache_name, row_builder=None, row_reader=None, schema=None, chunk_size=10000,
+                 load_processes=None, index=False, lazy=False, lazy_lru_size=1024, **kwargs):
         self.row_builder = row_builder
         self.row_reader = row_reader
+        self.schema = schema
+        self.chunk_size = chunk_size
+        self.load_processes = load_processes
+        self.index = index or lazy
+        self.lazy = lazy
+        self.lazy_lru_size = lazy_lru_size
+        self.csv_row_count = None # Rows in the csv file, including any overwritten or deleted rows
         CacheWrap.__init__(self, cache_name, **kwargs)
 
+    def _active_row_builder(self):
+        if self.row_builder is None and self.schema and len(self.schema) > 2:
+            return csv_expanded_row_builder
+        return self.row_builder
+
     def saver(self, name, contents):
-        return csv_saver(self.manager.cache_directory, name, contents, self.row_builder)
+        csv_saver(self.manager.cache_directory, name, contents, self._active_row_builder(), self.index,
+            self._locked_commit(self.async_saver, self.async_presaver, self.async_cleaner))
+        if isinstance(self.contents, LazyCSVContents) and self.contents is contents:
+            # Writes are in the new file now, so serve from its index instead
+            self.contents.close()
+            self.contents = self.loader(name)
+
+    def unload(self):
+        contents = self.contents
+        unloaded = CacheWrap.unload(self)
+        if unloaded and isinstance(contents, LazyCSVContents):
+            contents.close()
+        return unloaded
+
+    def _lazy_loader(self, name):
+        if self.row_reader:
+            return None
+        offsets = csv_index_loader(self.manager.cache_directory, name)
+        if offsets is None:
+            return None
+        key_parser = csv_column_parsers(self.schema)[0] if self.schema else None
+        if key_parser is not None:
+            offsets = dict((key_parser(key), offset) for key, offset in iteritems(offsets))
+        try:
+            return LazyCSVContents(generate_csv_path(self.manager.cache_directory, name), offsets,
+                self.row_reader, self.schema, self.lazy_lru_size)
+        except IOError:
+            return None
 
     def loader(self, name):
-        return csv_loader(self.manager.cache_directory, name, self.row_reader)
+        if self.lazy:
+            contents = self._lazy_loader(name)
+            if contents is not None:
+                self.csv_row_count = len(contents.offsets)
+                return contents
+        stats = {}
+        if self.load_processes and self.load_processes > 1:
+            contents = csv_parallel_loader(self.manager.cache_directory, name, self.row_reader, self.schema,
+                self.load_processes, self.chunk_size, stats, deletes=self.delete_markers)
+        elif self.schema:
+            contents = csv_typed_loader(self.manager.cache_directory, name, self.schema, self.row_reader,
+                self.chunk_size, stats, self.delete_markers)
+        else:
+            contents = csv_loader(self.manager.cache_directory, name, self.row_reader, stats, self.delete_markers)
+        self.csv_row_count = stats.get('rows')
+        return contents
+
+    def stream_rows(self, schema=None):
+        '''
+        Streams the saved rows, typed by the cache schema if present, without loading contents.
+        '''
+        return csv_row_stream(self.manager.cache_directory, self.name, schema or self.schema, self.chunk_size)
 
     def deleter(self, name):
-        try:
-            os.remove(generate_csv_path(self.manager.cache_directory, name))
-        except OSError:
-            pass
+        for path in [generate_csv_path(self.manager.cache_directory, name),
+                     generate_csv_resave_path(self.manager.cache_directory, name)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        csv_index_deleter(self.manager.cache_directory, name)
 
     def async_presaver(self, name, contents, extensions):
-        return csv_pre_saver(self.manager.cache_directory, name, contents, extensions, self.row_builder)
+        return csv_pre_saver(self.manager.cache_directory, name, contents, extensions, self._active_row_builder(),
+            self.index)
 
     def async_saver(self, name, contents, extensions):
         return csv_mover(self.manager.cache_directory, name, contents, extensions)
@@ -31,9 +219,170 @@ class CSVCache(CacheWrap):
     def async_cleaner(self, name, extensions):
         return csv_cleaner(self.manager.cache_directory, name, extensions)
 
+    def persisted_path(self):
+        return generate_csv_path(self.manager.cache_directory, self.name)
+
 class AutoSyncCSVCache(AutoSyncCacheBase, CSVCache):
     '''
     AutoSyncCSVCache defaults to a csv basis.
+
+    With incremental enabled, saves append new and updated rows plus delete markers to the
+    existing csv rather than rewriting it, and later rows win on load. Once the fraction of
+    dead rows in the file passes compact_ratio, the next save compacts it with a full rewrite
+    in the background. Only edits made through the cache are appended, and caches with a
+    pre_processor always save in full.
     '''
-    def __init__(self, cache_name, **kwargs):
-        AutoSyncCacheBase.__init__(self, CSVCache, cache_name, **kwargs)
+    def __init__(self, cache_name, incremental=False, compact_ratio=0.5, **kwargs):
+        self.incremental = incremental
+        self.delete_markers = incremental
+        self.compact_ratio = compact_ratio
+        self.compaction_lock = threading.Lock() # Orders appends after any running compaction
+        self.compaction_thread = None
+        AutoSyncCacheBase.__init__(self, CSVCache, cache_name, track_changes=incremental, **kwargs)
+
+    def dead_row_fraction(self):
+        if not self.csv_row_count or self.contents is None:
+            return 0.0
+        return max(0.0, 1.0 - len(self.contents) / float(self.csv_row_count))
+
+    def _can_append(self):
+        # Rows drained into an append another process's save replaced never landed
+        return (self.incremental and not self.change_log.reset_all and not self.pre_processor and
+                os.path.isfile(generate_csv_path(self.manager.cache_directory, self.name)) and
+                (self.coherence is None or self.coherence.changed_by_other() is None))
+
+    def _save_skipped(self):
+        self._resave_in_full()
+
+    def _resave_in_full(self):
+        if self.change_log is not None:
+            self.change_log.clear_all() # The next save has to rewrite everything
+
+    def _resave_marker_path(self):
+        return generate_csv_resave_path(self.manager.cache_directory, self.name)
+
+    def _check_failed_saves(self):
+        '''
+        Forked saves can't reach the parent's change log, so failed ones leave a marker
+        asking for the next save to rewrite the csv in full.
+        '''
+        path = self._resave_marker_path()
+        if os.path.isfile(path):
+            try: os.remove(path)
+            except OSError: pass
+            self._resave_in_full()
+
+    def _marking_failures(self, callback):
+        '''
+        Wraps a forked save callback to leave the resave marker when it fails.
+        '''
+        if callback is None:
+            return None
+        marker_path = self._resave_marker_path()
+        def marked(*args):
+            try:
+                return callback(*args)
+            except:
+                open(marker_path, 'a').close()
+                raise
+        return marked
+
+    def _drain_delta_rows(self, contents):
+        updated, deleted, _ = self.change_log.drain()
+        build = self._active_row_builder() or (lambda key, value: [key, value])
+        rows = [build(key, contents[key]) for key in updated if key in contents]
+        rows.extend([CSV_DELETE_MARKER] + list(build(key, value)) for key, value in iteritems(deleted))
+        return rows
+
+    def _full_save_reset(self, contents):
+        if self.change_log is not None:
+            self.change_log.drain()
+        self.csv_row_count = len(contents) if contents is not None else None
+
+    def saver(self, name, contents):
+        # Changes are drained up front so edits racing the save stay logged for the next one,
+        # and a failed save falls back to rewriting everything
+        self._check_failed_saves()
+        if not self._can_append():
+            self._full_save_reset(contents)
+            try:
+                with self.compaction_lock:
+                    return CSVCache.saver(self, name, contents)
+            except:
+                self._resave_in_full()
+                raise
+        if self.dead_row_fraction() > self.compact_ratio:
+            return self._background_compact(name, contents)
+
+        rows = self._drain_delta_rows(contents)
+        if rows:
+            try:
+                with self.compaction_lock:
+                    csv_append_saver(self.manager.cache_directory, name, rows,
+                        self._locked_commit(self.async_appender, cleaner=self.async_cleaner))
+            except:
+                self._resave_in_full()
+                raise
+            self.csv_row_count += len(rows)
+
+    def _background_compact(self, name, contents):
+        snapshot = dict(iteritems(contents))
+        self._full_save_reset(snapshot)
+        # Taken here and released by the thread, so later appends land in the compacted file
+        self.compaction_lock.acquire()
+        def compact():
+            try:
+                CSVCache.saver(self, name, snapshot)
+            except Exception as e:
+                self.change_log.clear_all() # Appends can't build on a failed compaction
+                print("Warning: ignored error in '{}' cache compaction - {}".format(name, repr(e)))
+            finally:
+                self.compaction_lock.release()
+        self.compaction_thread = threading.Thread(target=compact, name='cacheman-compact-' + name)
+        self.compaction_thread.daemon = True
+        self.compaction_thread.start()
+
+    def _async_save(self, name, contents):
+        self._check_failed_saves()
+        if self._skip_async_save():
+            return
+        cleaner = self._callback('async_cleaner')
+        # Forked full saves already run in the background, so they double as compactions
+        if not self._can_append() or self.dead_row_fraction() > self.compact_ratio:
+            self._full_save_reset(contents)
+            presaver = self._callback('async_presaver')
+            saver = self._async_commit(self._callback('async_saver'), presaver, cleaner)
+            fork_content_save(name, contents, self._marking_failures(presaver), self._marking_failures(saver),
+                cleaner, self.async_timeout, self.manager.async_pid_cache, self.manager.metrics)
+            return
+
+        rows = self._drain_delta_rows(contents)
+        if rows:
+            self.csv_row_count += len(rows)
+            appender = self._async_commit(self.async_appender, cleaner=cleaner)
+            # Killing a running compaction or earlier append would lose the rows drained into it
+            fork_content_save(name, rows, self._marking_failures(self.async_append_presaver),
+                self._marking_failures(appender), cleaner, self.async_timeout, self.manager.async_pid_cache,
+                self.manager.metrics, kill_previous=False)
+
+    def async_append_presaver(self, name, rows, extensions):
+        return csv_rows_pre_saver(self.manager.cache_directory, name, rows, extensions)
+
+    def async_appender(self, name, rows, extensions):
+        return csv_appender(self.manager.cache_directory, name, rows, extensions)
+
+    def load(self, *args, **kwargs):
+        contents = AutoSyncCacheBase.load(self, *args, **kwargs)
+        if self.change_log is not None:
+            self.change_log.drain()
+        return contents
+
+    def _build(self, *args, **kwargs):
+        if self.change_log is not None:
+            self.change_log.clear_all()
+        return AutoSyncCacheBase._build(self, *args, **kwargs)
+
+    def _apply_changes(self, changes):
+        if self.change_log is not None:
+            self.change_log.clear_all() # Incremental builders edit contents without logging it
+        return self.base_class._apply_changes(self, changes)
@@ -0,0 +1,143 @@
+from math import log
+
+_MASK_64 = (1 << 64) - 1
+
+def mix_hash(key):
+    '''
+    Spreads the bits of hash(key) over 64 bits (splitmix64 finalizer), as small ints hash to themselves.
+    '''
+    h = hash(key) & _MASK_64
+    h = ((h ^ (h >> 30)) * 0xbf58476d1ce4e5b9) & _MASK_64
+    h = ((h ^ (h >> 27)) * 0x94d049bb133111eb) & _MASK_64
+    return h ^ (h >> 31)
+
+class HyperLogLog(object):
+    '''
+    Estimates the number of distinct keys added in a fixed 2 ** precision bytes of memory.
+    The estimate is maintained incrementally so reading it stays constant time.
+    '''
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.register_count = 1 << precision
+        self.alpha = 0.7213 / (1 + 1.079 / self.register_count)
+        self.clear()
+
+    def clear(self):
+        self.registers = bytearray(self.register_count)
+        self.inverse_sum = float(self.register_count) # Sum of 2 ** -register
+        self.zero_registers = self.register_count
+
+    def add(self, key):
+        '''
+        Returns True if the key changed the sketch (and so might have been unseen).
+        '''
+        h = mix_hash(key)
+        index = h >> (64 - self.precision)
+        remainder = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remainder.bit_length() + 1
+        current = self.registers[index]
+        if rank <= current:
+            return False
+        if not current:
+            self.zero_registers -= 1
+        self.inverse_sum += 2.0 ** -rank - 2.0 ** -current
+        self.registers[index] = rank
+        return True
+
+    def estimate(self):
+        m = self.register_count
+        raw = self.alpha * m * m / self.inverse_sum
+        if raw <= 2.5 * m and self.zero_registers:
+            # Linear counting is more accurate for small cardinalities
+            return m * log(float(m) / self.zero_registers)
+        return raw
+
+    def __len__(self):
+        return int(round(self.estimate()))
+
+class DirtyKeyTracker(object):
+    '''
+    Counts distinct keys changed since it was last cleared. Keys are tracked exactly in a set
+    until max_exact_keys is crossed, after which a HyperLogLog estimate takes over.
+    '''
+    def __init__(self, max_exact_keys=100000, precision=14):
+        self.max_exact_keys = max_exact_keys
+        self.precision = precision
+        self.clear()
+
+    def clear(self):
+        self.keys = set()
+        self.sketch = None
+        self.reported = 0
+
+    def exact(self):
+        return self.sketch is None
+
+    def add(self, key):
+        '''
+        Marks a key dirty, returning how many new distinct keys this added (usually 0 or 1).
+        '''
+        if self.sketch is None:
+            if key in self.keys:
+                return 0
+            self.keys.add(key)
+            self.reported += 1
+            if len(self.keys) > self.max_exact_keys:
+                self._switch_to_sketch()
+            return 1
+
+        if not self.sketch.add(key):
+            return 0
+        # Only report growth in the estimate so totals never run backwards
+        estimate = len(self.sketch)
+        added = max(estimate - self.reported, 0)
+        self.reported += added
+        return added
+
+    def _switch_to_sketch(self):
+        self.sketch = HyperLogLog(self.precision)
+        for key in self.keys:
+            self.sketch.add(key)
+        self.keys = set()
+
+    def __len__(self):
+        return len(self.keys) if self.sketch is None else self.reported
+
+class ChangeLog(object):
+    '''
+    Records which keys were set or deleted since it was last drained, keeping only the final
+    state of each key. Deleted keys keep their old value so rows can be rebuilt for them.
+    '''
+    def __init__(self):
+        self.updated = set()
+        self.deleted = {}
+        self.reset_all = False
+
+    def set(self, key):
+        self.updated.add(key)
+        self.deleted.pop(key, None)
+
+    def delete(self, key, old_value):
+        self.updated.discard(key)
+        self.deleted[key] = old_value
+
+    def clear_all(self):
+        '''
+        Marks every key as changed, such as when contents are replaced wholesale.
+        '''
+        self.updated = set()
+        self.deleted = {}
+        self.reset_all = True
+
+    def drain(self):
+        '''
+        Returns (updated keys, {deleted key: old value}, reset_all) and starts a fresh log.
+        '''
+        drained = (self.updated, self.deleted, self.reset_all)
+        self.updated = set()
+        self.deleted = {}
+        self.reset_all = False
+        return drained
+
+    def __len__(self):
+        return len(self.updated) + len(self.deleted)
@@ -0,0 +1,221 @@
+import os
+import mmap
+import shutil
+import struct
+import traceback
+from array import array
+from functools import partial
+from six import iteritems
+from six.moves import cPickle
+from collections import MutableMapping
+
+from .registers import *
+from .cacheutils import INT64_TYPECODE, _array_to_bytes, _array_from_bytes
+from .cachewrap import CacheWrap
+from .autosync import AutoSyncCacheBase
+from .utils import random_name
+
+LAZY_PICKLE_MAGIC = b'CMLP'
+LAZY_PICKLE_VERSION = 1
+HEADER = struct.Struct('<4sIQQ') # magic, version, entry count, index offset
+OFFSET_TYPECODE = INT64_TYPECODE
+
+def generate_lazy_pickle_path(cache_dir, cache_name):
+    return generate_path(cache_dir, cache_name, 'lpkl')
+
+class LazyPickleContents(MutableMapping):
+    '''
+    Serves contents saved by lazy_pickle_pre_saver, where every value is pickled separately
+    behind an index of keys and offsets. Opening only reads the index, and each value is
+    unpickled from a memory map of the file on first access then memoized, so startup time
+    and memory follow the number of keys rather than the size of the values.
+    Writes stay in memory until the cache is saved.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.values = {} # Memoized, set or overridden values
+        self.deleted = set()
+        self.value_loads = 0
+        with open(path, 'rb') as lazy_file:
+            magic, version, count, index_offset = HEADER.unpack(lazy_file.read(HEADER.size))
+            if magic != LAZY_PICKLE_MAGIC or version != LAZY_PICKLE_VERSION:
+                raise ValueError("'{}' is not a lazy pickle file".format(path))
+            lazy_file.seek(index_offset)
+            keys, offset_bytes = cPickle.load(lazy_file)
+            # Mapped before the file can be replaced, so later saves can't move our offsets
+            self.map = mmap.mmap(lazy_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = _array_from_bytes(OFFSET_TYPECODE, offset_bytes)
+        self.positions = dict((key, position) for position, key in enumerate(keys))
+        if len(self.positions) != count or len(self.offsets) != count + 1:
+            raise ValueError("'{}' lazy pickle index is truncated".format(path))
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def raw_value(self, key):
+        '''
+        The pickled bytes of a saved value, or None when the value was loaded or changed since
+        (as it may have been mutated in place) so it must be pickled again.
+        '''
+        if key in self.values or key in self.deleted:
+            return None
+        position = self.positions.get(key)
+        if position is None:
+            return None
+        return self.map[self.offsets[position]:self.offsets[position + 1]]
+
+    def __getitem__(self, key):
+        try:
+            return self.values[key]
+        except KeyError:
+            pass
+        if key in self.deleted:
+            raise KeyError(key)
+        position = self.positions[key]
+        value = cPickle.loads(self.map[self.offsets[position]:self.offsets[position + 1]])
+        self.value_loads += 1
+        self.values[key] = value
+        return value
+
+    def __contains__(self, key):
+        return key in self.values or (key in self.positions and key not in self.deleted)
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.values.pop(key, None)
+        if key in self.positions:
+            self.deleted.add(key)
+
+    def __iter__(self):
+        for key in self.positions:
+            if key not in self.deleted:
+                yield key
+        for key in self.values:
+            if key not in self.positions:
+                yield key
+
+    def __len__(self):
+        added = sum(1 for key in self.values if key not in self.positions)
+        return len(self.positions) + added - len(self.deleted)
+
+    def __repr__(self):
+        return '{}<{} keys, {} values loaded>'.format(self.__class__.__name__, len(self), len(self.values))
+
+    def __reduce__(self):
+        # Pickles as a plain dict so other savers persist the contents rather than the mapping
+        return (dict, (dict(iteritems(self)),))
+
+    def reopened(self, path):
+        '''
+        Opens the file a save just wrote from these contents, keeping values already loaded.
+        '''
+        contents = LazyPickleContents(path)
+        contents.values = self.values
+        return contents
+
+def lazy_pickle_pre_saver(cache_dir, cache_name, contents, extensions):
+    '''
+    Writes each value as its own pickle followed by an index of keys and value offsets.
+    Unchanged values of LazyPickleContents are copied across without being unpickled.
+    '''
+    ensure_directory(cache_dir)
+    cache_path = generate_lazy_pickle_path(cache_dir, cache_name)
+    raw_value = contents.raw_value if isinstance(contents, LazyPickleContents) else lambda key: None
+    keys = []
+    offsets = array(OFFSET_TYPECODE, [HEADER.size])
+    with open('.'.join([cache_path] + extensions), 'wb') as lazy_file:
+        lazy_file.write(HEADER.pack(LAZY_PICKLE_MAGIC, LAZY_PICKLE_VERSION, 0, 0))
+        for key in contents:
+            data = raw_value(key)
+            if data is None:
+                data = cPickle.dumps(contents[key], cPickle.HIGHEST_PROTOCOL)
+            lazy_file.write(data)
+            keys.append(key)
+            offsets.append(offsets[-1] + len(data))
+        cPickle.dump((keys, _array_to_bytes(offsets)), lazy_file, cPickle.HIGHEST_PROTOCOL)
+        lazy_file.seek(0)
+        lazy_file.write(HEADER.pack(LAZY_PICKLE_MAGIC, LAZY_PICKLE_VERSION, len(keys), offsets[-1]))
+
+def lazy_pickle_mover(cache_dir, cache_name, contents, extensions):
+    cache_path = generate_lazy_pickle_path(cache_dir, cache_name)
+    shutil.move('.'.join([cache_path] + extensions), cache_path)
+
+def lazy_pickle_cleaner(cache_dir, cache_name, extensions):
+    cache_path = generate_lazy_pickle_path(cache_dir, cache_name)
+    try: os.remove('.'.join([cache_path] + extensions))
+    except OSError: pass
+
+def lazy_pickle_saver(cache_dir, cache_name, contents, commit=None):
+    tmp_exts = ['tmp', random_name()]
+    commit = commit or partial(lazy_pickle_mover, cache_dir)
+    try:
+        try:
+            lazy_pickle_pre_saver(cache_dir, cache_name, contents, tmp_exts)
+            commit(cache_name, contents, tmp_exts)
+        except (IOError, EOFError):
+            traceback.print_exc()
+            raise IOError('Unable to save {} cache'.format(cache_name))
+    except:
+        try: lazy_pickle_cleaner(cache_dir, cache_name, tmp_exts)
+        except: pass
+        raise
+
+def lazy_pickle_loader(cache_dir, cache_name):
+    try:
+        return LazyPickleContents(generate_lazy_pickle_path(cache_dir, cache_name))
+    except (IOError, OSError, EOFError, ValueError, struct.error):
+        return None
+
+def lazy_pickle_deleter(cache_dir, cache_name):
+    try:
+        os.remove(generate_lazy_pickle_path(cache_dir, cache_name))
+    except OSError:
+        pass
+
+class LazyPersistentCache(CacheWrap):
+    '''
+    A persistent cache saved in the lazy pickle format, which loads as LazyPickleContents so
+    values are only unpickled once they're accessed.
+    '''
+    def __init__(self, cache_name, **kwargs):
+        CacheWrap.__init__(self, cache_name, **kwargs)
+
+    def loader(self, name):
+        return lazy_pickle_loader(self.manager.cache_directory, name)
+
+    def saver(self, name, contents):
+        lazy_pickle_saver(self.manager.cache_directory, name, contents,
+            self._locked_commit(self.async_saver, self.async_presaver, self.async_cleaner))
+        if isinstance(self.contents, LazyPickleContents) and self.contents is contents:
+            # Serve from the new file so the old one can be freed
+            previous, self.contents = self.contents, self.contents.reopened(self.persisted_path())
+            previous.close()
+
+    def deleter(self, name):
+        return lazy_pickle_deleter(self.manager.cache_directory, name)
+
+    def async_presaver(self, name, contents, extensions):
+        return lazy_pickle_pre_saver(self.manager.cache_directory, name, contents, extensions)
+
+    def async_saver(self, name, contents, extensions):
+        return lazy_pickle_mover(self.manager.cache_directory, name, contents, extensions)
+
+    def async_cleaner(self, name, extensions):
+        return lazy_pickle_cleaner(self.manager.cache_directory, name, extensions)
+
+    def persisted_path(self):
+        return generate_lazy_pickle_path(self.manager.cache_directory, self.name)
+
+class AutoSyncLazyPersistentCache(AutoSyncCacheBase, LazyPersistentCache):
+    '''
+    AutoSyncLazyPersistentCache saves in the lazy pickle format.
+    '''
+    def __init__(self, cache_name, **kwargs):
+        AutoSyncCacheBase.__init__(self, LazyPersistentCache, cache_name, **kwargs)
@@ -0,0 +1,52 @@
+import sys
+from array import array
+from collections import deque
+from itertools import islice
+from six import iteritems
+
+ATOMIC_TYPES = (int, float, complex, bool, str, bytes, bytearray, type(None), array)
+try:
+    ATOMIC_TYPES += (long, unicode) # Python 2
+except NameError:
+    pass
+SEQUENCE_TYPES = (list, tuple, set, frozenset, deque)
+
+def deep_sizeof(obj, sample_size=64, seen=None):
+    '''
+    Estimates the bytes held by obj and everything it references. Builtin containers larger
+    than sample_size are measured from their first sample_size entries, scaled up by length,
+    so estimates stay cheap for huge caches. Other objects are measured through their attributes,
+    which avoids iterating contents that are read from disk on access.
+    '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, ATOMIC_TYPES):
+        return size
+
+    if isinstance(obj, dict):
+        entries = islice(iteritems(obj), sample_size)
+        size += _scaled_size(len(obj), (part for item in entries for part in item), 2, sample_size, seen)
+    elif isinstance(obj, SEQUENCE_TYPES):
+        size += _scaled_size(len(obj), islice(obj, sample_size), 1, sample_size, seen)
+
+    attributes = getattr(obj, '__dict__', None)
+    if attributes is not None:
+        size += deep_sizeof(attributes, sample_size, seen)
+    for slot in getattr(type(obj), '__slots__', ()):
+        if hasattr(obj, slot):
+            size += deep_sizeof(getattr(obj, slot), sample_size, seen)
+    return size
+
+def _scaled_size(length, parts, parts_per_entry, sample_size, seen):
+    sampled_size = 0
+    sampled_parts = 0
+    for part in parts:
+        sampled_size += deep_sizeof(part, sample_size, seen)
+        sampled_parts += 1
+    if not sampled_parts:
+        return 0
+    return sampled_size * length * parts_per_entry // sampled_parts
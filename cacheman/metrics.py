@@ -0,0 +1,195 @@
+import shutil
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from timeit import default_timer
+from six.moves import BaseHTTPServer
+
+from .utils import random_name
+
+SECONDS_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 0.5, 1, 5, 30, 120)
+BYTES_BUCKETS = (1 << 10, 1 << 15, 1 << 20, 1 << 25, 1 << 30, 1 << 35)
+
+# name: (type, help, histogram buckets)
+METRIC_DEFINITIONS = {
+    'hits': ('counter', 'Lookups which found their key, estimated from sampled accesses plus batch lookups', None),
+    'misses': ('counter', 'Lookups which missed their key, estimated from sampled accesses plus batch lookups', None),
+    'loads': ('counter', 'Loads of saved contents', None),
+    'load_misses': ('counter', 'Loads which found no valid saved contents', None),
+    'builds': ('counter', 'Builds of fresh contents', None),
+    'saves': ('counter', 'Saves, sync or async', None),
+    'async_forks': ('counter', 'Child processes forked for async saves', None),
+    'async_fork_fallbacks': ('counter', 'Async saves run synchronously as fork was unavailable', None),
+    'async_saves_reaped': ('counter', 'Finished async save processes cleaned up', None),
+    'autosync_triggers': ('counter', 'Saves triggered by autosync conditions', None),
+    'unloads': ('counter', 'Contents dropped from memory to meet the manager memory budget', None),
+    'reloads': ('counter', 'Unloaded contents reloaded on access', None),
+    'coherence_checks': ('counter', 'Stats of saved files checking for saves by other processes', None),
+    'coherence_reloads': ('counter', 'Reloads of contents saved by another process', None),
+    'stale_reads_prevented': ('counter', 'Lookups which first saw contents reloaded by coherence', None),
+    'write_conflicts': ('counter', 'Locked saves which found a newer save by another process', None),
+    'skipped_saves': ('counter', 'Conflicting saves dropped by the skip write_conflict', None),
+    'merged_saves': ('counter', 'Conflicting saves merged with the saved contents', None),
+    'partition_retries': ('counter', 'Retries of partitions which failed to build', None),
+    'partition_failures': ('counter', 'Partitions which still failed to build after their retries', None),
+    'incremental_builds': ('counter', 'Change sets applied in place by the incremental_builder', None),
+    'incremental_fallbacks': ('counter', 'Change sets which fell back to a full rebuild', None),
+    'keys_invalidated': ('counter', 'Entries evicted or recomputed by key level invalidation', None),
+    'snapshots': ('counter', 'Deduplicated snapshots taken', None),
+    'snapshot_new_bytes': ('counter', 'Chunk bytes snapshots had to write, the rest were already stored', None),
+    'access_seconds': ('histogram', 'Sampled lookup latency', SECONDS_BUCKETS),
+    'load_seconds': ('histogram', 'Time spent loading contents', SECONDS_BUCKETS),
+    'build_seconds': ('histogram', 'Time spent building contents', SECONDS_BUCKETS),
+    'incremental_build_seconds': ('histogram', 'Time spent in the incremental_builder applying change sets', SECONDS_BUCKETS),
+    'partition_build_seconds': ('histogram', 'Time spent building each partition of partitioned builds', SECONDS_BUCKETS),
+    'save_seconds': ('histogram', 'Time spent saving, or handing off to an async save', SECONDS_BUCKETS),
+    'fork_seconds': ('histogram', 'Time spent in fork for async saves', SECONDS_BUCKETS),
+    'lock_wait_seconds': ('histogram', 'Time spent waiting on the commit lock of synchronous saves', SECONDS_BUCKETS),
+    'save_bytes': ('histogram', 'Size of saved contents after synchronous saves', BYTES_BUCKETS),
+}
+
+class Histogram(object):
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1) # Last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+    def snapshot(self):
+        return { 'count': self.count, 'sum': self.sum, 'buckets': list(self.cumulative_counts()) }
+
+class CacheMetrics(object):
+    '''
+    Counters and histograms for every cache of a manager, labeled by cache name. Lookups are
+    only measured once every sample_every accesses to keep the hot path cheap.
+    '''
+    def __init__(self, sample_every=64, prefix='cacheman'):
+        self.sample_every = max(int(sample_every), 1)
+        self.prefix = prefix
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = defaultdict(float) # (name, cache_name) -> value
+            self.histograms = {} # (name, cache_name) -> Histogram
+
+    def inc(self, name, cache_name, amount=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[(name, cache_name)] += amount
+
+    def observe(self, name, cache_name, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get((name, cache_name))
+            if histogram is None:
+                buckets = METRIC_DEFINITIONS.get(name, (None, None, None))[2] or SECONDS_BUCKETS
+                histogram = self.histograms[(name, cache_name)] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timed(self, name, cache_name):
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.observe(name, cache_name, default_timer() - start)
+
+    def stats(self):
+        '''
+        Returns { cache_name: { metric: value or histogram snapshot } }.
+        '''
+        stats = defaultdict(dict)
+        with self.lock:
+            for (name, cache_name), value in self.counters.items():
+                stats[cache_name][name] = value
+            for (name, cache_name), histogram in self.histograms.items():
+                stats[cache_name][name] = histogram.snapshot()
+        return dict(stats)
+
+    def _metric_name(self, name, kind):
+        return '_'.join([self.prefix, name, 'total']) if kind == 'counter' else '_'.join([self.prefix, name])
+
+    def prometheus_text(self):
+        '''
+        Renders every metric in the Prometheus text exposition format.
+        '''
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, histogram.snapshot()) for key, histogram in self.histograms.items())
+        by_name = defaultdict(list)
+        for (name, cache_name), value in counters:
+            by_name[('counter', name)].append((cache_name, value))
+        for (name, cache_name), snapshot in histograms:
+            by_name[('histogram', name)].append((cache_name, snapshot))
+
+        lines = []
+        for (kind, name), samples in sorted(by_name.items(), key=lambda item: item[0][1]):
+            metric = self._metric_name(name, kind)
+            lines.append('# HELP {} {}'.format(metric, METRIC_DEFINITIONS.get(name, (None, name))[1]))
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            for cache_name, value in samples:
+                label = 'cache="{}"'.format(_escape_label(cache_name))
+                if kind == 'counter':
+                    lines.append('{}{{{}}} {}'.format(metric, label, _format_value(value)))
+                    continue
+                for bound, count in value['buckets']:
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, label, _format_value(bound), count))
+                lines.append('{}_sum{{{}}} {}'.format(metric, label, _format_value(value['sum'])))
+                lines.append('{}_count{{{}}} {}'.format(metric, label, value['count']))
+        return '\n'.join(lines) + '\n'
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+def write_prometheus_file(metrics, path):
+    '''
+    Atomically writes the metrics for a node exporter textfile collector to scrape.
+    '''
+    tmp_path = '.'.join([path, 'tmp', random_name()])
+    with open(tmp_path, 'w') as metrics_file:
+        metrics_file.write(metrics.prometheus_text())
+    shutil.move(tmp_path, path)
+
+def serve_prometheus(metrics, port=0, host='127.0.0.1'):
+    '''
+    Serves the metrics over http from a daemon thread. Returns the server, whose
+    server_address holds the bound port and whose shutdown() stops it.
+    '''
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='cacheman-metrics')
+    thread.daemon = True
+    thread.start()
+    return server
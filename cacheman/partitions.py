@@ -0,0 +1,70 @@
+import traceback
+import multiprocessing
+from timeit import default_timer
+from six.moves import cPickle
+
+def _build_partition(task):
+    '''
+    Builds one partition, returning (index, contents, seconds, error). Errors come back
+    as formatted tracebacks as not every exception pickles across the pool.
+    '''
+    partition_builder, cache_name, index, partition = task
+    start = default_timer()
+    try:
+        contents, error = partition_builder(cache_name, partition), None
+    except Exception:
+        contents, error = None, traceback.format_exc()
+    return index, contents, default_timer() - start, error
+
+def _picklable(cache_name, partition_builder, partitions):
+    try:
+        cPickle.dumps((partition_builder, partitions), cPickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        print("Warning: building '{}' partitions inline as they can't be sent to a pool - {}".format(
+            cache_name, repr(e)))
+        return False
+    return True
+
+def build_partitions(cache_name, partitions, partition_builder, processes=None, retries=1):
+    '''
+    Builds each partition with partition_builder(cache_name, partition), in a process pool
+    when there's more than one partition and process, streaming each result into contents
+    as it finishes. Partitions which fail are retried on their own up to retries more times.
+    The partition_builder and partitions have to be picklable for the pool, otherwise they
+    build inline, and partitions shouldn't share keys as they merge in the order they finish.
+
+    Returns (contents, report) where report has a dict per partition of its attempts,
+    entries, seconds taken by the last attempt and the error of that attempt, if it failed.
+    '''
+    processes = processes or multiprocessing.cpu_count()
+    contents = {}
+    # Indexed rather than keyed by partition, which needn't be hashable or distinct
+    report = [{ 'partition': partition, 'attempts': 0, 'entries': 0, 'seconds': 0.0, 'error': None }
+              for partition in partitions]
+    pool = None
+    if processes > 1 and len(partitions) > 1 and _picklable(cache_name, partition_builder, partitions):
+        pool = multiprocessing.Pool(min(processes, len(partitions)))
+    try:
+        pending = list(range(len(partitions)))
+        for _ in range(retries + 1):
+            if not pending:
+                break
+            tasks = [(partition_builder, cache_name, index, partitions[index]) for index in pending]
+            results = pool.imap_unordered(_build_partition, tasks) if pool and len(tasks) > 1 else map(_build_partition, tasks)
+            failed = []
+            for index, partition_contents, seconds, error in results:
+                entry = report[index]
+                entry['attempts'] += 1
+                entry['seconds'] = seconds
+                entry['error'] = error
+                if error is None:
+                    entry['entries'] = len(partition_contents)
+                    contents.update(partition_contents)
+                else:
+                    failed.append(index)
+            pending = failed
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return contents, report
@@ -1,14 +1,30 @@
 import pickle
 from six.moves import cPickle
-from six import iteritems
+from six import iteritems, StringIO
 import shutil
 import os
 import sys
 import psutil
+import io
 import csv
+import locale
 import traceback
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
+from timeit import default_timer
+from operator import itemgetter
+from six.moves import zip
 
 from .utils import random_name
+from .coherence import file_signature
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows has no advisory locks, so commits run unlocked
 
 if sys.version_info[0] == 2:
     text_read_mode = 'rU'
@@ -33,6 +49,38 @@ def generate_pickle_path(cache_dir, cache_name):
 def generate_csv_path(cache_dir, cache_name):
     return generate_path(cache_dir, cache_name, 'csv')
 
+def generate_csv_index_path(cache_dir, cache_name):
+    return generate_path(cache_dir, cache_name, 'csv.idx')
+
+def generate_csv_resave_path(cache_dir, cache_name):
+    return generate_path(cache_dir, cache_name, 'csv.resave')
+
+def generate_bloom_path(cache_dir, cache_name):
+    return generate_path(cache_dir, cache_name, 'bloom')
+
+def generate_lock_path(path):
+    return '.'.join([path, 'lock'])
+
+@contextmanager
+def commit_lock(path, metrics=None, cache_name=None):
+    '''
+    Holds an exclusive advisory lock on a sidecar of path while a save commits, recording
+    the time spent waiting for it. Readers never take the lock as commits are atomic moves.
+    '''
+    if fcntl is None:
+        yield
+        return
+    ensure_directory(os.path.dirname(path))
+    start = default_timer()
+    with open(generate_lock_path(path), 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        if metrics:
+            metrics.observe('lock_wait_seconds', cache_name, default_timer() - start)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
 def ensure_directory(dirname):
     if not os.path.exists(dirname):
         try:
@@ -51,13 +99,28 @@ def _exclude_zombie_procs(procs):
             pass
     return alive_procs
 
+def wait_async_saves(cache_name, seen_pids, timeout):
+    '''
+    Waits for any async saves of a cache which are still running.
+    '''
+    children = _exclude_zombie_procs([proc for proc in psutil.Process().children(recursive=False)
+            if proc.pid in seen_pids.get(cache_name, ())])
+    if children:
+        psutil.wait_procs(children, timeout=timeout)
+
 def _tmp_pid_extensions(pid=None):
     extensions = ['tmp', random_name()]
     if pid:
         extensions.append(str(pid))
     return extensions
 
-def fork_content_save(cache_name, contents, presaver, saver, cleaner, timeout, seen_pids):
+def fork_content_save(cache_name, contents, presaver, saver, cleaner, timeout, seen_pids, metrics=None,
+                      kill_previous=True):
+    '''
+    Saves in a forked child, which waits up to timeout for the cache's previous async saves
+    before killing them, as a newer full save supersedes them. Saves which only add to the
+    previous ones, like appends, pass kill_previous=False to wait for them however long.
+    '''
     children = _exclude_zombie_procs([proc for proc in psutil.Process().children(recursive=False)
             if proc.pid in seen_pids[cache_name]])
     cache_pids = set(child.pid for child in children)
@@ -69,19 +132,26 @@ def fork_content_save(cache_name, contents, presaver, saver, cleaner, timeout, s
         if cleaner:
             cleaner(cache_name, _tmp_pid_extensions(pid))
     seen_pids[cache_name] = cache_pids
+    if metrics and terminated_pids:
+        metrics.inc('async_saves_reaped', cache_name, len(terminated_pids))
 
     exts = _tmp_pid_extensions()
+    fork_start = default_timer()
     try:
         fork_pid = os.fork()
     except OSError as e:
         print(("Warning, saving {} synchronously: {} ".format(cache_name, repr(e)) +
             "-- you're out of memory or you might be out of shared memory (check kernel.shmmax)"))
+        if metrics:
+            metrics.inc('async_fork_fallbacks', cache_name)
         if presaver:
             presaver(cache_name, contents, exts)
         saver(cache_name, contents, exts)
         return
     except AttributeError:
         # Windows has no fork... TODO make windows async saver
+        if metrics:
+            metrics.inc('async_fork_fallbacks', cache_name)
         if presaver:
             presaver(cache_name, contents, exts)
         saver(cache_name, contents, exts)
@@ -89,6 +159,9 @@ def fork_content_save(cache_name, contents, presaver, saver, cleaner, timeout, s
 
     if fork_pid != 0:
         cache_pids.add(fork_pid)
+        if metrics:
+            metrics.observe('fork_seconds', cache_name, default_timer() - fork_start)
+            metrics.inc('async_forks', cache_name)
     else:
         try:
             pid = os.getpid()
@@ -101,7 +174,9 @@ def fork_content_save(cache_name, contents, presaver, saver, cleaner, timeout, s
 
             # Refilter our zombies
             children = _exclude_zombie_procs(children)
-            if children:
+            if children and not kill_previous:
+                psutil.wait_procs(children)
+            elif children:
                 gone, alive_and_undead = psutil.wait_procs(children, timeout=timeout)
                 # Avoid killing processes that have since died
                 alive = _exclude_zombie_procs(alive_and_undead)
@@ -118,12 +193,17 @@ def fork_content_save(cache_name, contents, presaver, saver, cleaner, timeout, s
             # Exit aggresively -- we don't want cleanup to occur
             os._exit(0)
 
-def pickle_saver(cache_dir, cache_name, contents):
+def pickle_saver(cache_dir, cache_name, contents, commit=None):
+    '''
+    Pickles contents to a temporary file, then commits it with commit(cache_name, contents,
+    extensions), which defaults to moving it into place.
+    '''
     tmp_exts = ['tmp', random_name()]
+    commit = commit or partial(pickle_mover, cache_dir)
     try:
         try:
             pickle_pre_saver(cache_dir, cache_name, contents, tmp_exts)
-            pickle_mover(cache_dir, cache_name, contents, tmp_exts)
+            commit(cache_name, contents, tmp_exts)
         except (IOError, EOFError):
             traceback.print_exc()
             raise IOError('Unable to save {} cache'.format(cache_name))
@@ -176,12 +256,52 @@ def pickle_loader(cache_dir, cache_name):
         return None
     return contents
 
-def csv_saver(cache_dir, cache_name, contents, row_builder=None):
+def bloom_saver(cache_dir, cache_name, bloom, entries, signature):
+    '''
+    Saves a cache's bloom filter next to its contents, stamped with the number of entries
+    it was built from and the file signature of the saved contents, so a loader can tell
+    when it no longer matches.
+    '''
+    ensure_directory(cache_dir)
+    bloom_path = generate_bloom_path(cache_dir, cache_name)
+    tmp_path = '.'.join([bloom_path, 'tmp', random_name()])
+    try:
+        with open(tmp_path, 'wb') as bloom_file:
+            cPickle.dump({ 'entries': entries, 'signature': signature, 'filter': bloom }, bloom_file,
+                cPickle.HIGHEST_PROTOCOL)
+        shutil.move(tmp_path, bloom_path)
+    except:
+        try: os.remove(tmp_path)
+        except OSError: pass
+        raise
+
+def bloom_loader(cache_dir, cache_name, entries, signature):
+    '''
+    Loads a saved bloom filter, or None if it's missing or was built from a different
+    number of entries or version of the saved contents.
+    '''
+    try:
+        with open(generate_bloom_path(cache_dir, cache_name), 'rb') as bloom_file:
+            saved = cPickle.load(bloom_file)
+    except (IOError, OSError, EOFError):
+        return None
+    if signature is None or saved.get('entries') != entries or saved.get('signature') != signature:
+        return None
+    return saved['filter']
+
+def bloom_deleter(cache_dir, cache_name):
+    try:
+        os.remove(generate_bloom_path(cache_dir, cache_name))
+    except OSError:
+        pass
+
+def csv_saver(cache_dir, cache_name, contents, row_builder=None, index=False, commit=None):
     tmp_exts = ['tmp', random_name()]
+    commit = commit or partial(csv_mover, cache_dir)
     try:
         try:
-            csv_pre_saver(cache_dir, cache_name, contents, tmp_exts, row_builder)
-            csv_mover(cache_dir, cache_name, contents, tmp_exts)
+            csv_pre_saver(cache_dir, cache_name, contents, tmp_exts, row_builder, index)
+            commit(cache_name, contents, tmp_exts)
         except (IOError, EOFError):
             traceback.print_exc()
             raise IOError('Unable to save {} cache'.format(cache_name))
@@ -190,32 +310,440 @@ def csv_saver(cache_dir, cache_name, contents, row_builder=None):
         except: pass
         raise
 
-def csv_pre_saver(cache_dir, cache_name, contents, extensions, row_builder=None):
+def csv_pre_saver(cache_dir, cache_name, contents, extensions, row_builder=None, index=False):
     ensure_directory(cache_dir)
     cache_path = generate_csv_path(cache_dir, cache_name)
+    if index:
+        return _csv_indexed_pre_saver(cache_dir, cache_name, contents, extensions, row_builder)
     with open('.'.join([cache_path] + extensions), text_write_mode) as csv_file:
         writer = csv.writer(csv_file, dialect='excel', quoting=csv.QUOTE_MINIMAL)
         for key, value in iteritems(contents):
             writer.writerow(row_builder(key, value) if row_builder else [key, value])
 
+def _csv_read_key(row, data):
+    '''
+    The key cell of a written row as a load reads it back, only parsing the written data
+    when the cell isn't already a string which survives newline translation.
+    '''
+    cell = row[0]
+    if isinstance(cell, str) and '\r' not in cell:
+        return cell
+    if sys.version_info[0] == 2:
+        # Match the universal newlines of text_read_mode
+        lines = io.BytesIO(data.replace('\r\n', '\n').replace('\r', '\n'))
+    else:
+        lines = io.StringIO(data, newline=None)
+    return next(csv.reader(lines, dialect='excel', quoting=csv.QUOTE_MINIMAL))[0]
+
+def _csv_indexed_pre_saver(cache_dir, cache_name, contents, extensions, row_builder=None):
+    '''
+    Writes rows one at a time through a buffer so the byte offset of each key is known,
+    then writes the offsets to a sidecar index next to the temporary csv file. Offsets are
+    keyed by the key cell as a load would read it, and the index is stamped with the file
+    signature of the csv, which moving it into place keeps.
+    '''
+    buf = StringIO()
+    writer = csv.writer(buf, dialect='excel', quoting=csv.QUOTE_MINIMAL)
+    encoding = locale.getpreferredencoding(False)
+    offsets = {}
+    offset = 0
+    tmp_path = '.'.join([generate_csv_path(cache_dir, cache_name)] + extensions)
+    with open(tmp_path, 'wb') as csv_file:
+        for key, value in iteritems(contents):
+            row = row_builder(key, value) if row_builder else [key, value]
+            writer.writerow(row)
+            data = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            offsets[_csv_read_key(row, data)] = offset
+            if not isinstance(data, bytes):
+                data = data.encode(encoding)
+            csv_file.write(data)
+            offset += len(data)
+
+    index_path = generate_csv_index_path(cache_dir, cache_name)
+    with open('.'.join([index_path] + extensions), 'wb') as index_file:
+        cPickle.dump({ 'signature': file_signature(tmp_path), 'offsets': offsets }, index_file,
+            cPickle.HIGHEST_PROTOCOL)
+
+def csv_index_loader(cache_dir, cache_name):
+    '''
+    Loads the key cell to byte offset index of a csv cache, or None if it's missing or the
+    csv file was replaced or modified since the index was written.
+    '''
+    signature = file_signature(generate_csv_path(cache_dir, cache_name))
+    try:
+        with open(generate_csv_index_path(cache_dir, cache_name), 'rb') as index_file:
+            index = cPickle.load(index_file)
+    except (IOError, OSError, EOFError):
+        return None
+    if signature is None or index.get('signature') != signature:
+        return None
+    return index['offsets']
+
+def csv_index_deleter(cache_dir, cache_name):
+    try:
+        os.remove(generate_csv_index_path(cache_dir, cache_name))
+    except OSError:
+        pass
+
+def csv_rows_pre_saver(cache_dir, cache_name, rows, extensions):
+    '''
+    Writes already built rows to a temporary csv file for csv_appender.
+    '''
+    ensure_directory(cache_dir)
+    cache_path = generate_csv_path(cache_dir, cache_name)
+    with open('.'.join([cache_path] + extensions), text_write_mode) as csv_file:
+        writer = csv.writer(csv_file, dialect='excel', quoting=csv.QUOTE_MINIMAL)
+        writer.writerows(rows)
+
+def csv_appender(cache_dir, cache_name, rows, extensions):
+    '''
+    Appends a temporary csv file onto the end of the cache's csv file.
+    '''
+    cache_path = generate_csv_path(cache_dir, cache_name)
+    tmp_path = '.'.join([cache_path] + extensions)
+    with open(tmp_path, 'rb') as tmp_file:
+        with open(cache_path, 'ab') as csv_file:
+            shutil.copyfileobj(tmp_file, csv_file)
+    os.remove(tmp_path)
+    csv_index_deleter(cache_dir, cache_name) # Offsets don't cover appended rows
+
+def csv_append_saver(cache_dir, cache_name, rows, commit=None):
+    tmp_exts = ['tmp', random_name()]
+    commit = commit or partial(csv_appender, cache_dir)
+    try:
+        try:
+            csv_rows_pre_saver(cache_dir, cache_name, rows, tmp_exts)
+            commit(cache_name, rows, tmp_exts)
+        except (IOError, EOFError):
+            traceback.print_exc()
+            raise IOError('Unable to append to {} cache'.format(cache_name))
+    except:
+        try: csv_cleaner(cache_dir, cache_name, tmp_exts)
+        except: pass
+        raise
+
+def csv_record_boundaries(path, parts, block_size=1 << 20):
+    '''
+    Splits a csv file into at most parts byte ranges which start and end on record boundaries.
+    A newline only ends a record when an even number of quote characters precede it, so
+    quoted newlines never split a record ('""' escapes keep the parity intact).
+    '''
+    size = os.path.getsize(path)
+    targets = deque(size * part // parts for part in range(1, parts))
+    boundaries = [0]
+    quotes = 0 # Parity of quote characters before the scan position
+    offset = 0
+    with open(path, 'rb') as csv_file:
+        while targets:
+            block = csv_file.read(block_size)
+            if not block:
+                break
+            pos = 0
+            end = len(block)
+            while targets and pos < end:
+                target = targets[0] - offset
+                if target > pos:
+                    skip = min(target, end)
+                    quotes ^= block.count(b'"', pos, skip) & 1
+                    pos = skip
+                    continue
+                newline = block.find(b'\n', pos)
+                if newline < 0:
+                    quotes ^= block.count(b'"', pos) & 1
+                    pos = end
+                    break
+                quotes ^= block.count(b'"', pos, newline) & 1
+                pos = newline + 1
+                if not quotes:
+                    boundary = offset + pos
+                    if boundary < size:
+                        boundaries.append(boundary)
+                    while targets and targets[0] < boundary:
+                        targets.popleft()
+            offset += end
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def _csv_range_reader(path, start, end):
+    with open(path, 'rb') as csv_file:
+        csv_file.seek(start)
+        data = csv_file.read(end - start)
+    if sys.version_info[0] == 2:
+        lines = io.BytesIO(data)
+    else:
+        # Decode and translate newlines the same way text_read_mode does for csv_loader
+        lines = io.StringIO(data.decode(locale.getpreferredencoding(False)), newline=None)
+    return csv.reader(lines, dialect='excel', quoting=csv.QUOTE_MINIMAL)
+
+def _csv_parse_range(task):
+    '''
+    Parses one byte range, returning (contents, keys deleted by the range, row count).
+    '''
+    path, start, end, row_reader, schema, chunk_size, deletes = task
+    reader = _csv_range_reader(path, start, end)
+    contents = {}
+    deleted = set()
+    row_count = 0
+    if schema:
+        parsers = csv_column_parsers(schema)
+        while True:
+            chunk = list(islice(reader, chunk_size))
+            if not chunk:
+                break
+            rows = list(filter(None, chunk))
+            if rows:
+                row_count += len(rows)
+                _apply_typed_chunk(contents, rows, parsers, row_reader, deleted, deletes)
+    else:
+        for row in reader:
+            if not row:
+                continue
+            row_count += 1
+            if deletes and row[0] == CSV_DELETE_MARKER:
+                key, _ = row_reader(row[1:]) if row_reader else (row[1], row[2])
+                contents.pop(key, None)
+                deleted.add(key)
+                continue
+            key, val = row_reader(row) if row_reader else (row[0], row[1])
+            contents[key] = val
+            if deleted:
+                deleted.discard(key)
+    return contents, deleted, row_count
+
+def csv_parallel_loader(cache_dir, cache_name, row_reader=None, schema=None, processes=None,
+                        chunk_size=10000, stats=None, min_range_size=1 << 20, deletes=False):
+    '''
+    Loads a csv cache by parsing record aligned byte ranges in a process pool, then merging
+    the partial contents in file order. Gives the same result as csv_loader, or
+    csv_typed_loader when a schema is given. The row_reader has to be picklable.
+    '''
+    path = generate_csv_path(cache_dir, cache_name)
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return None
+
+    processes = processes or multiprocessing.cpu_count()
+    parts = max(1, min(processes, size // max(min_range_size, 1)))
+    tasks = [(path, start, end, row_reader, schema, chunk_size, deletes)
+             for start, end in csv_record_boundaries(path, parts)]
+    if len(tasks) > 1:
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        try:
+            results = pool.map(_csv_parse_range, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_csv_parse_range(task) for task in tasks]
+
+    contents = {}
+    row_count = 0
+    for part_contents, deleted, part_rows in results:
+        for key in deleted:
+            contents.pop(key, None)
+        contents.update(part_contents)
+        row_count += part_rows
+    if stats is not None:
+        stats['rows'] = row_count
+    return contents
+
 def csv_mover(cache_dir, cache_name, contents, extensions):
     cache_path = generate_csv_path(cache_dir, cache_name)
     shutil.move('.'.join([cache_path] + extensions), cache_path)
 
+    index_path = generate_csv_index_path(cache_dir, cache_name)
+    tmp_index_path = '.'.join([index_path] + extensions)
+    if os.path.isfile(tmp_index_path):
+        shutil.move(tmp_index_path, index_path)
+    else:
+        csv_index_deleter(cache_dir, cache_name) # Don't leave an index for the old file around
+
 def csv_cleaner(cache_dir, cache_name, extensions):
-    cache_path = generate_csv_path(cache_dir, cache_name)
-    try: os.remove('.'.join([cache_path] + extensions))
-    except OSError: pass
+    for path in [generate_csv_path(cache_dir, cache_name), generate_csv_index_path(cache_dir, cache_name)]:
+        try: os.remove('.'.join([path] + extensions))
+        except OSError: pass
+
+# First cell of incremental csv rows which delete the key of the rest of the row
+CSV_DELETE_MARKER = '__cacheman_deleted__'
+
+def parse_bool(cell):
+    lowered = cell.strip().lower()
+    if lowered in ('true', 't', 'yes', 'y', '1'):
+        return True
+    if lowered in ('false', 'f', 'no', 'n', '0', ''):
+        return False
+    raise ValueError("Unable to parse '{}' as a bool".format(cell))
 
-def csv_loader(cache_dir, cache_name, row_reader=None):
+CSV_COLUMN_PARSERS = {
+    'int': int,
+    'float': float,
+    'bool': parse_bool,
+    'str': None
+}
+
+def csv_column_parsers(schema):
+    '''
+    Converts a schema of type names ('int', 'float', 'bool', 'str'), types or callables
+    into per-column parsers, where None means the column stays a string.
+    '''
+    parsers = []
+    for column in schema:
+        if column in CSV_COLUMN_PARSERS:
+            parsers.append(CSV_COLUMN_PARSERS[column])
+        elif column is bool:
+            parsers.append(parse_bool) # bool('False') is True
+        elif column is str:
+            parsers.append(None)
+        elif callable(column):
+            parsers.append(column)
+        else:
+            raise ValueError("Unknown csv column type '{}'".format(column))
+    return parsers
+
+def _csv_typed_columns(rows, parsers):
+    '''
+    Converts a chunk of rows column by column, so cells are extracted and parsed through
+    map instead of per cell Python calls.
+    '''
+    rows = list(filter(None, rows))
+    if not rows:
+        return []
+    if len(set(map(len, rows))) != 1 or len(rows[0]) != len(parsers):
+        raise ValueError('Csv rows do not match the {} column schema'.format(len(parsers)))
+    columns = []
+    for index, parser in enumerate(parsers):
+        column = map(itemgetter(index), rows)
+        columns.append(list(column if parser is None else map(parser, column)))
+    return columns
+
+def _csv_raw_chunks(cache_dir, cache_name, chunk_size):
+    try:
+        csv_file = open(generate_csv_path(cache_dir, cache_name), text_read_mode)
+    except IOError:
+        return
+    with csv_file:
+        reader = csv.reader(csv_file, dialect='excel', quoting=csv.QUOTE_MINIMAL)
+        while True:
+            chunk = list(islice(reader, chunk_size))
+            if not chunk:
+                break
+            yield chunk
+
+def csv_chunk_stream(cache_dir, cache_name, schema, chunk_size=10000):
+    '''
+    Yields lists of typed column values for each chunk of up to chunk_size csv rows.
+    '''
+    parsers = csv_column_parsers(schema)
+    for chunk in _csv_raw_chunks(cache_dir, cache_name, chunk_size):
+        columns = _csv_typed_columns(chunk, parsers)
+        if columns:
+            yield columns
+
+def csv_row_stream(cache_dir, cache_name, schema=None, chunk_size=10000):
+    '''
+    Yields row tuples from a csv cache without building the contents in memory, typed
+    by the schema when one is given.
+    '''
+    if schema is None:
+        for chunk in _csv_raw_chunks(cache_dir, cache_name, chunk_size):
+            for row in chunk:
+                if row:
+                    yield tuple(row)
+        return
+    for columns in csv_chunk_stream(cache_dir, cache_name, schema, chunk_size):
+        for row in zip(*columns):
+            yield row
+
+def csv_expanded_row_builder(key, value):
+    '''
+    Writes tuple values out as separate columns, mirroring csv_typed_loader on wide schemas.
+    '''
+    return [key] + list(value)
+
+def _typed_items(columns, row_reader=None):
+    if row_reader:
+        return (row_reader(row) for row in zip(*columns))
+    elif len(columns) == 2:
+        return zip(columns[0], columns[1])
+    return zip(columns[0], zip(*columns[1:]))
+
+def _update_contents(contents, items, deleted=None):
+    if deleted:
+        items = list(items)
+        deleted.difference_update(key for key, _ in items)
+    contents.update(items)
+
+def _apply_typed_chunk(contents, rows, parsers, row_reader=None, deleted=None, deletes=True):
+    '''
+    Applies typed rows to contents in order. Keys removed by delete markers are added to
+    the deleted set when one is given, and dropped from it again if a later row sets them.
+    Delete markers are plain keys unless deletes is set.
+    '''
+    if not deletes or CSV_DELETE_MARKER not in map(itemgetter(0), rows):
+        _update_contents(contents, _typed_items(_csv_typed_columns(rows, parsers), row_reader), deleted)
+        return
+
+    # Apply runs of rows between delete markers in order, so later rows still win
+    segment = []
+    for row in rows:
+        if row[0] != CSV_DELETE_MARKER:
+            segment.append(row)
+            continue
+        if segment:
+            _update_contents(contents, _typed_items(_csv_typed_columns(segment, parsers), row_reader), deleted)
+            segment = []
+        for key, _ in _typed_items(_csv_typed_columns([row[1:]], parsers), row_reader):
+            contents.pop(key, None)
+            if deleted is not None:
+                deleted.add(key)
+    if segment:
+        _update_contents(contents, _typed_items(_csv_typed_columns(segment, parsers), row_reader), deleted)
+
+def csv_typed_loader(cache_dir, cache_name, schema, row_reader=None, chunk_size=10000, stats=None,
+                     deletes=False):
+    '''
+    Loads a csv cache with typed columns. The first column is the key and the value is the
+    second column, or a tuple of the remaining columns for wider schemas. A row_reader is
+    applied to each typed row instead when given, and deletes is as for csv_loader.
+    '''
+    if not os.path.isfile(generate_csv_path(cache_dir, cache_name)):
+        return None
+    parsers = csv_column_parsers(schema)
+    contents = {}
+    row_count = 0
+    for chunk in _csv_raw_chunks(cache_dir, cache_name, chunk_size):
+        rows = list(filter(None, chunk))
+        if rows:
+            row_count += len(rows)
+            _apply_typed_chunk(contents, rows, parsers, row_reader, deletes=deletes)
+    if stats is not None:
+        stats['rows'] = row_count
+    return contents
+
+def csv_loader(cache_dir, cache_name, row_reader=None, stats=None, deletes=False):
+    '''
+    Loads a csv cache where later rows win. With deletes set, as for incremental csvs, rows
+    starting with CSV_DELETE_MARKER remove the key of the row which follows the marker.
+    '''
     contents = {}
+    row_count = 0
     try:
         with open(generate_csv_path(cache_dir, cache_name), text_read_mode) as csv_file:
             reader = csv.reader(csv_file, dialect='excel', quoting=csv.QUOTE_MINIMAL)
             for row in reader:
                 if row:
+                    row_count += 1
+                    if deletes and row[0] == CSV_DELETE_MARKER:
+                        key, _ = row_reader(row[1:]) if row_reader else (row[1], row[2])
+                        contents.pop(key, None)
+                        continue
                     key, val = row_reader(row) if row_reader else (row[0], row[1])
                     contents[key] = val
     except (IOError, EOFError):
         return None
+    if stats is not None:
+        stats['rows'] = row_count
     return contents
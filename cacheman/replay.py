@@ -0,0 +1,292 @@
+'''
+Replays timestamped traces of reads, writes and deletes against autosync caches on a virtual
+clock, reporting how often each persistence policy saves and how much data it puts at risk.
+
+    python -m cacheman.replay --synthetic 3600 --time-checks 60:10000,300:10,900:1 --time-checks 30:1
+    python -m cacheman.replay --trace writes.jsonl --csv --time-checks 60:100
+
+Trace files hold one JSON object per line: {"t": seconds, "op": "get|set|delete", "key": ..., "value": ...}.
+'''
+from __future__ import print_function
+
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import psutil
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from timeit import default_timer
+
+from . import autosync
+from .cacher import CacheManager
+from .autosync import AutoSyncCache, TimeCount
+
+TraceEvent = namedtuple('TraceEvent', ['time', 'op', 'key', 'value'])
+TRACE_OPS = ('get', 'set', 'delete')
+
+class VirtualClock(object):
+    '''
+    Stands in for datetime inside autosync, only moving when advanced.
+    '''
+    def __init__(self, start=None):
+        self.start = start or datetime(2000, 1, 1)
+        self.current = self.start
+
+    def now(self):
+        return self.current
+
+    def seconds(self):
+        return (self.current - self.start).total_seconds()
+
+    def advance_to(self, seconds):
+        current = self.start + timedelta(seconds=seconds)
+        if current > self.current:
+            self.current = current
+
+@contextmanager
+def virtual_clock(clock):
+    original, autosync.datetime = autosync.datetime, clock
+    try:
+        yield clock
+    finally:
+        autosync.datetime = original
+
+def load_trace(path):
+    '''
+    Reads a JSON lines trace, with times made relative to the first event.
+    '''
+    start = None
+    with open(path) as trace_file:
+        for line in trace_file:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if event['op'] not in TRACE_OPS:
+                raise ValueError("Unknown trace op '{}', expected one of {}".format(event['op'], TRACE_OPS))
+            start = event['t'] if start is None else start
+            yield TraceEvent(event['t'] - start, event['op'], event['key'], event.get('value'))
+
+def synthetic_trace(duration, writes_per_second=10.0, reads_per_second=50.0, key_space=10000,
+                    delete_fraction=0.05, burst_every=None, burst_writes=1000, seed=0):
+    '''
+    Generates a Poisson arrival trace of reads and writes over duration seconds, optionally
+    with a burst of burst_writes every burst_every seconds.
+    '''
+    rng = random.Random(seed)
+    events = []
+    for op, rate in [('set', writes_per_second), ('get', reads_per_second)]:
+        t = rng.expovariate(rate) if rate else duration
+        while t < duration:
+            key = rng.randrange(key_space)
+            if op == 'set' and rng.random() < delete_fraction:
+                events.append(TraceEvent(t, 'delete', key, None))
+            else:
+                events.append(TraceEvent(t, op, key, rng.random() if op == 'set' else None))
+            t += rng.expovariate(rate)
+    if burst_every:
+        burst_time = burst_every
+        while burst_time < duration:
+            for i in range(burst_writes):
+                events.append(TraceEvent(burst_time + i * 1e-4, 'set', rng.randrange(key_space), rng.random()))
+            burst_time += burst_every
+    events.sort(key=lambda event: event.time)
+    return events
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def _written_bytes(process):
+    try:
+        return process.io_counters().write_chars
+    except (AttributeError, psutil.Error):
+        return None
+
+class ReplayRecorder(object):
+    def __init__(self, cache, clock):
+        self.cache = cache
+        self.clock = clock
+        self.process = psutil.Process()
+        self.save_times = []
+        self.save_seconds = []
+        self.bytes_written = 0
+        self.unsaved_since = None # Virtual time of the oldest write not yet saved
+        self.loss_windows = []
+        original_save = cache.save
+        def recorded_save(*args, **kwargs):
+            written = _written_bytes(self.process)
+            start = default_timer()
+            result = original_save(*args, **kwargs)
+            self.save_seconds.append(default_timer() - start)
+            after = _written_bytes(self.process)
+            if written is not None and after is not None:
+                self.bytes_written += after - written
+            else:
+                self.bytes_written += cache.saved_size() or 0
+            self.saved()
+            return result
+        cache.save = recorded_save
+
+    def wrote(self):
+        if self.unsaved_since is None:
+            self.unsaved_since = self.clock.seconds()
+
+    def saved(self):
+        now = self.clock.seconds()
+        self.save_times.append(now)
+        if self.unsaved_since is not None:
+            self.loss_windows.append(now - self.unsaved_since)
+            self.unsaved_since = None
+
+def replay(trace, cache_factory, scheduler_interval=1.0):
+    '''
+    Replays trace against the cache built by cache_factory(manager, name) and returns a report.
+    Saves are made synchronous so their cost is attributed to the write which triggered them,
+    and background_sync caches are checked every scheduler_interval virtual seconds.
+    '''
+    base_dir = tempfile.mkdtemp(prefix='cacheman_replay')
+    clock = VirtualClock()
+    manager = CacheManager('replay', base_dir)
+    manager.autosync_scheduler.stop()
+    reads = writes = deletes = misses = 0
+    latencies = []
+    try:
+        with virtual_clock(clock):
+            cache = cache_factory(manager, 'replay')
+            manager.autosync_scheduler.stop()
+            cache.async = False
+            recorder = ReplayRecorder(cache, clock)
+            background = getattr(cache, 'background_sync', False)
+            next_check = scheduler_interval
+            last_time = 0.0
+
+            for event in trace:
+                while background and next_check <= event.time:
+                    clock.advance_to(next_check)
+                    cache.check_save_conditions()
+                    next_check += scheduler_interval
+                clock.advance_to(event.time)
+                last_time = event.time
+                if event.op == 'get':
+                    reads += 1
+                    try:
+                        cache[event.key]
+                    except KeyError:
+                        misses += 1
+                    continue
+
+                start = default_timer()
+                if event.op == 'set':
+                    writes += 1
+                    recorder.wrote()
+                    cache[event.key] = event.value
+                else:
+                    deletes += 1
+                    if event.key in cache:
+                        recorder.wrote()
+                    cache.pop(event.key, None)
+                latencies.append(default_timer() - start)
+
+            unsaved_window = last_time - recorder.unsaved_since if recorder.unsaved_since is not None else 0.0
+        # Drop the cache without its final save, which a crash wouldn't get either
+        cache.delete_triggered = True
+        manager.cache_by_name.clear()
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+    latencies.sort()
+    loss_windows = recorder.loss_windows + ([unsaved_window] if recorder.unsaved_since is not None else [])
+    return {
+        'duration': last_time,
+        'reads': reads,
+        'read_misses': misses,
+        'writes': writes,
+        'deletes': deletes,
+        'saves': len(recorder.save_times),
+        'bytes_written': recorder.bytes_written,
+        'save_seconds': sum(recorder.save_seconds),
+        'worst_loss_window': max(loss_windows) if loss_windows else 0.0,
+        'mean_loss_window': sum(loss_windows) / len(loss_windows) if loss_windows else 0.0,
+        'unsaved_at_end': recorder.unsaved_since is not None,
+        'write_latency_p50': _percentile(latencies, 0.5),
+        'write_latency_p99': _percentile(latencies, 0.99),
+        'write_latency_max': latencies[-1] if latencies else 0.0,
+    }
+
+def compare_policies(trace, factories, scheduler_interval=1.0):
+    '''
+    Replays the same trace against each named cache factory, returning { name: report }.
+    '''
+    trace = list(trace)
+    return dict((name, replay(trace, factory, scheduler_interval)) for name, factory in factories.items())
+
+REPORT_FIELDS = ['saves', 'bytes_written', 'save_seconds', 'worst_loss_window', 'mean_loss_window',
+                 'write_latency_p50', 'write_latency_p99', 'write_latency_max']
+
+def format_reports(reports):
+    names = sorted(reports)
+    width = max([len(name) for name in names] + [14])
+    lines = [' '.join(['{:<20}'.format('')] + ['{:>{}}'.format(name, width) for name in names])]
+    for field in REPORT_FIELDS:
+        lines.append(' '.join(['{:<20}'.format(field)] +
+            ['{:>{}.6g}'.format(reports[name][field], width) for name in names]))
+    return '\n'.join(lines)
+
+def parse_time_checks(spec):
+    '''
+    Parses 'seconds:count,seconds:count' into TimeCounts.
+    '''
+    checks = []
+    for part in spec.split(','):
+        seconds, count = part.split(':')
+        checks.append(TimeCount(int(seconds), int(count)))
+    return checks
+
+def time_checks_factory(time_checks, time_bucket_size=None, csv=False, **kwargs):
+    def factory(manager, name):
+        if csv:
+            from .csvcache import AutoSyncCSVCache # Import here to avoid circular import
+            cache_class = AutoSyncCSVCache
+        else:
+            cache_class = AutoSyncCache
+        return cache_class(name, cache_manager=manager, contents={}, time_checks=time_checks,
+            time_bucket_size=time_bucket_size, **kwargs)
+    return factory
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--trace', help='JSON lines trace file')
+    source.add_argument('--synthetic', type=float, metavar='SECONDS', help='generate a synthetic trace')
+    parser.add_argument('--writes-per-second', type=float, default=10.0)
+    parser.add_argument('--reads-per-second', type=float, default=50.0)
+    parser.add_argument('--key-space', type=int, default=10000)
+    parser.add_argument('--burst-every', type=float)
+    parser.add_argument('--time-checks', action='append', required=True,
+        help='a policy as seconds:count pairs, repeat to compare policies')
+    parser.add_argument('--time-bucket-size', type=int)
+    parser.add_argument('--background-sync', action='store_true')
+    parser.add_argument('--csv', action='store_true', help='replay against AutoSyncCSVCache')
+    parser.add_argument('--incremental', action='store_true', help='incremental csv appends')
+    args = parser.parse_args(argv)
+    if args.incremental and not args.csv:
+        parser.error('--incremental requires --csv')
+
+    if args.trace:
+        trace = list(load_trace(args.trace))
+    else:
+        trace = synthetic_trace(args.synthetic, args.writes_per_second, args.reads_per_second,
+            args.key_space, burst_every=args.burst_every)
+    extra = { 'background_sync': args.background_sync }
+    if args.incremental:
+        extra['incremental'] = True
+    factories = dict((spec, time_checks_factory(parse_time_checks(spec), args.time_bucket_size, args.csv, **extra))
+        for spec in args.time_checks)
+    print(format_reports(compare_policies(trace, factories)))
+
+if __name__ == '__main__':
+    main()
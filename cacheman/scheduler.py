@@ -0,0 +1,65 @@
+import threading
+import weakref
+
+class AutoSyncScheduler(object):
+    '''
+    A manager-wide daemon thread which periodically checks the time windows of every
+    registered autosync cache and triggers any saves outside of the write path.
+    '''
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.caches = {} # Weak references by cache name, the manager owns the caches
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def register(self, cache):
+        with self.lock:
+            self.caches[cache.name] = weakref.ref(cache)
+        self.start()
+
+    def deregister(self, cache_name):
+        with self.lock:
+            self.caches.pop(cache_name, None)
+
+    def registered_caches(self):
+        with self.lock:
+            refs = list(self.caches.values())
+        return [cache for cache in (ref() for ref in refs) if cache is not None]
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        with self.lock:
+            if self.running():
+                return
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, name='cacheman-autosync')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self, wait=True):
+        self.stop_event.set()
+        thread = self.thread
+        if wait and thread is not None and thread is not threading.current_thread():
+            thread.join(self.interval * 2)
+        self.thread = None
+
+    def check_caches(self):
+        '''
+        Checks every registered cache once, returning the names of the caches which saved.
+        '''
+        saved = []
+        for cache in self.registered_caches():
+            try:
+                if cache.check_save_conditions():
+                    saved.append(cache.name)
+            except Exception as e:
+                # The cache keeps save_failed set, so the next check retries the save
+                print("Warning: ignored error in '{}' autosync scheduler - {}".format(cache.name, repr(e)))
+        return saved
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.check_caches()
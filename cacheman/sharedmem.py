@@ -0,0 +1,263 @@
+import os
+import mmap
+import json
+import struct
+import pickle
+import shutil
+import hashlib
+from collections import MutableMapping
+
+from .registers import *
+from .bloom import stable_key_bytes
+from .cachewrap import PersistentCache
+from .utils import random_name
+
+SEGMENT_MAGIC = b'CMSH'
+HEADER = struct.Struct('<4sIQQ') # magic, version, slot count, entry count
+SLOT = struct.Struct('<QQII') # key hash, record offset, key length, value length
+
+def generate_generation_path(cache_dir, cache_name):
+    return generate_path(cache_dir, cache_name, 'shm')
+
+def generate_segment_path(cache_dir, cache_name, generation):
+    return generate_path(cache_dir, cache_name, 'seg{}'.format(generation))
+
+def key_hash(key):
+    '''
+    A 64 bit hash which agrees across processes, with 0 reserved for empty slots.
+    '''
+    digest = hashlib.md5(stable_key_bytes(key)).digest()
+    return struct.unpack('<Q', digest[:8])[0] or 1
+
+def _attach_segment(segment_path):
+    '''
+    Maps a segment file read-only. Every process mapping the same file shares its pages in
+    the OS page cache, and a mapping stays valid after the file is unlinked.
+    '''
+    with open(segment_path, 'rb') as segment_file:
+        return mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def read_generation(cache_dir, cache_name):
+    '''
+    Returns the published { 'generation', 'segment', 'entries' } record, or None.
+    The segment is the path of the generation's segment file.
+    '''
+    try:
+        with open(generate_generation_path(cache_dir, cache_name)) as generation_file:
+            return json.load(generation_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+def publish_shared(cache_dir, cache_name, contents):
+    '''
+    Serializes contents into a new segment file with an open addressing hash index, then
+    points the generation file at it. Processes still mapping the previous generation keep
+    it until they reload; its file is unlinked so new readers only find the new one.
+    '''
+    records = []
+    for key, value in iteritems(contents):
+        records.append((key_hash(key), pickle.dumps(key, pickle.HIGHEST_PROTOCOL),
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+    slot_count = 8
+    while slot_count < 2 * len(records):
+        slot_count *= 2
+    data_offset = HEADER.size + slot_count * SLOT.size
+    size = data_offset + sum(len(key) + len(value) for _, key, value in records)
+
+    buf = bytearray(size)
+    HEADER.pack_into(buf, 0, SEGMENT_MAGIC, 1, slot_count, len(records))
+    offset = data_offset
+    mask = slot_count - 1
+    for hashed, key, value in records:
+        slot = hashed & mask
+        while SLOT.unpack_from(buf, HEADER.size + slot * SLOT.size)[0]:
+            slot = (slot + 1) & mask
+        SLOT.pack_into(buf, HEADER.size + slot * SLOT.size, hashed, offset, len(key), len(value))
+        buf[offset:offset + len(key)] = key
+        offset += len(key)
+        buf[offset:offset + len(value)] = value
+        offset += len(value)
+
+    ensure_directory(cache_dir)
+    previous = read_generation(cache_dir, cache_name)
+    generation = previous['generation'] + 1 if previous else 1
+    segment_path = generate_segment_path(cache_dir, cache_name, generation)
+    tmp_path = '.'.join([segment_path, 'tmp', random_name()])
+    with open(tmp_path, 'wb') as segment_file:
+        segment_file.write(buf)
+    # Replaces any segment left behind by a publisher which died before updating the generation file
+    shutil.move(tmp_path, segment_path)
+
+    generation_path = generate_generation_path(cache_dir, cache_name)
+    tmp_path = '.'.join([generation_path, 'tmp', random_name()])
+    with open(tmp_path, 'w') as generation_file:
+        json.dump({ 'generation': generation, 'segment': segment_path, 'entries': len(records) }, generation_file)
+    shutil.move(tmp_path, generation_path)
+    if previous:
+        unlink_segment(previous['segment'])
+    return generation
+
+def unlink_segment(segment_path):
+    try:
+        os.remove(segment_path)
+    except OSError:
+        pass
+
+def unpublish_shared(cache_dir, cache_name):
+    published = read_generation(cache_dir, cache_name)
+    try:
+        os.remove(generate_generation_path(cache_dir, cache_name))
+    except OSError:
+        pass
+    if published:
+        unlink_segment(published['segment'])
+
+class SharedContents(MutableMapping):
+    '''
+    A read-only mapping over a published segment. Lookups hash the key, probe the index in
+    place and only unpickle the matching record, so no process holds a private copy of the
+    contents.
+    '''
+    def __init__(self, segment_path, generation=None):
+        self.segment_path = segment_path
+        self.generation = generation
+        self.buf = _attach_segment(segment_path)
+        try:
+            magic, _, self.slot_count, self.entry_count = HEADER.unpack_from(self.buf, 0)
+        except struct.error:
+            magic = None
+        if magic != SEGMENT_MAGIC:
+            self.close()
+            raise ValueError("'{}' isn't a cache segment".format(segment_path))
+
+    def _find(self, key):
+        hashed = key_hash(key)
+        mask = self.slot_count - 1
+        slot = hashed & mask
+        buf = self.buf
+        while True:
+            slot_hash, offset, key_length, value_length = SLOT.unpack_from(buf, HEADER.size + slot * SLOT.size)
+            if not slot_hash:
+                raise KeyError(key)
+            if slot_hash == hashed:
+                stored_key = pickle.loads(buf[offset:offset + key_length])
+                if stored_key == key:
+                    return offset + key_length, value_length
+            slot = (slot + 1) & mask
+
+    def _slots(self):
+        for slot in range(self.slot_count):
+            entry = SLOT.unpack_from(self.buf, HEADER.size + slot * SLOT.size)
+            if entry[0]:
+                yield entry
+
+    def __getitem__(self, key):
+        offset, length = self._find(key)
+        return pickle.loads(self.buf[offset:offset + length])
+
+    def __contains__(self, key):
+        try:
+            self._find(key)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for _, offset, key_length, _ in self._slots():
+            yield pickle.loads(self.buf[offset:offset + key_length])
+
+    def __len__(self):
+        return self.entry_count
+
+    def __setitem__(self, key, value):
+        raise TypeError("Shared contents are read-only, publish a new generation instead")
+
+    def __delitem__(self, key):
+        raise TypeError("Shared contents are read-only, publish a new generation instead")
+
+    def __reduce__(self):
+        # Pickles as a plain dict so savers persist the contents rather than the mapping
+        return (dict, (dict(iteritems(self)),))
+
+    def close(self):
+        if self.buf is not None:
+            self.buf.close()
+            self.buf = None
+
+class SharedMemoryCache(PersistentCache):
+    '''
+    Serves contents from a segment file which every process on the machine memory maps, so
+    they share one copy in the page cache instead of each process unpickling its own. The pickle file stays the durable copy:
+    loading attaches to the current generation, or loads the pickle and publishes it when no
+    generation exists yet, and every save publishes a new generation.
+
+    Contents are read-only, so edits are made by saving a new mapping through publish() or by
+    rebuilding. Other processes move to a new generation through refresh().
+    '''
+    def __init__(self, cache_name, **kwargs):
+        PersistentCache.__init__(self, cache_name, **kwargs)
+
+    def _attach(self, name):
+        published = read_generation(self.manager.cache_directory, name)
+        if not published:
+            return None
+        try:
+            return SharedContents(published['segment'], published['generation'])
+        except (IOError, OSError, ValueError):
+            return None # Unlinked, such as after a reboot
+
+    def loader(self, name):
+        contents = self._attach(name)
+        if contents is None:
+            contents = self._manager_pickle_loader(name)
+            if contents is not None:
+                publish_shared(self.manager.cache_directory, name, contents)
+                contents = self._attach(name)
+        return contents
+
+    def saver(self, name, contents):
+        published = read_generation(self.manager.cache_directory, name)
+        if isinstance(contents, SharedContents) and published and published['generation'] == contents.generation:
+            return # Already published and saved
+        self._manager_pickle_saver(name, contents)
+        publish_shared(self.manager.cache_directory, name, contents)
+        self._swap_contents(self._attach(name))
+
+    def async_saver(self, name, contents, extensions):
+        self._manager_pickle_async_mover(name, contents, extensions)
+        publish_shared(self.manager.cache_directory, name, contents)
+
+    def deleter(self, name):
+        self._manager_pickle_deleter(name)
+        unpublish_shared(self.manager.cache_directory, name)
+
+    def _swap_contents(self, contents):
+        # The previous generation stays mapped until collected, as other threads may still
+        # be reading through it
+        if contents is not None and contents is not self.contents:
+            self.contents = contents
+
+    def generation(self):
+        return self.contents.generation if isinstance(self.contents, SharedContents) else None
+
+    def publish(self, contents):
+        '''
+        Saves and publishes contents as a new generation, then serves from it.
+        '''
+        self.contents = contents
+        self.save()
+        return self.generation()
+
+    def refresh(self):
+        '''
+        Moves to the latest published generation if another process published one.
+        Returns True if contents changed.
+        '''
+        published = read_generation(self.manager.cache_directory, self.name)
+        if not published or published['generation'] == self.generation():
+            return False
+        contents = self._attach(self.name)
+        if contents is None:
+            return False
+        self._swap_contents(contents)
+        return True
@@ -0,0 +1,549 @@
+import os
+import shutil
+import hashlib
+from six import iteritems
+from six.moves import cPickle
+from collections import OrderedDict
+from collections import MutableMapping
+
+from .registers import *
+from .bloom import stable_key_bytes
+from .cachewrap import CacheWrap
+from .utils import random_name
+
+WRITE_POLICIES = ('through', 'behind')
+_DELETED = object() # Pending write-behind delete
+
+def key_digest(key):
+    return hashlib.md5(stable_key_bytes(key)).hexdigest()
+
+def generate_tier_path(cache_dir, cache_name):
+    return generate_path(cache_dir, cache_name, 'l2')
+
+class Tier(object):
+    '''
+    One level of a TieredContents. Writes either go straight to the backing store or are
+    held in pending until flush, and reads see pending writes first.
+    '''
+    name = 'tier'
+    enumerable = True # Whether keys can be listed
+
+    def __init__(self, write_policy='through', max_pending=1000):
+        if write_policy not in WRITE_POLICIES:
+            raise ValueError("Unknown write_policy '{}', expected one of {}".format(write_policy, WRITE_POLICIES))
+        self.write_policy = write_policy
+        self.max_pending = max_pending
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.errors = 0
+
+    def get(self, key):
+        if key in self.pending:
+            value = self.pending[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+        return self._load(key)
+
+    def get_many(self, keys):
+        '''
+        Returns { key: value } for each of keys found, loading the ones not pending in one batch.
+        '''
+        found, unpending = {}, []
+        for key in keys:
+            if key in self.pending:
+                if self.pending[key] is not _DELETED:
+                    found[key] = self.pending[key]
+            else:
+                unpending.append(key)
+        if unpending:
+            found.update(self._load_many(unpending))
+        return found
+
+    def set(self, key, value):
+        self._write(key, value)
+
+    def set_many(self, pairs):
+        self._write_many(pairs)
+
+    def delete(self, key):
+        self._write(key, _DELETED)
+
+    def delete_many(self, keys):
+        self._write_many([(key, _DELETED) for key in keys])
+
+    def fill(self, key, value):
+        '''
+        Stores a value promoted from a lower tier, which is already persisted there.
+        '''
+        self._store(key, value)
+
+    def fill_many(self, pairs):
+        self._store_many(pairs)
+
+    def _write(self, key, value):
+        if self.write_policy == 'behind':
+            self.pending[key] = value
+            if len(self.pending) >= self.max_pending:
+                self.flush()
+        else:
+            self._apply(key, value)
+
+    def _write_many(self, pairs):
+        if self.write_policy == 'behind':
+            self.pending.update(pairs)
+            if len(self.pending) >= self.max_pending:
+                self.flush()
+        else:
+            self._apply_many(pairs)
+
+    def _apply(self, key, value):
+        self.writes += 1
+        if value is _DELETED:
+            self._remove(key)
+        else:
+            self._store(key, value)
+
+    def _apply_many(self, pairs):
+        self.writes += len(pairs)
+        removed = [key for key, value in pairs if value is _DELETED]
+        if removed:
+            self._remove_many(removed)
+        if len(removed) < len(pairs):
+            self._store_many([(key, value) for key, value in pairs if value is not _DELETED])
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        self._apply_many(list(iteritems(pending)))
+        return len(pending)
+
+    def keys(self):
+        keys = set(key for key, value in iteritems(self.pending) if value is not _DELETED)
+        keys.update(key for key in self._keys() if self.pending.get(key) is not _DELETED)
+        return keys
+
+    def clear(self):
+        self.pending = {}
+        self._clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'tier': self.name,
+            'write_policy': self.write_policy,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else None,
+            'writes': self.writes,
+            'pending': len(self.pending),
+            'errors': self.errors
+        }
+
+    def _load(self, key):
+        raise NotImplementedError()
+
+    def _store(self, key, value):
+        raise NotImplementedError()
+
+    def _remove(self, key):
+        raise NotImplementedError()
+
+    def _load_many(self, keys):
+        found = {}
+        for key in keys:
+            try:
+                found[key] = self._load(key)
+            except KeyError:
+                pass
+        return found
+
+    def _store_many(self, pairs):
+        for key, value in pairs:
+            self._store(key, value)
+
+    def _remove_many(self, keys):
+        for key in keys:
+            self._remove(key)
+
+    def _keys(self):
+        return []
+
+    def _clear(self):
+        pass
+
+class MemoryTier(Tier):
+    '''
+    An in-process least recently used mapping of at most max_entries keys.
+    '''
+    name = 'l1'
+
+    def __init__(self, max_entries=1024):
+        Tier.__init__(self, 'through')
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def _load(self, key):
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def _store(self, key, value):
+        self.entries.pop(key, None)
+        if len(self.entries) >= self.max_entries:
+            self.entries.popitem(last=False)
+        self.entries[key] = value
+
+    def _remove(self, key):
+        self.entries.pop(key, None)
+
+    def _keys(self):
+        return self.entries.keys()
+
+    def _clear(self):
+        self.entries.clear()
+
+class DiskTier(Tier):
+    '''
+    Stores each entry in its own pickle file under directory, named by a digest of the key,
+    so single entries are read and written without touching the rest.
+    '''
+    name = 'l2'
+
+    def __init__(self, directory, write_policy='through', max_pending=1000):
+        Tier.__init__(self, write_policy, max_pending)
+        self.directory = directory
+
+    def _entry_path(self, key):
+        digest = key_digest(key)
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _load(self, key):
+        try:
+            with open(self._entry_path(key), 'rb') as entry_file:
+                stored_key, value = cPickle.load(entry_file)
+        except (IOError, OSError, EOFError):
+            raise KeyError(key)
+        if stored_key != key:
+            raise KeyError(key) # Digest collision
+        return value
+
+    def _store(self, key, value):
+        path = self._entry_path(key)
+        ensure_directory(os.path.dirname(path))
+        tmp_path = '.'.join([path, 'tmp', random_name()])
+        try:
+            with open(tmp_path, 'wb') as entry_file:
+                cPickle.dump((key, value), entry_file, cPickle.HIGHEST_PROTOCOL)
+            shutil.move(tmp_path, path)
+        except:
+            try: os.remove(tmp_path)
+            except OSError: pass
+            raise
+
+    def _remove(self, key):
+        try:
+            os.remove(self._entry_path(key))
+        except OSError:
+            pass
+
+    def _keys(self):
+        if not os.path.isdir(self.directory):
+            return
+        for fan_out in os.listdir(self.directory):
+            fan_dir = os.path.join(self.directory, fan_out)
+            for file_name in os.listdir(fan_dir):
+                if '.' in file_name:
+                    continue # Unfinished write
+                try:
+                    with open(os.path.join(fan_dir, file_name), 'rb') as entry_file:
+                        yield cPickle.load(entry_file)[0]
+                except (IOError, OSError, EOFError):
+                    pass
+
+    def _clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def empty(self):
+        return not os.path.isdir(self.directory) or not os.listdir(self.directory)
+
+class RemoteTier(Tier):
+    '''
+    Reaches a shared remote store through a client with memcached/redis style methods:
+    get(str key) returning bytes or None, set(str key, bytes value) and delete(str key).
+    Clients which also have get_many(keys) returning { key: bytes }, set_many({ key: bytes })
+    or delete_many(keys) serve batches in one round trip. Keys are namespaced digests and
+    values are pickled with their key. Client errors are counted and treated as misses,
+    so an unreachable remote only costs its hit rate.
+    '''
+    name = 'l3'
+    enumerable = False
+
+    def __init__(self, client, namespace, write_policy='behind', max_pending=1000):
+        Tier.__init__(self, write_policy, max_pending)
+        self.client = client
+        self.namespace = namespace
+
+    def _remote_key(self, key):
+        return ':'.join([self.namespace, key_digest(key)])
+
+    def _ignored_error(self, action, e):
+        self.errors += 1
+        print("Warning: ignored error in '{}' remote tier {} - {}".format(self.namespace, action, repr(e)))
+
+    def _load(self, key):
+        try:
+            data = self.client.get(self._remote_key(key))
+        except Exception as e:
+            self._ignored_error('get', e)
+            raise KeyError(key)
+        if data is None:
+            raise KeyError(key)
+        stored_key, value = cPickle.loads(data)
+        if stored_key != key:
+            raise KeyError(key)
+        return value
+
+    def _load_many(self, keys):
+        if not hasattr(self.client, 'get_many'):
+            return Tier._load_many(self, keys)
+        remote_keys = dict((self._remote_key(key), key) for key in keys)
+        try:
+            datas = self.client.get_many(list(remote_keys))
+        except Exception as e:
+            self._ignored_error('get_many', e)
+            return {}
+        found = {}
+        for remote_key, data in iteritems(datas):
+            if data is None or remote_key not in remote_keys:
+                continue
+            stored_key, value = cPickle.loads(data)
+            if stored_key == remote_keys[remote_key]:
+                found[stored_key] = value
+        return found
+
+    def _store_many(self, pairs):
+        if not hasattr(self.client, 'set_many'):
+            return Tier._store_many(self, pairs)
+        try:
+            self.client.set_many(dict((self._remote_key(key), cPickle.dumps((key, value), cPickle.HIGHEST_PROTOCOL))
+                for key, value in pairs))
+        except Exception as e:
+            self._ignored_error('set_many', e)
+
+    def _remove_many(self, keys):
+        if not hasattr(self.client, 'delete_many'):
+            return Tier._remove_many(self, keys)
+        try:
+            self.client.delete_many([self._remote_key(key) for key in keys])
+        except Exception as e:
+            self._ignored_error('delete_many', e)
+
+    def _store(self, key, value):
+        try:
+            self.client.set(self._remote_key(key), cPickle.dumps((key, value), cPickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            self._ignored_error('set', e)
+
+    def _remove(self, key):
+        try:
+            self.client.delete(self._remote_key(key))
+        except Exception as e:
+            self._ignored_error('delete', e)
+
+class TieredContents(MutableMapping):
+    '''
+    Looks keys up through each tier in order, promoting values found in a lower tier into
+    the tiers above it. Writes go to every tier by each tier's write policy. Iteration only
+    covers tiers which can list their keys.
+    '''
+    def __init__(self, tiers):
+        self.tiers = tiers
+
+    def _find(self, key):
+        for index, tier in enumerate(self.tiers):
+            try:
+                value = tier.get(key)
+            except KeyError:
+                tier.misses += 1
+                continue
+            tier.hits += 1
+            for upper in self.tiers[:index]:
+                upper.fill(key, value)
+            return value
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        return self._find(key)
+
+    def get_many(self, keys):
+        '''
+        Looks a batch of keys up one tier at a time, so each tier sees a single batch of the
+        keys still missing and promotions are filled in batches too.
+        '''
+        found, missing = {}, list(keys)
+        for index, tier in enumerate(self.tiers):
+            if not missing:
+                break
+            tier_found = tier.get_many(missing)
+            tier.hits += len(tier_found)
+            tier.misses += len(missing) - len(tier_found)
+            if tier_found:
+                for upper in self.tiers[:index]:
+                    upper.fill_many(list(iteritems(tier_found)))
+                found.update(tier_found)
+                missing = [key for key in missing if key not in tier_found]
+        return found
+
+    def set_many(self, pairs):
+        for tier in self.tiers:
+            tier.set_many(pairs)
+
+    def delete_many(self, keys):
+        '''
+        Deletes keys from every tier, returning the ones which were present. Presence is
+        probed a tier at a time in batches, without promoting keys about to be deleted.
+        '''
+        found, missing = set(), list(keys)
+        for tier in self.tiers:
+            if not missing:
+                break
+            found.update(tier.get_many(missing))
+            missing = [key for key in missing if key not in found]
+        present = [key for key in keys if key in found]
+        if present:
+            for tier in self.tiers:
+                tier.delete_many(present)
+        return present
+
+    def __contains__(self, key):
+        try:
+            self._find(key)
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, key, value):
+        for tier in self.tiers:
+            tier.set(key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        for tier in self.tiers:
+            tier.delete(key)
+
+    def _keys(self):
+        keys = set()
+        for tier in self.tiers:
+            if tier.enumerable:
+                keys.update(tier.keys())
+        return keys
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def __repr__(self):
+        return '{}<{}>'.format(self.__class__.__name__, ', '.join(tier.name for tier in self.tiers))
+
+    def __reduce__(self):
+        return (dict, (dict(iteritems(self)),))
+
+    def flush(self):
+        '''
+        Writes every pending write-behind entry to its tier, returning how many were written.
+        '''
+        return sum(tier.flush() for tier in self.tiers)
+
+    def clear_tiers(self, keep_memory=False):
+        '''
+        Drops every tier's contents, other than in-process ones with keep_memory. Remote
+        entries can't be listed, so only the keys known to the local tiers are deleted there.
+        '''
+        known = self._keys()
+        for tier in self.tiers:
+            if keep_memory and isinstance(tier, MemoryTier):
+                continue
+            if tier.enumerable:
+                tier.clear()
+            else:
+                tier.pending = {}
+                for key in known:
+                    tier._remove(key)
+
+    def tier_stats(self):
+        return [tier.stats() for tier in self.tiers]
+
+class TieredCache(CacheWrap):
+    '''
+    Holds contents in up to three tiers: an in-process LRU of l1_size entries, a directory
+    of per-entry pickle files on local disk, and a remote store reached through l3_client
+    (see RemoteTier). Reads promote values up the tiers, and the disk and remote tiers write
+    through or behind as set by l2_write and l3_write. Saving flushes write-behind entries,
+    always synchronously as the tiers hold the only copy of them. Iterating or counting the
+    contents lists every entry of the disk tier.
+
+    Built or assigned contents replace what the tiers hold on their next save.
+    '''
+    def __init__(self, cache_name, l1_size=1024, disk_tier=True, l3_client=None, l2_write='through',
+                 l3_write='behind', max_pending=1000, **kwargs):
+        if kwargs.get('async'):
+            self.delete_triggered = True # Nothing to save on del
+            raise ValueError("Tiered cache '{}' flushes its tiers in place, so can't save asynchronously".format(
+                cache_name))
+        self.l1_size = l1_size
+        self.disk_tier = disk_tier
+        self.l3_client = l3_client
+        self.l2_write = l2_write
+        self.l3_write = l3_write
+        self.max_pending = max_pending
+        CacheWrap.__init__(self, cache_name, **kwargs)
+        if self.contents is not None and not isinstance(self.contents, TieredContents):
+            self.save()
+
+    def _tiered_contents(self, name):
+        tiers = [MemoryTier(self.l1_size)]
+        if self.disk_tier:
+            tiers.append(DiskTier(generate_tier_path(self.manager.cache_directory, name), self.l2_write,
+                self.max_pending))
+        if self.l3_client is not None:
+            tiers.append(RemoteTier(self.l3_client, '.'.join([self.manager.name, name]), self.l3_write,
+                self.max_pending))
+        return TieredContents(tiers)
+
+    def loader(self, name):
+        contents = self._tiered_contents(name)
+        if self.has_builder() and self.disk_tier and contents.tiers[1].empty():
+            return None # Nothing saved yet, so build
+        return contents
+
+    def saver(self, name, contents):
+        if not isinstance(contents, TieredContents):
+            tiered = self._tiered_contents(name)
+            tiered.clear_tiers()
+            for key, value in iteritems(contents):
+                tiered[key] = value
+            if not isinstance(self.contents, TieredContents):
+                self.contents = tiered
+            contents = tiered
+        contents.flush()
+
+    def _async_save(self, name, contents):
+        # A forked flush would only empty the child's pending writes
+        return self.saver(name, contents)
+
+    def deleter(self, name):
+        if isinstance(self.contents, TieredContents):
+            self.contents.clear_tiers(keep_memory=True)
+        else:
+            shutil.rmtree(generate_tier_path(self.manager.cache_directory, name), ignore_errors=True)
+
+    def tier_stats(self):
+        '''
+        Hit rate and write counts for each tier, from the top tier down.
+        '''
+        return self.contents.tier_stats() if isinstance(self.contents, TieredContents) else []
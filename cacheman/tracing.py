@@ -0,0 +1,118 @@
+import os
+import json
+import shutil
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from timeit import default_timer
+from past.builtins import basestring
+
+from .utils import random_name
+
+def payload_size(*values):
+    '''
+    The len of the first sized, non-string value, as a cheap measure of how much a callback handled.
+    '''
+    for value in values:
+        if value is None or isinstance(value, (basestring, bytes)):
+            continue
+        try:
+            return len(value)
+        except (TypeError, AttributeError):
+            continue
+    return None
+
+class Tracer(object):
+    '''
+    Records nested spans of cache operations and callbacks, exportable as Chrome trace events
+    for chrome://tracing or Perfetto. Only the most recent max_events spans are kept.
+    '''
+    def __init__(self, max_events=100000):
+        self.events = deque(maxlen=max_events)
+        self.local = threading.local()
+        self.epoch = default_timer()
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def depth(self, cache_name):
+        '''
+        How many dependency levels deep the current thread is below the cache that started the cascade.
+        '''
+        return len(set(self._stack()) - set([cache_name]))
+
+    @contextmanager
+    def span(self, name, cache_name, category='callback'):
+        '''
+        Times the enclosed block. Yields a dict of args which the block can add to.
+        '''
+        args = { 'cache': cache_name, 'depth': self.depth(cache_name) }
+        stack = self._stack()
+        stack.append(cache_name)
+        start = default_timer()
+        try:
+            yield args
+        except Exception as e:
+            args['error'] = repr(e)
+            raise
+        finally:
+            end = default_timer()
+            stack.pop()
+            self.events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': (start - self.epoch) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': threading.current_thread().ident,
+                'args': args,
+            })
+
+    def call(self, name, cache_name, callback, *args):
+        with self.span(name, cache_name) as span_args:
+            result = callback(*args)
+            size = payload_size(result, *reversed(args))
+            if size is not None:
+                span_args['payload_size'] = size
+        return result
+
+    def clear(self):
+        self.events.clear()
+
+    def chrome_trace(self):
+        return { 'traceEvents': list(self.events), 'displayTimeUnit': 'ms' }
+
+    def write(self, path):
+        '''
+        Atomically writes the Chrome trace JSON to path.
+        '''
+        tmp_path = '.'.join([path, 'tmp', random_name()])
+        with open(tmp_path, 'w') as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
+        shutil.move(tmp_path, path)
+
+def traced_cascade(method):
+    '''
+    Wraps a CacheWrap cascade method in a span when the manager is tracing, skipping
+    calls which return early because the cache was already visited.
+    '''
+    arg_names = method.__code__.co_varnames[1:method.__code__.co_argcount] # Less self
+    seen_index = arg_names.index('seen_caches') if 'seen_caches' in arg_names else None
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        tracer = self.manager.tracer
+        if tracer is None:
+            return method(self, *args, **kwargs)
+        seen_caches = kwargs.get('seen_caches')
+        if seen_index is not None and len(args) > seen_index:
+            seen_caches = args[seen_index]
+        if seen_caches and self.name in seen_caches:
+            return method(self, *args, **kwargs)
+        with tracer.span(method.__name__, self.name, 'cascade'):
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -5,6 +5,7 @@ import unittest
 from .faketime import FakeTime
 from datetime import datetime, timedelta
 from cacheman import autosync
+from cacheman.dirtytrack import DirtyKeyTracker, HyperLogLog
 from .common import CacheCommonAsserter
 
 class AutoSyncCacheTest(CacheCommonAsserter, unittest.TestCase):
@@ -123,5 +124,217 @@ class AutoSyncCacheTest(CacheCommonAsserter, unittest.TestCase):
         cache.time_shift_buckets()
         self.assertEqual(list(cache.time_counts), [0] * 5)
 
+    def test_batch_single_edit_track(self):
+        cache_name = 'batched'
+        cache = self.build_fast_sync_cache(cache_name)
+
+        with cache.batch():
+            for count in range(20):
+                cache[count] = count
+            # Nothing tracked until the batch exits
+            self.assertEqual(list(cache.time_counts), [0] * 5)
+            cache.load()
+            self.assert_contents_equal(cache, {})
+            for count in range(20):
+                cache[count] = count
+
+        # The single weighted edit crossed a threshold and saved
+        self.assertEqual(list(cache.time_counts), [0] * 5)
+        cache.load()
+        self.assert_contents_equal(cache, dict((i, i) for i in range(20)))
+
+    def test_native_bulk_edits(self):
+        cache_name = 'bulk'
+        cache = autosync.AutoSyncCache(cache_name, cache_manager=self.manager,
+                time_checks=[autosync.TimeCount(5, 1000)], time_bucket_size=1)
+
+        cache.update(dict((i, i) for i in range(10)), extra=True)
+        self.assertEqual(list(cache.time_counts), [0] * 4 + [11])
+        cache.set_many([('a', 1), ('b', 2)])
+        self.assertEqual(list(cache.time_counts), [0] * 4 + [13])
+        self.assertEqual(cache.get_many(['a', 'b', 'missing']), { 'a': 1, 'b': 2 })
+        cache.set_many([('x', 1), ('y', 2)])
+        self.assertEqual(cache.delete_many(['x', 'y', 'missing']), 2)
+        self.assertEqual(list(cache.time_counts), [0] * 4 + [17])
+
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('missing', 'default'), 'default')
+        self.assertRaises(KeyError, cache.pop, 'missing')
+        self.assertEqual(cache.setdefault('b', 3), 2)
+        self.assertEqual(cache.setdefault('c', 3), 3)
+        self.assertEqual(list(cache.time_counts), [0] * 4 + [19])
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(list(cache.time_counts), [0] * 4 + [32])
+
+    def test_adaptive_policy_interval(self):
+        policy = autosync.AdaptiveSyncPolicy(target_fraction=0.1, max_loss_window=60, min_interval=1)
+        self.assertEqual(policy.save_interval(), 1)
+        now = self.faketime.now()
+        policy.record_save(2.0, 100, now)
+        # 2 second saves at 10% of wall time means saving every 20 seconds
+        self.assertEqual(policy.save_interval(), 20)
+        self.assertFalse(policy.should_save(now + timedelta(seconds=30))) # Nothing pending
+
+        policy.record_edit(3, now + timedelta(seconds=5))
+        self.assertFalse(policy.should_save(now + timedelta(seconds=10)))
+        self.assertTrue(policy.should_save(now + timedelta(seconds=20)))
+        self.assertEqual([d.reason for d in policy.decisions], ['waiting', 'interval'])
+        self.assertEqual(policy.decisions[-1].pending_edits, 3)
+
+        # Slow saves are capped by the data loss window
+        policy.record_save(100.0, 100, now)
+        self.assertEqual(policy.save_interval(), 60)
+        policy.clear_pending()
+        policy.record_edit(1, now)
+        self.assertTrue(policy.should_save(now + timedelta(seconds=60)))
+        self.assertEqual(policy.decisions[-1].reason, 'max_loss_window')
+        self.assertEqual(policy.stats()['save_count'], 2)
+
+    def test_adaptive_policy_cache(self):
+        cache_name = 'adaptive'
+        policy = autosync.AdaptiveSyncPolicy(target_fraction=0.5, max_loss_window=10, min_interval=5)
+        cache = autosync.AutoSyncCache(cache_name, cache_manager=self.manager, policy=policy,
+                time_checks=[autosync.TimeCount(1, 1)], time_bucket_size=1)
+        # The initial build saved and was measured
+        self.assertEqual(policy.save_count, 1)
+        self.assertGreater(policy.save_bytes, 0)
+
+        # Policy overrides the time_checks which would have saved on every edit
+        cache['first'] = 1
+        self.assertEqual(policy.pending_edits, 1)
+        cache.load()
+        self.assert_contents_equal(cache, {})
+        self.assertEqual(policy.pending_edits, 0)
+
+        cache['first'] = 1
+        self.faketime.incr_time(timedelta(seconds=5))
+        cache['second'] = 2
+        self.assertEqual(policy.save_count, 2)
+        self.assertEqual(policy.pending_edits, 0)
+        cache.load()
+        self.assert_contents_equal(cache, { 'first': 1, 'second': 2 })
+
+    def test_distinct_key_counting(self):
+        cache_name = 'hot_key'
+        cache = autosync.AutoSyncCache(cache_name, cache_manager=self.manager, count_mode='keys',
+                time_checks=[autosync.TimeCount(1, 3), autosync.TimeCount(5, 10)], time_bucket_size=1)
+
+        for count in range(100):
+            cache['counter'] = count
+        # Only one distinct key changed, so no save should have triggered
+        self.assertEqual(cache.dirty_key_count(), 1)
+        self.assertEqual(list(cache.time_counts), [0] * 4 + [1])
+
+        cache['second'] = 2
+        cache['third'] = 3
+        self.assertEqual(cache.dirty_key_count(), 0) # Cleared by the save
+        cache.load()
+        self.assert_contents_equal(cache, { 'counter': 99, 'second': 2, 'third': 3 })
+
+    def test_weighted_edit_counts(self):
+        cache_name = 'weighted'
+        cache = autosync.AutoSyncCache(cache_name, cache_manager=self.manager,
+                edit_weigher=lambda key, value: len(value) if value else 1,
+                time_checks=[autosync.TimeCount(5, 100)], time_bucket_size=1)
+        cache['small'] = 'a'
+        cache['large'] = 'b' * 50
+        self.assertEqual(list(cache.time_counts), [0] * 4 + [51])
+        del cache['small']
+        self.assertEqual(list(cache.time_counts), [0] * 4 + [52])
+        self.assertGreater(autosync.value_size_weigher('key', 'b' * 50), 50)
+
+    def test_dirty_key_tracker_sketch(self):
+        tracker = DirtyKeyTracker(max_exact_keys=100, precision=12)
+        added = sum(tracker.add(key) for key in range(100))
+        self.assertEqual(added, 100)
+        self.assertTrue(tracker.exact())
+        self.assertEqual(tracker.add(5), 0)
+
+        added += sum(tracker.add(key) for key in range(20000))
+        self.assertFalse(tracker.exact())
+        self.assertEqual(len(tracker), added)
+        # HyperLogLog with 4096 registers has ~1.6% standard error
+        self.assertAlmostEqual(len(tracker), 20000, delta=20000 * 0.08)
+
+        tracker.clear()
+        self.assertTrue(tracker.exact())
+        self.assertEqual(len(tracker), 0)
+
+        sketch = HyperLogLog(precision=10)
+        for key in range(10):
+            sketch.add(key)
+            sketch.add(key)
+        self.assertEqual(len(sketch), 10)
+
+    def build_background_sync_cache(self, cache_name):
+        cache = autosync.AutoSyncCache(cache_name, cache_manager=self.manager, background_sync=True,
+                time_checks=[autosync.TimeCount(1, 2), autosync.TimeCount(5, 10)], time_bucket_size=1)
+        # Drive the scheduler by hand so checks line up with the fake clock
+        self.manager.autosync_scheduler.stop()
+        return cache
+
+    def test_background_sync_defers_save(self):
+        cache_name = 'background'
+        cache = self.build_background_sync_cache(cache_name)
+
+        cache['first'] = 1
+        cache['second'] = 2
+        self.assertEqual(sum(cache.time_counts), 2)
+        cache.load()
+        # Writes only record counts, so nothing should have saved yet
+        self.assert_contents_equal(cache, {})
+
+        cache['first'] = 1
+        cache['second'] = 2
+        self.assertEqual(self.manager.autosync_scheduler.check_caches(), [cache_name])
+        self.assertEqual(list(cache.time_counts), [0] * 5)
+        cache.load()
+        self.assert_contents_equal(cache, { 'first': 1, 'second': 2 })
+
+    def test_background_sync_quiet_cache(self):
+        cache_name = 'quiet'
+        cache = autosync.AutoSyncCache(cache_name, cache_manager=self.manager, background_sync=True,
+                time_checks=[autosync.TimeCount(1, 5), autosync.TimeCount(5, 1)], time_bucket_size=1)
+        self.manager.autosync_scheduler.stop()
+
+        cache['lonely'] = True
+        self.faketime.incr_time(timedelta(seconds=2))
+        # No more edits arrive, but the scheduler still catches the trailing edit
+        self.assertEqual(self.manager.autosync_scheduler.check_caches(), [cache_name])
+        cache.load()
+        self.assert_contents_equal(cache, { 'lonely': True })
+        self.assertEqual(self.manager.autosync_scheduler.check_caches(), [])
+
+    def test_background_sync_retries_failed_save(self):
+        cache_name = 'retried'
+        cache = self.build_background_sync_cache(cache_name)
+        saver = cache.saver
+        def failing_saver(name, contents):
+            raise IOError('disk full')
+        cache.saver = failing_saver
+
+        cache['first'] = 1
+        cache['second'] = 2
+        self.assertEqual(self.manager.autosync_scheduler.check_caches(), [])
+        self.assertTrue(cache.save_failed)
+        self.assertTrue(cache.has_unsaved_edits())
+
+        # The failed save uncounted its edits, but the failure alone triggers a retry
+        cache.saver = saver
+        self.faketime.incr_time(timedelta(seconds=10))
+        self.assertEqual(self.manager.autosync_scheduler.check_caches(), [cache_name])
+        self.assertFalse(cache.save_failed)
+        cache.load()
+        self.assert_contents_equal(cache, { 'first': 1, 'second': 2 })
+
+    def test_background_sync_deregister(self):
+        cache_name = 'deregistered'
+        self.build_background_sync_cache(cache_name)
+        self.assertEqual(len(self.manager.autosync_scheduler.registered_caches()), 1)
+        self.manager.deregister_cache(cache_name)
+        self.assertEqual(self.manager.autosync_scheduler.registered_caches(), [])
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,7 +3,6 @@ from . import parentpath
 
 import copy
 import unittest
-import psutil
 import os
 import random
 from cacheman import registers
@@ -408,10 +407,6 @@ class CacheManagerTest(CacheCommonAsserter, unittest.TestCase):
         self.assert_contents_equal(self.manager.retrieve_cache(cache_name), { 'baz': 'bar' })
         self.assert_contents_equal(self.manager.invalidate_and_rebuild_cache(cache_name), {})
 
-    def wait_async_complete(self):
-        parent = psutil.Process(os.getpid())
-        psutil.wait_procs(parent.children(recursive=True), timeout=30)
-
     def test_async_saver(self):
         cache_name = self.check_cache_gone('foo_bar_async_saver')
         cache = self.manager.register_custom_cache(cache_name, { 'foo': 'bar' }, async=True)
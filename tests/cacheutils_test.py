@@ -0,0 +1,91 @@
+# This import fixes sys.path issues
+from . import parentpath
+
+import pickle
+import unittest
+from cacheman.cachewrap import PersistentCache
+from cacheman.cacheutils import DenseIntMap, SortedArrayMap, CompactIntSet, SetAsDictWrap
+from .common import CacheCommonAsserter
+
+class CompactContainersTest(CacheCommonAsserter, unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        CacheCommonAsserter.__init__(self)
+        unittest.TestCase.__init__(self, *args, **kwargs)
+
+    def test_dense_int_map(self):
+        dense = DenseIntMap({ 3: 30, 0: 1 })
+        dense[10] = 100
+        self.assertEqual(len(dense), 3)
+        self.assertEqual(list(dense), [0, 3, 10])
+        self.assertEqual(dense[3], 30)
+        self.assertFalse(5 in dense)
+        self.assertFalse('foo' in dense)
+        self.assertRaises(KeyError, lambda: dense[5])
+        self.assertRaises(KeyError, dense.__setitem__, -1, 1)
+
+        dense[3] = 31
+        del dense[0]
+        self.assertEqual(dict(dense), { 3: 31, 10: 100 })
+        self.assertRaises(KeyError, dense.__delitem__, 0)
+
+    def test_dense_int_map_floats(self):
+        dense = DenseIntMap(typecode='d')
+        dense[2] = 0.5
+        self.assertEqual(dense[2], 0.5)
+        self.assertEqual(dense.values.typecode, 'd')
+
+    def test_sorted_array_map(self):
+        static = SortedArrayMap({ 50: 0.5, 7: 0.7, 1000000: 1.5 })
+        self.assertEqual(list(static), [7, 50, 1000000])
+        self.assertEqual(static[1000000], 1.5)
+        self.assertFalse(8 in static)
+        self.assertFalse('foo' in static)
+        self.assertRaises(KeyError, lambda: static[8])
+
+        static[7] = 1.0
+        static[20] = 2.0
+        del static[50]
+        self.assertEqual(dict(static), { 7: 1.0, 20: 2.0, 1000000: 1.5 })
+
+    def test_compact_int_set(self):
+        ids = CompactIntSet([1, 9, 9, 64])
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(list(ids), [1, 9, 64])
+        self.assertTrue(9 in ids)
+        self.assertFalse(10 in ids)
+        self.assertFalse(100000 in ids)
+        ids.discard(9)
+        ids.discard(9)
+        self.assertEqual(sorted(ids), [1, 64])
+        self.assertRaises(KeyError, ids.remove, 9)
+        self.assertRaises(ValueError, ids.add, -1)
+
+    def test_set_as_dict_delete(self):
+        wrapped = SetAsDictWrap(CompactIntSet([1, 2]))
+        del wrapped[1]
+        self.assertEqual(list(wrapped), [2])
+        wrapped = SetAsDictWrap(set(['foo']))
+        del wrapped['foo']
+        self.assertEqual(len(wrapped), 0)
+
+    def test_pickle_round_trips(self):
+        for container in [DenseIntMap({ 1: 2, 40: 5 }), SortedArrayMap({ 3: 0.25, 1: 0.5 }),
+                CompactIntSet([0, 17, 300])]:
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                loaded = pickle.loads(pickle.dumps(container, protocol))
+                self.assertEqual(type(loaded), type(container))
+                self.assertEqual(list(loaded), list(container))
+                if hasattr(container, 'items'):
+                    self.assertEqual(dict(loaded), dict(container))
+
+    def test_persistent_cache_contents(self):
+        cache_name = self.check_cache_gone('dense_contents')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, contents=DenseIntMap())
+        cache[4] = 16
+        cache[2] = 4
+        cache.save()
+
+        cache.contents = DenseIntMap()
+        cache.load()
+        self.assertTrue(isinstance(cache.contents, DenseIntMap))
+        self.assert_contents_equal(cache, { 2: 4, 4: 16 })
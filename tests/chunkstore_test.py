@@ -0,0 +1,100 @@
+# This import fixes sys.path issues
+from . import parentpath
+
+import os
+import shutil
+import unittest
+from cacheman.cachewrap import PersistentCache
+from cacheman.chunkstore import (snapshot_saver, snapshot_loader, list_snapshots, prune_snapshots, collect_garbage,
+    snapshot_records, content_defined_chunks, parse_chunk, generate_chunk_directory)
+from .common import CacheCommonAsserter
+
+def chunk_files(cache_dir):
+    return [name for _, _, names in os.walk(generate_chunk_directory(cache_dir)) for name in names]
+
+class ChunkStoreTest(CacheCommonAsserter, unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        CacheCommonAsserter.__init__(self)
+        unittest.TestCase.__init__(self, *args, **kwargs)
+
+    def tearDown(self):
+        CacheCommonAsserter.tearDown(self)
+        shutil.rmtree(generate_chunk_directory(self.test_cache_dir), ignore_errors=True)
+        shutil.rmtree(os.path.join(self.test_cache_dir, 'snapshots'), ignore_errors=True)
+
+    def contents(self, size=5000):
+        return dict((i, 'value-{}'.format(i) * 4) for i in range(size))
+
+    def test_chunks_round_trip(self):
+        contents = self.contents()
+        chunks = list(content_defined_chunks(snapshot_records(contents), 4096))
+        self.assertGreater(len(chunks), 10)
+        self.assertTrue(all(len(chunk) <= 4 * 4096 for chunk in chunks))
+        loaded = {}
+        for chunk in chunks:
+            loaded.update(parse_chunk(chunk))
+        self.assertEqual(loaded, contents)
+
+    def test_edits_only_change_nearby_chunks(self):
+        contents = self.contents()
+        before = list(content_defined_chunks(snapshot_records(contents), 4096))
+        contents[2500] = 'changed'
+        contents[-1] = 'inserted'
+        after = list(content_defined_chunks(snapshot_records(contents), 4096))
+        changed = len(set(after) - set(before))
+        self.assertLessEqual(changed, 4)
+        self.assertGreater(len(after), 20)
+
+    def test_saves_only_new_chunks(self):
+        contents = self.contents()
+        first = snapshot_saver(self.test_cache_dir, 'snap', contents, 'first', 4096)
+        self.assertEqual(first['new_chunks'], len(first['chunks']))
+        self.assertEqual(first['entries'], len(contents))
+
+        contents[10] = 'changed'
+        second = snapshot_saver(self.test_cache_dir, 'snap', contents, 'second', 4096)
+        self.assertLessEqual(second['new_chunks'], 2)
+        self.assertLess(second['new_bytes'], first['new_bytes'] / 10)
+
+        self.assertEqual([m['snapshot'] for m in list_snapshots(self.test_cache_dir, 'snap')], ['first', 'second'])
+        self.assertEqual(snapshot_loader(self.test_cache_dir, 'snap'), contents)
+        self.assertEqual(snapshot_loader(self.test_cache_dir, 'snap', 'first')[10], 'value-10' * 4)
+        self.assertIsNone(snapshot_loader(self.test_cache_dir, 'snap', 'missing'))
+
+    def test_garbage_collection(self):
+        contents = self.contents()
+        snapshot_saver(self.test_cache_dir, 'snap', contents, 'first', 4096)
+        contents[10] = 'changed'
+        second = snapshot_saver(self.test_cache_dir, 'snap', contents, 'second', 4096)
+        chunk_count = len(chunk_files(self.test_cache_dir))
+
+        self.assertEqual(collect_garbage(self.test_cache_dir, grace_seconds=0), (0, 0))
+        self.assertEqual(prune_snapshots(self.test_cache_dir, 'snap', 1), ['first'])
+        self.assertEqual(collect_garbage(self.test_cache_dir, grace_seconds=3600)[0], 0) # Too recent
+        removed, freed = collect_garbage(self.test_cache_dir, grace_seconds=0)
+        self.assertGreater(removed, 0)
+        self.assertGreater(freed, 0)
+        self.assertEqual(len(chunk_files(self.test_cache_dir)), chunk_count - removed)
+        self.assertEqual(set(chunk_files(self.test_cache_dir)), set(second['chunks']))
+        self.assertEqual(snapshot_loader(self.test_cache_dir, 'snap'), contents)
+
+    def test_cache_snapshot_and_restore(self):
+        cache_name = self.check_cache_gone('snapshot_cache')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, contents={ 'a': 1 })
+        first = cache.snapshot('first')
+        cache['a'] = 2
+        cache.snapshot('second', keep=1)
+        self.assertEqual([m['snapshot'] for m in cache.snapshots()], ['second'])
+
+        cache['a'] = 3
+        self.assertTrue(cache.restore_snapshot())
+        self.assertEqual(cache['a'], 2)
+        cache.load()
+        self.assertEqual(cache['a'], 2) # Restores are saved
+        self.assertFalse(cache.restore_snapshot(first['snapshot']))
+
+        self.assertEqual(self.manager.collect_snapshot_garbage(grace_seconds=0)[0], 1)
+        self.assertEqual(self.manager.stats()[cache_name]['snapshots'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+# This import fixes sys.path issues
+from . import parentpath
+
+import os
+import unittest
+from cacheman.cachewrap import PersistentCache, NonPersistentCache
+from cacheman.autosync import AutoSyncCache, TimeCount
+from cacheman.coherence import generate_stamp_path, stamp_loader
+from cacheman.registers import wait_async_saves
+from .common import CacheCommonAsserter
+
+class CacheCoherenceTest(CacheCommonAsserter, unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        CacheCommonAsserter.__init__(self)
+        unittest.TestCase.__init__(self, *args, **kwargs)
+
+    def save_in_other_process(self, cache, contents):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                cache.contents = contents
+                cache.save()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+    def coherent_cache(self, cache_name, cache_class=PersistentCache, **kwargs):
+        kwargs.setdefault('coherence_interval', 0)
+        kwargs.setdefault('coherence_background', False)
+        cache = cache_class(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' },
+            coherent=True, **kwargs)
+        cache.save()
+        return cache
+
+    def coherence_stats(self, cache_name):
+        return self.manager.stats()[cache_name]
+
+    def test_save_stamps_generation(self):
+        cache_name = self.check_cache_gone('coherence_stamp')
+        cache = self.coherent_cache(cache_name)
+        stamp = stamp_loader(cache.persisted_path())
+        self.assertEqual(stamp['writer'], cache.coherence.writer())
+        self.assertEqual(stamp['generation'], 1)
+
+        cache.save()
+        self.assertEqual(stamp_loader(cache.persisted_path())['generation'], 2)
+
+        cache.delete_saved_content()
+        self.assertFalse(os.path.exists(generate_stamp_path(cache.persisted_path())))
+
+    def test_reload_after_other_process_saves(self):
+        self.manager.metrics.sample_every = 1
+        cache_name = self.check_cache_gone('coherence_reload')
+        cache = self.coherent_cache(cache_name)
+
+        self.save_in_other_process(cache, { 'foo': 'baz' })
+        self.assertEqual(cache.contents, { 'foo': 'bar' }) # Nothing checked yet
+        self.assertEqual(cache['foo'], 'baz')
+        self.assertEqual(cache['foo'], 'baz')
+
+        stats = self.coherence_stats(cache_name)
+        self.assertEqual(stats['coherence_reloads'], 1)
+        self.assertEqual(stats['stale_reads_prevented'], 1) # Only the first read saw the reload
+
+    def test_no_reload_of_own_saves(self):
+        cache_name = self.check_cache_gone('coherence_own')
+        cache = self.coherent_cache(cache_name)
+        cache['foo'] = 'baz'
+        cache.save()
+        self.assertEqual(cache['foo'], 'baz')
+
+        cache.async = True
+        cache['foo'] = 'qux'
+        cache.save()
+        wait_async_saves(cache_name, self.manager.async_pid_cache, 5)
+        self.assertEqual(cache['foo'], 'qux')
+        self.assertEqual(cache['foo'], 'qux')
+
+        stats = self.coherence_stats(cache_name)
+        self.assertNotIn('coherence_reloads', stats)
+        self.assertGreaterEqual(stats['coherence_checks'], 2)
+
+    def test_background_reload(self):
+        cache_name = self.check_cache_gone('coherence_background')
+        cache = self.coherent_cache(cache_name, coherence_background=True)
+
+        self.save_in_other_process(cache, { 'foo': 'baz' })
+        cache['foo'] # Starts the reload and is served the current contents
+        cache.coherence_thread.join(5)
+        self.assertFalse(cache.coherence.reloading)
+        self.assertEqual(cache['foo'], 'baz')
+
+    def test_checks_are_rate_limited(self):
+        cache_name = self.check_cache_gone('coherence_limited')
+        cache = self.coherent_cache(cache_name, coherence_interval=3600)
+
+        self.save_in_other_process(cache, { 'foo': 'baz' })
+        self.assertEqual(cache['foo'], 'bar')
+        self.assertNotIn('coherence_checks', self.coherence_stats(cache_name))
+
+        cache.coherence.next_check = 0
+        self.assertEqual(cache['foo'], 'baz')
+
+    def test_unsaved_edits_are_kept(self):
+        cache_name = self.check_cache_gone('coherence_edits')
+        cache = self.coherent_cache(cache_name, AutoSyncCache, time_checks=[TimeCount(60, 100)])
+        cache['local'] = 'edit'
+
+        self.save_in_other_process(cache, { 'foo': 'baz' })
+        self.assertEqual(cache['local'], 'edit')
+        self.assertNotIn('coherence_reloads', self.coherence_stats(cache_name))
+
+    def test_plain_cache_edits_are_kept(self):
+        cache_name = self.check_cache_gone('coherence_plain_edits')
+        cache = self.coherent_cache(cache_name)
+        cache['local'] = 'edit'
+
+        self.save_in_other_process(cache, { 'foo': 'baz' })
+        self.assertEqual(cache['local'], 'edit')
+        self.assertNotIn('coherence_reloads', self.coherence_stats(cache_name))
+
+    def test_edits_during_reload_are_kept(self):
+        for cache_class, kwargs in [(PersistentCache, {}), (AutoSyncCache, { 'time_checks': [TimeCount(60, 100)] })]:
+            cache_name = self.check_cache_gone('coherence_mid_reload_' + cache_class.__name__)
+            cache = self.coherent_cache(cache_name, cache_class, **kwargs)
+            load_contents = cache._load_contents
+            def edited_load():
+                contents = load_contents()
+                cache['late'] = 'edit'
+                return contents
+            cache._load_contents = edited_load
+
+            self.save_in_other_process(cache, { 'foo': 'baz' })
+            self.assertEqual(cache['late'], 'edit')
+            self.assertEqual(cache['foo'], 'bar')
+            self.assertNotIn('coherence_reloads', self.coherence_stats(cache_name))
+
+    def test_generation_follows_other_writers(self):
+        cache_name = self.check_cache_gone('coherence_generations')
+        cache = self.coherent_cache(cache_name)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                cache.coherence.generation = 0 # As in a process which never saved before
+                cache.save()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(stamp_loader(cache.persisted_path())['generation'], 2)
+
+        cache.save()
+        self.assertEqual(stamp_loader(cache.persisted_path())['generation'], 3)
+
+    def test_requires_saved_file(self):
+        self.assertRaises(ValueError, lambda: NonPersistentCache(self.check_cache_gone('coherence_memory'),
+            cache_manager=self.manager, coherent=True))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -27,6 +27,10 @@ class CacheCommonAsserter(object):
             os.remove(f)
         for f in glob.glob(os.path.join(self.test_cache_dir, '*.csv*')):
             os.remove(f)
+        for f in glob.glob(os.path.join(self.test_cache_dir, '*.bloom*')):
+            os.remove(f)
+        for f in glob.glob(os.path.join(self.test_cache_dir, '*.lpkl*')):
+            os.remove(f)
 
     def setUp(self):
         self.manager = cacher.CacheManager(self.test_cache_key, self.test_cache_base_dir)
@@ -58,3 +62,7 @@ class CacheCommonAsserter(object):
 
     def check_cache_gone(self, cache_name, csv_path=False):
         return self.check_cache(cache_name, False, csv_path)
+
+    def wait_async_complete(self):
+        parent = psutil.Process(os.getpid())
+        psutil.wait_procs(parent.children(recursive=True), timeout=30)
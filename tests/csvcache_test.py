@@ -2,12 +2,20 @@
 from . import parentpath
 
 import unittest
+import os
+import time
 from .faketime import FakeTime
 from cacheman import autosync
-from cacheman.csvcache import CSVCache, AutoSyncCSVCache
+from cacheman import registers
+from cacheman import csvcache
+from cacheman.csvcache import CSVCache, AutoSyncCSVCache, LazyCSVContents
 from .common import CacheCommonAsserter
 from datetime import datetime, timedelta
 
+def float_row_reader(row):
+    # Module level so parallel loads can pickle it
+    return row[0], float(row[1])
+
 class CSVCacheTest(CacheCommonAsserter, unittest.TestCase):
     def __init__(self, *args, **kwargs):
         CacheCommonAsserter.__init__(self)
@@ -64,6 +72,48 @@ class CSVCacheTest(CacheCommonAsserter, unittest.TestCase):
         self.check_cache(cache_name, True, csv_path=True)
         self.assertEqual(cache[('foo', 'bar')], 1)
 
+    def test_typed_schema_loader(self):
+        cache_name = self.check_cache_gone('typed', csv_path=True)
+
+        cache = CSVCache(cache_name, cache_manager=self.manager, schema=['int', 'float'], chunk_size=3)
+        for i in range(10):
+            cache[i] = i / 2.0
+        cache.save()
+        cache.load()
+        self.assert_contents_equal(cache, dict((i, i / 2.0) for i in range(10)))
+
+        # Wider schemas produce tuple values
+        cache.schema = ['str', int, 'bool']
+        cache.contents = { 'foo': (1, True), 'bar': (2, False) }
+        cache.save()
+        cache.load()
+        self.assert_contents_equal(cache, { 'foo': (1, True), 'bar': (2, False) })
+
+        # Schemas which don't match the rows should fail loudly
+        cache.schema = ['str', 'int']
+        self.assertRaises(ValueError, cache.load)
+
+    def test_stream_rows(self):
+        cache_name = self.check_cache_gone('streamed', csv_path=True)
+
+        cache = CSVCache(cache_name, cache_manager=self.manager, schema=['int', 'int'], chunk_size=4)
+        self.assertEqual(list(cache.stream_rows()), [])
+        cache.contents = dict((i, i * i) for i in range(10))
+        cache.save()
+
+        self.assertEqual(sorted(cache.stream_rows()), [(i, i * i) for i in range(10)])
+        self.assertEqual(sorted(cache.stream_rows(schema=['str', 'float']))[1], ('1', 1.0))
+        cache.schema = None
+        self.assertEqual(sorted(cache.stream_rows())[2], ('2', '4'))
+
+    def test_bool_parser(self):
+        for cell in ['True', 'true', '1', 'yes']:
+            self.assertTrue(registers.parse_bool(cell))
+        for cell in ['False', 'false', '0', 'no', '']:
+            self.assertFalse(registers.parse_bool(cell))
+        self.assertRaises(ValueError, registers.parse_bool, 'maybe')
+        self.assertRaises(ValueError, registers.csv_column_parsers, ['complex'])
+
     def test_basic_autosync_actions(self):
         cache_name = self.check_cache_gone('csv_auto', csv_path=True)
         cache = AutoSyncCSVCache(cache_name, cache_manager=self.manager)
@@ -117,5 +167,358 @@ class CSVCacheTest(CacheCommonAsserter, unittest.TestCase):
         # No save should have triggered save from second time window
         self.assert_contents_equal(cache, dict((str(i), str(i)) for i in range(10)))
 
+    def build_incremental_cache(self, cache_name, **kwargs):
+        return AutoSyncCSVCache(cache_name, cache_manager=self.manager, incremental=True,
+                time_checks=[autosync.TimeCount(5, 1000)], time_bucket_size=1, **kwargs)
+
+    def csv_rows(self, cache_name):
+        return list(registers.csv_row_stream(self.test_cache_dir, cache_name))
+
+    def test_incremental_appends(self):
+        cache_name = self.check_cache_gone('csv_incremental', csv_path=True)
+        cache = self.build_incremental_cache(cache_name)
+        cache.update({ 'first': '1', 'second': '2' })
+        cache.save()
+        self.assertEqual(sorted(self.csv_rows(cache_name)), [('first', '1'), ('second', '2')])
+
+        cache['first'] = 'overwritten'
+        del cache['second']
+        cache.pop('missing', None)
+        cache.save()
+        rows = self.csv_rows(cache_name)
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[2:], [('first', 'overwritten'), (registers.CSV_DELETE_MARKER, 'second', '2')])
+        self.assertEqual(cache.csv_row_count, 4)
+
+        cache.load()
+        self.assert_contents_equal(cache, { 'first': 'overwritten' })
+        self.assertEqual(cache.csv_row_count, 4)
+        cache.save() # Nothing to append, but 3 of 4 rows are dead so it compacts
+        cache.compaction_thread.join()
+        self.assertEqual(self.csv_rows(cache_name), [('first', 'overwritten')])
+        self.assertEqual(cache.csv_row_count, 1)
+
+        # Clearing has to rewrite the whole file
+        cache.clear()
+        cache['third'] = '3'
+        cache.save()
+        self.assertEqual(self.csv_rows(cache_name), [('third', '3')])
+
+    def test_incremental_typed_delete_markers(self):
+        cache_name = self.check_cache_gone('csv_incremental_typed', csv_path=True)
+        cache = self.build_incremental_cache(cache_name, schema=['int', 'float'], chunk_size=2)
+        cache.update((i, float(i)) for i in range(5))
+        cache.save()
+        del cache[1]
+        cache[3] = 0.5
+        del cache[3]
+        cache[1] = 1.5
+        cache.save()
+        cache.load()
+        self.assert_contents_equal(cache, { 0: 0.0, 1: 1.5, 2: 2.0, 4: 4.0 })
+
+    def test_incremental_apply_changes_saved(self):
+        cache_name = self.check_cache_gone('csv_incremental_changes', csv_path=True)
+        def apply_in_place(name, contents, changes):
+            for key, value in changes:
+                if value is None:
+                    del contents[key]
+                else:
+                    contents[key] = value
+        cache = self.build_incremental_cache(cache_name, incremental_builder=apply_in_place)
+        cache.update({ 'a': '1', 'b': '2' })
+        cache.save()
+
+        self.assertEqual(cache.apply_changes([('a', None), ('c', '3')]), { cache_name: 'incremental' })
+        cache.load()
+        self.assert_contents_equal(cache, { 'b': '2', 'c': '3' })
+
+    def test_delete_marker_key_outside_incremental(self):
+        cache_name = self.check_cache_gone('csv_marker_key', csv_path=True)
+        contents = { registers.CSV_DELETE_MARKER: 'kept', 'kept': 'value' }
+        for kwargs in [{}, { 'schema': ['str', 'str'] }, { 'load_processes': 2 }]:
+            cache = CSVCache(cache_name, cache_manager=self.manager, **kwargs)
+            cache.contents = dict(contents)
+            cache.save()
+            cache.load()
+            self.assert_contents_equal(cache, contents)
+
+    def test_incremental_compaction(self):
+        cache_name = self.check_cache_gone('csv_compaction', csv_path=True)
+        cache = self.build_incremental_cache(cache_name, compact_ratio=0.5)
+        cache['hot'] = '0'
+        cache['cold'] = 'cold'
+        cache.save()
+        for count in range(1, 4):
+            cache['hot'] = str(count)
+            cache.save()
+        self.assertEqual(len(self.csv_rows(cache_name)), 5)
+        self.assertGreater(cache.dead_row_fraction(), 0.5)
+
+        cache['hot'] = 'latest'
+        cache.save() # Compacts in the background
+        cache['cold'] = 'appended'
+        cache.save() # Waits on the compaction before appending
+        cache.compaction_thread.join()
+        self.assertEqual(sorted(self.csv_rows(cache_name)),
+            [('cold', 'appended'), ('cold', 'cold'), ('hot', 'latest')])
+        cache.load()
+        self.assert_contents_equal(cache, { 'hot': 'latest', 'cold': 'appended' })
+
+    def test_incremental_async_appends(self):
+        cache_name = self.check_cache_gone('csv_incremental_async', csv_path=True)
+        cache = self.build_incremental_cache(cache_name, async=True)
+        cache['first'] = '1'
+        cache.save()
+        self.wait_async_complete()
+        cache['second'] = '2'
+        del cache['first']
+        cache.save()
+        self.wait_async_complete()
+
+        self.assertEqual(len(self.csv_rows(cache_name)), 3)
+        cache.load()
+        self.assert_contents_equal(cache, { 'second': '2' })
+
+    def failing_saver(self, *args, **kwargs):
+        raise IOError('disk full')
+
+    def test_failed_saves_resave_in_full(self):
+        cache_name = self.check_cache_gone('csv_incremental_failed', csv_path=True)
+        cache = self.build_incremental_cache(cache_name)
+        cache['a'] = '1'
+        cache.save()
+
+        cache['b'] = '2'
+        csvcache.csv_append_saver = self.failing_saver
+        try:
+            self.assertRaises(IOError, cache.save)
+        finally:
+            csvcache.csv_append_saver = registers.csv_append_saver
+        cache['z'] = '26'
+        cache.save()
+        cache.load()
+        self.assert_contents_equal(cache, { 'a': '1', 'b': '2', 'z': '26' })
+
+        # A failed full save must not leave later saves appending to the old file
+        cache.change_log.clear_all()
+        cache['c'] = '3'
+        csvcache.csv_saver = self.failing_saver
+        try:
+            self.assertRaises(IOError, cache.save)
+        finally:
+            csvcache.csv_saver = registers.csv_saver
+        del cache['a']
+        cache.save()
+        cache.load()
+        self.assert_contents_equal(cache, { 'b': '2', 'c': '3', 'z': '26' })
+
+    def test_failed_async_append_resaves_in_full(self):
+        cache_name = self.check_cache_gone('csv_incremental_async_failed', csv_path=True)
+        cache = self.build_incremental_cache(cache_name)
+        cache['a'] = '1'
+        cache.save()
+
+        cache.async = True
+        cache['b'] = '2'
+        cache.async_appender = self.failing_saver
+        cache.save() # The forked child fails
+        self.wait_async_complete()
+        del cache.async_appender
+        self.assertTrue(os.path.isfile(registers.generate_csv_resave_path(self.test_cache_dir, cache_name)))
+
+        cache['z'] = '26'
+        cache.save()
+        self.wait_async_complete()
+        self.assertFalse(os.path.isfile(registers.generate_csv_resave_path(self.test_cache_dir, cache_name)))
+        cache.async = False
+        cache.load()
+        self.assert_contents_equal(cache, { 'a': '1', 'b': '2', 'z': '26' })
+
+    def test_async_appends_wait_for_earlier_saves(self):
+        cache_name = self.check_cache_gone('csv_incremental_ordered', csv_path=True)
+        cache = self.build_incremental_cache(cache_name, async_timeout=0.05)
+        cache['first'] = '1'
+        cache.save()
+
+        cache.async = True
+        presaver = cache.async_append_presaver
+        def slow_presaver(name, rows, extensions):
+            time.sleep(0.5)
+            return presaver(name, rows, extensions)
+        cache.async_append_presaver = slow_presaver
+        cache['second'] = '2'
+        cache.save()
+        cache.async_append_presaver = presaver
+        cache['third'] = '3'
+        cache.save() # Outlasts async_timeout waiting, but mustn't kill the slow append
+        self.wait_async_complete()
+
+        cache.async = False
+        cache.load()
+        self.assert_contents_equal(cache, { 'first': '1', 'second': '2', 'third': '3' })
+
+    def awkward_contents(self):
+        contents = dict(('key{}'.format(i), 'value {}'.format(i)) for i in range(200))
+        contents.update({
+            'multi\nline key': 'has "quotes"\nand, commas',
+            'quoted': '"\n"',
+            'empty': ''
+        })
+        return contents
+
+    def test_record_boundaries(self):
+        cache_name = self.check_cache_gone('csv_boundaries', csv_path=True)
+        registers.csv_saver(self.test_cache_dir, cache_name, self.awkward_contents())
+        path = registers.generate_csv_path(self.test_cache_dir, cache_name)
+        serial_rows = list(registers.csv_row_stream(self.test_cache_dir, cache_name))
+
+        for parts in [1, 2, 7, 50]:
+            ranges = registers.csv_record_boundaries(path, parts, block_size=16)
+            self.assertLessEqual(len(ranges), parts)
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], os.path.getsize(path))
+            rows = []
+            for start, end in ranges:
+                rows.extend(tuple(row) for row in registers._csv_range_reader(path, start, end) if row)
+            self.assertEqual(rows, serial_rows)
+
+    def test_parallel_loader_matches_serial(self):
+        cache_name = self.check_cache_gone('csv_parallel', csv_path=True)
+        cache = self.build_incremental_cache(cache_name)
+        cache.update(self.awkward_contents())
+        cache.save()
+        for i in range(0, 200, 3):
+            del cache['key{}'.format(i)]
+        cache['key3'] = 'revived'
+        cache.save()
+
+        serial = registers.csv_loader(self.test_cache_dir, cache_name, deletes=True)
+        stats = {}
+        parallel = registers.csv_parallel_loader(self.test_cache_dir, cache_name, processes=3,
+            min_range_size=1, stats=stats, deletes=True)
+        self.assertDictEqual(parallel, serial)
+        self.assertEqual(stats['rows'], cache.csv_row_count)
+        self.assertEqual(parallel['key3'], 'revived')
+        self.assertNotIn('key6', parallel)
+
+        self.assertIsNone(registers.csv_parallel_loader(self.test_cache_dir, 'missing_cache'))
+
+    def test_parallel_typed_cache(self):
+        cache_name = self.check_cache_gone('csv_parallel_typed', csv_path=True)
+        cache = CSVCache(cache_name, cache_manager=self.manager, schema=['int', 'float'], load_processes=4)
+        cache.contents = dict((i, i / 4.0) for i in range(1000))
+        cache.save()
+        cache.load()
+        self.assert_contents_equal(cache, dict((i, i / 4.0) for i in range(1000)))
+
+        self.assertDictEqual(
+            registers.csv_parallel_loader(self.test_cache_dir, cache_name, float_row_reader, processes=4,
+                min_range_size=1),
+            dict((str(i), i / 4.0) for i in range(1000)))
+
+    def test_offset_index(self):
+        cache_name = self.check_cache_gone('csv_indexed', csv_path=True)
+        contents = self.awkward_contents()
+        registers.csv_saver(self.test_cache_dir, cache_name, contents, index=True)
+        offsets = registers.csv_index_loader(self.test_cache_dir, cache_name)
+        self.assertEqual(set(offsets), set(contents))
+
+        path = registers.generate_csv_path(self.test_cache_dir, cache_name)
+        for key in ['multi\nline key', 'quoted', 'key199']:
+            lazy = LazyCSVContents(path, offsets)
+            self.assertEqual(lazy[key], contents[key])
+            lazy.close()
+
+        # Saving without an index removes the old one, as does appending
+        registers.csv_saver(self.test_cache_dir, cache_name, contents)
+        self.assertIsNone(registers.csv_index_loader(self.test_cache_dir, cache_name))
+        registers.csv_saver(self.test_cache_dir, cache_name, contents, index=True)
+        registers.csv_append_saver(self.test_cache_dir, cache_name, [['appended', '1']])
+        self.assertIsNone(registers.csv_index_loader(self.test_cache_dir, cache_name))
+
+        # An index which doesn't match the file signature is stale
+        registers.csv_saver(self.test_cache_dir, cache_name, contents, index=True)
+        with open(path, 'a') as csv_file:
+            csv_file.write('extra,row\n')
+        self.assertIsNone(registers.csv_index_loader(self.test_cache_dir, cache_name))
+
+        # Even when the replacement is the same size
+        registers.csv_saver(self.test_cache_dir, cache_name, contents, index=True)
+        index_path = registers.generate_csv_index_path(self.test_cache_dir, cache_name)
+        os.rename(index_path, index_path + '.kept')
+        registers.csv_saver(self.test_cache_dir, cache_name, dict((key, value[::-1])
+            for key, value in contents.items()))
+        os.rename(index_path + '.kept', index_path)
+        self.assertIsNone(registers.csv_index_loader(self.test_cache_dir, cache_name))
+
+    def test_lazy_load_matches_full_load(self):
+        contents = dict((i, i / 2.0) for i in range(10))
+        contents['multi\r\nline'] = None
+        for schema in [None, ['int', 'float']]:
+            cache_name = self.check_cache_gone('csv_lazy_types_{}'.format(bool(schema)), csv_path=True)
+            if schema:
+                del contents['multi\r\nline']
+            cache = CSVCache(cache_name, cache_manager=self.manager, schema=schema, lazy=True)
+            cache.contents = dict(contents)
+            cache.save()
+            cache.load()
+            self.assertTrue(isinstance(cache.contents, LazyCSVContents))
+            lazy = dict(cache.items())
+
+            cache.lazy = False
+            cache.load()
+            self.assertDictEqual(lazy, dict(cache.items()))
+
+    def test_lazy_cache(self):
+        cache_name = self.check_cache_gone('csv_lazy', csv_path=True)
+        cache = CSVCache(cache_name, cache_manager=self.manager, lazy=True, lazy_lru_size=2,
+            schema=['str', 'int', 'float'])
+        cache.contents = dict(('key{}'.format(i), (i, i / 2.0)) for i in range(10))
+        cache.save()
+        cache.load()
+        self.assertTrue(isinstance(cache.contents, LazyCSVContents))
+        self.assertEqual(len(cache), 10)
+
+        # Membership comes from the index alone
+        self.assertTrue('key3' in cache)
+        self.assertFalse('key10' in cache)
+        self.assertEqual(cache.contents.row_reads, 0)
+
+        self.assertEqual(cache['key3'], (3, 1.5))
+        self.assertEqual(cache['key3'], (3, 1.5))
+        self.assertEqual(cache.contents.row_reads, 1)
+        cache['key4']
+        cache['key5']
+        self.assertEqual(list(cache.contents.lru), ['key4', 'key5'])
+        self.assertRaises(KeyError, lambda: cache['key10'])
+
+        cache['key10'] = (10, 5.0)
+        del cache['key0']
+        self.assertRaises(KeyError, lambda: cache['key0'])
+        self.assertEqual(len(cache), 10)
+        cache.save()
+        self.assertTrue(isinstance(cache.contents, LazyCSVContents))
+        self.assertEqual(cache['key10'], (10, 5.0))
+        self.assertFalse('key0' in cache)
+
+        cache.lazy = False
+        cache.load()
+        self.assert_contents_equal(cache, dict(('key{}'.format(i), (i, i / 2.0)) for i in range(1, 11)))
+
+    def test_lazy_cache_fallback(self):
+        cache_name = self.check_cache_gone('csv_lazy_fallback', csv_path=True)
+        registers.csv_saver(self.test_cache_dir, cache_name, { 'foo': 'bar' })
+        cache = CSVCache(cache_name, cache_manager=self.manager, lazy=True)
+        # No index yet, so the contents were fully loaded
+        self.assert_contents_equal(cache, { 'foo': 'bar' })
+        cache.save()
+        cache.load()
+        self.assertTrue(isinstance(cache.contents, LazyCSVContents))
+        self.assertEqual(cache['foo'], 'bar')
+
+        cache.delete_saved_content()
+        self.assertFalse(os.path.isfile(registers.generate_csv_index_path(self.test_cache_dir, cache_name)))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,105 @@
+# This import fixes sys.path issues
+from . import parentpath
+
+import os
+import pickle
+import unittest
+from cacheman.lazypickle import (LazyPersistentCache, AutoSyncLazyPersistentCache, LazyPickleContents,
+    lazy_pickle_saver, lazy_pickle_loader, generate_lazy_pickle_path)
+from cacheman.registers import wait_async_saves
+from .common import CacheCommonAsserter
+
+class LazyPickleTest(CacheCommonAsserter, unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        CacheCommonAsserter.__init__(self)
+        unittest.TestCase.__init__(self, *args, **kwargs)
+
+    def saved(self, cache_name, contents):
+        lazy_pickle_saver(self.test_cache_dir, cache_name, contents)
+        return lazy_pickle_loader(self.test_cache_dir, cache_name)
+
+    def test_values_load_on_access(self):
+        contents = dict((i, { 'id': i, 'payload': 'x' * i }) for i in range(100))
+        lazy = self.saved('lazy_access', contents)
+        try:
+            self.assertEqual(len(lazy), 100)
+            self.assertTrue(50 in lazy)
+            self.assertEqual(lazy.value_loads, 0)
+
+            self.assertEqual(lazy[50], contents[50])
+            self.assertTrue(lazy[50] is lazy[50]) # Memoized
+            self.assertEqual(lazy.value_loads, 1)
+            self.assertRaises(KeyError, lambda: lazy[100])
+            self.assertEqual(dict(lazy.items()), contents)
+        finally:
+            lazy.close()
+
+    def test_edits_before_save(self):
+        lazy = self.saved('lazy_edits', { 'a': 1, 'b': 2 })
+        try:
+            lazy['c'] = 3
+            lazy['a'] = 10
+            del lazy['b']
+            self.assertRaises(KeyError, lambda: lazy['b'])
+            self.assertEqual(sorted(lazy), ['a', 'c'])
+            self.assertEqual(len(lazy), 2)
+            self.assertEqual(pickle.loads(pickle.dumps(lazy)), { 'a': 10, 'c': 3 })
+        finally:
+            lazy.close()
+
+    def test_resave_copies_untouched_values(self):
+        lazy = self.saved('lazy_resave', { 'a': [1], 'b': [2], 'c': [3] })
+        try:
+            lazy['a'].append(4) # Mutated in place, so it must be repickled
+            resaved = self.saved('lazy_resave', lazy)
+            self.assertEqual(lazy.value_loads, 1)
+            self.assertEqual(dict(resaved.items()), { 'a': [1, 4], 'b': [2], 'c': [3] })
+            resaved.close()
+        finally:
+            lazy.close()
+
+    def test_invalid_file_loads_as_missing(self):
+        path = generate_lazy_pickle_path(self.test_cache_dir, 'lazy_invalid')
+        self.saved('lazy_invalid', {}).close()
+        with open(path, 'wb') as lazy_file:
+            lazy_file.write(b'not a lazy pickle')
+        self.assertIsNone(lazy_pickle_loader(self.test_cache_dir, 'lazy_invalid'))
+        os.remove(path)
+
+    def test_lazy_cache_lifecycle(self):
+        cache_name = self.check_cache_gone('lazy_cache')
+        cache = LazyPersistentCache(cache_name, cache_manager=self.manager,
+            builder=lambda name: dict((i, str(i)) for i in range(10)))
+        self.assertTrue(isinstance(cache.contents, dict))
+        self.assertTrue(os.path.isfile(cache.persisted_path()))
+
+        cache.load()
+        self.assertTrue(isinstance(cache.contents, LazyPickleContents))
+        self.assertEqual(cache[3], '3')
+        cache[20] = '20'
+        cache.save()
+        self.assertTrue(isinstance(cache.contents, LazyPickleContents))
+        self.assertEqual(cache.contents.value_loads, 0) # Loaded values carried over
+        self.assertEqual(cache[20], '20')
+
+        cache.async = True
+        cache[30] = '30'
+        cache.save()
+        wait_async_saves(cache_name, self.manager.async_pid_cache, 5)
+        cache.load()
+        self.assertEqual(len(cache), 12)
+        self.assertEqual(cache[30], '30')
+
+        cache.delete_saved_content()
+        self.assertFalse(os.path.isfile(cache.persisted_path()))
+
+    def test_register_lazy_values(self):
+        cache = self.manager.register_custom_cache(self.check_cache_gone('lazy_registered'), { 'a': 1 },
+            lazy_values=True)
+        self.assertTrue(isinstance(cache, AutoSyncLazyPersistentCache))
+        cache.save()
+        self.manager.reload_cache(cache.name)
+        self.assertEqual(cache['a'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
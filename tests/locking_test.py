@@ -0,0 +1,198 @@
+# This import fixes sys.path issues
+from . import parentpath
+
+import os
+import glob
+import time
+import unittest
+from cacheman.cachewrap import PersistentCache
+from cacheman.csvcache import AutoSyncCSVCache
+from cacheman.registers import commit_lock, pickle_loader, csv_saver, csv_loader, wait_async_saves
+from .common import CacheCommonAsserter
+
+class CacheLockingTest(CacheCommonAsserter, unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        CacheCommonAsserter.__init__(self)
+        unittest.TestCase.__init__(self, *args, **kwargs)
+
+    def save_in_other_process(self, cache, contents):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                cache.contents = contents
+                cache.save()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+    def saved_contents(self, cache_name):
+        return pickle_loader(self.test_cache_dir, cache_name)
+
+    def assert_no_tmp_files(self):
+        self.assertEqual(glob.glob(os.path.join(self.test_cache_dir, '*.tmp*')), [])
+
+    def test_lock_wait_measured(self):
+        cache_name = self.check_cache_gone('locked_wait')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' },
+            locked_saves=True)
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                with commit_lock(cache.persisted_path()):
+                    os.write(write_end, b'x')
+                    time.sleep(0.3)
+            finally:
+                os._exit(0)
+        os.read(read_end, 1)
+        try:
+            cache.save()
+        finally:
+            os.waitpid(pid, 0)
+            os.close(read_end)
+            os.close(write_end)
+
+        wait = self.manager.stats()[cache_name]['lock_wait_seconds']
+        self.assertEqual(wait['count'], 1)
+        self.assertGreaterEqual(wait['sum'], 0.2)
+        self.assertEqual(self.saved_contents(cache_name), { 'foo': 'bar' })
+
+    def test_own_saves_never_conflict(self):
+        cache_name = self.check_cache_gone('locked_own')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' },
+            write_conflict='skip')
+        cache.save()
+        cache['foo'] = 'baz'
+        cache.save()
+        cache.async = True
+        cache['foo'] = 'qux'
+        cache.save()
+        wait_async_saves(cache_name, self.manager.async_pid_cache, 5)
+        cache.async = False
+        cache['foo'] = 'last'
+        cache.save()
+
+        self.assertEqual(self.saved_contents(cache_name), { 'foo': 'last' })
+        self.assertNotIn('write_conflicts', self.manager.stats()[cache_name])
+
+    def test_skip_conflicting_save(self):
+        cache_name = self.check_cache_gone('locked_skip')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' },
+            write_conflict='skip')
+        cache.save()
+        self.save_in_other_process(cache, { 'foo': 'other' })
+
+        cache['foo'] = 'mine'
+        cache.save()
+        self.assertEqual(self.saved_contents(cache_name), { 'foo': 'other' })
+        stats = self.manager.stats()[cache_name]
+        self.assertEqual(stats['write_conflicts'], 1)
+        self.assertEqual(stats['skipped_saves'], 1)
+        self.assert_no_tmp_files()
+
+    def test_skip_adopts_winning_save(self):
+        cache_name = self.check_cache_gone('locked_skip_twice')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' },
+            write_conflict='skip')
+        cache.save()
+        self.save_in_other_process(cache, { 'foo': 'other' })
+
+        cache['foo'] = 'mine'
+        cache.save()
+        self.assertEqual(cache.contents, { 'foo': 'other' })
+        cache['next'] = 1
+        cache.save()
+        self.assertEqual(self.saved_contents(cache_name), { 'foo': 'other', 'next': 1 })
+        self.assertEqual(self.manager.stats()[cache_name]['skipped_saves'], 1)
+
+    def test_async_skip_adopts_winning_save(self):
+        cache_name = self.check_cache_gone('locked_async_skip_twice')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' },
+            write_conflict='skip')
+        cache.save()
+        self.save_in_other_process(cache, { 'foo': 'other' })
+
+        cache.async = True
+        cache['foo'] = 'mine'
+        cache.save()
+        wait_async_saves(cache_name, self.manager.async_pid_cache, 5)
+        self.assertEqual(cache.contents, { 'foo': 'other' })
+        cache['next'] = 1
+        cache.save()
+        wait_async_saves(cache_name, self.manager.async_pid_cache, 5)
+        self.assertEqual(self.saved_contents(cache_name), { 'foo': 'other', 'next': 1 })
+        self.assertEqual(self.manager.stats()[cache_name]['skipped_saves'], 1)
+
+    def test_merge_conflicting_save(self):
+        cache_name = self.check_cache_gone('locked_merge')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' },
+            write_conflict='merge')
+        cache.save()
+        self.save_in_other_process(cache, { 'foo': 'other', 'theirs': 1 })
+
+        cache['mine'] = 2
+        cache.save()
+        merged = { 'foo': 'bar', 'theirs': 1, 'mine': 2 }
+        self.assertEqual(self.saved_contents(cache_name), merged)
+        self.assertEqual(cache.contents, merged)
+        self.assertEqual(self.manager.stats()[cache_name]['merged_saves'], 1)
+
+    def test_merge_keeps_local_deletes(self):
+        cache_name = self.check_cache_gone('locked_merge_deletes')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar', 'gone': 1 },
+            write_conflict='merge')
+        cache.save()
+        self.save_in_other_process(cache, { 'foo': 'other', 'gone': 1, 'theirs': 2 })
+
+        del cache['gone']
+        cache.save()
+        merged = { 'foo': 'bar', 'theirs': 2 }
+        self.assertEqual(self.saved_contents(cache_name), merged)
+        self.assertEqual(cache.contents, merged)
+
+    def test_async_merge_reloads_in_parent(self):
+        cache_name = self.check_cache_gone('locked_async_merge')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' },
+            write_conflict='merge', merger=lambda saved, contents: dict(saved, **contents), coherent=True,
+            coherence_interval=3600, coherence_background=False)
+        cache.save()
+        self.save_in_other_process(cache, { 'theirs': 1 })
+
+        cache.async = True
+        cache['mine'] = 2
+        cache.save()
+        wait_async_saves(cache_name, self.manager.async_pid_cache, 5)
+        merged = { 'foo': 'bar', 'theirs': 1, 'mine': 2 }
+        self.assertEqual(self.saved_contents(cache_name), merged)
+        cache.coherence.next_check = 0
+        self.assertEqual(cache['theirs'], 1) # Merged by the child, so reloaded here
+        self.assertEqual(cache.contents, merged)
+
+    def test_csv_append_conflicts(self):
+        cache_name = self.check_cache_gone('locked_append', csv_path=True)
+        cache = AutoSyncCSVCache(cache_name, cache_manager=self.manager, contents={ 'a': '1' },
+            incremental=True, write_conflict='skip')
+        cache.save()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                csv_saver(self.test_cache_dir, cache_name, { 'b': '2' }) # Leaves no generation stamp
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        cache['c'] = '3'
+        cache.save()
+        self.assertEqual(csv_loader(self.test_cache_dir, cache_name), { 'b': '2' })
+        self.assertEqual(self.manager.stats()[cache_name]['skipped_saves'], 1)
+        self.assert_no_tmp_files()
+        # The skipped rows were drained, so only a full save can write them later
+        self.assertTrue(cache.change_log.reset_all)
+        self.assertFalse(cache._can_append())
+
+    def test_unknown_write_conflict(self):
+        self.assertRaises(ValueError, lambda: PersistentCache(self.check_cache_gone('locked_unknown'),
+            cache_manager=self.manager, contents={}, write_conflict='newest'))
+
+if __name__ == '__main__':
+    unittest.main()
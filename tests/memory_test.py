@@ -0,0 +1,109 @@
+# This import fixes sys.path issues
+from . import parentpath
+
+import sys
+import unittest
+from cacheman.cachewrap import NonPersistentCache, PersistentCache
+from cacheman.cacheutils import DenseIntMap
+from cacheman.memory import deep_sizeof
+from .common import CacheCommonAsserter
+
+class MemoryBudgetTest(CacheCommonAsserter, unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        CacheCommonAsserter.__init__(self)
+        unittest.TestCase.__init__(self, *args, **kwargs)
+
+    def build_cache(self, name, size=1000):
+        cache_name = self.check_cache_gone(name)
+        return PersistentCache(cache_name, cache_manager=self.manager,
+            contents=dict((i, 'value-{}'.format(i)) for i in range(size)))
+
+    def test_deep_sizeof(self):
+        contents = dict((i, 'value-{:06d}'.format(i)) for i in range(10000))
+        exact = sys.getsizeof(contents) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in contents.items())
+        estimate = deep_sizeof(contents)
+        self.assertTrue(0.8 * exact < estimate < 1.2 * exact)
+
+        nested = { 'a': [1, 2, 3], 'b': { 'c': 'd' } }
+        self.assertGreater(deep_sizeof(nested), sys.getsizeof(nested) + sys.getsizeof(nested['a']))
+        shared = ['x' * 1000]
+        self.assertLess(deep_sizeof([shared, shared]), 2 * deep_sizeof(shared))
+
+        dense = DenseIntMap(dict((i, i) for i in range(10000)))
+        self.assertGreater(deep_sizeof(dense), 10000 * dense.values.itemsize)
+
+    def test_footprints(self):
+        cache = self.build_cache('footprint')
+        footprints = self.manager.footprints()
+        self.assertEqual(footprints[cache.name], cache.estimated_size())
+        self.assertGreater(footprints[cache.name], 1000 * sys.getsizeof('value-0'))
+
+    def test_budget_unloads_least_recently_used(self):
+        first = self.build_cache('budget_first')
+        second = self.build_cache('budget_second')
+        third = self.build_cache('budget_third')
+        first[0]
+        third[0] # Second is now the least recently used
+
+        budget = sum(self.manager.footprints().values()) - 1
+        self.assertEqual(self.manager.set_memory_budget(budget), [second.name])
+        self.assertTrue(second.unloaded)
+        self.assertIsNone(second.contents)
+        self.assertEqual(self.manager.footprints()[second.name], 0)
+        self.assertTrue(self.manager.stats()[second.name]['unloaded'])
+
+        # Transparent reload, which pushes out the next least recently used cache
+        self.assertEqual(second[5], 'value-5')
+        self.assertFalse(second.unloaded)
+        self.assertTrue(first.unloaded)
+        self.assertEqual(self.manager.metrics.stats()[second.name]['reloads'], 1)
+
+        self.assertTrue(10 in first)
+        self.assertEqual(len(third.items()), 1000) # Attribute passthrough reloads as well
+
+    def test_reload_paths(self):
+        cache = self.build_cache('budget_paths', 10)
+        for access in [lambda: cache[1], lambda: 1 in cache, lambda: len(cache), lambda: list(cache),
+                lambda: cache.copy(), cache.load]:
+            self.assertTrue(cache.unload())
+            access()
+            self.assertFalse(cache.unloaded)
+            self.assertEqual(len(cache.contents), 10)
+
+        self.assertTrue(cache.unload())
+        cache[100] = 'new'
+        self.assertEqual(len(cache), 11)
+
+    def test_unloaded_save_keeps_saved_contents(self):
+        cache = self.build_cache('budget_save', 10)
+        cache.unload()
+        cache.save()
+        self.manager.save_all_cache_contents()
+        self.assertTrue(cache.unloaded)
+        self.assertEqual(cache[9], 'value-9')
+
+    def test_unloaded_delete_keeps_memory(self):
+        cache = self.build_cache('budget_delete', 10)
+        cache.unload()
+        cache.delete_saved_content()
+        self.check_cache(cache.name, False)
+        self.assertEqual(len(cache.contents), 10)
+
+    def test_blank_cache_stays(self):
+        cache_name = self.check_cache_gone('budget_blank')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, contents={ 'a': 1 },
+            save_on_blank_cache=False)
+        cache.save()
+        del cache['a']
+        self.assertFalse(cache.unload())
+        self.assertEqual(dict(cache), {})
+
+    def test_non_persistent_caches_stay(self):
+        cache_name = self.check_cache_gone('budget_memory_only')
+        cache = NonPersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' })
+        self.assertFalse(cache.unload())
+        self.assertEqual(self.manager.set_memory_budget(0), [])
+        self.assertEqual(cache['foo'], 'bar')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# This import fixes sys.path issues
+from . import parentpath
+
+import os
+import unittest
+from six.moves.urllib.request import urlopen
+from cacheman.cachewrap import NonPersistentCache, PersistentCache
+from cacheman.metrics import CacheMetrics, Histogram
+from .common import CacheCommonAsserter
+
+class CacheMetricsTest(CacheCommonAsserter, unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        CacheCommonAsserter.__init__(self)
+        unittest.TestCase.__init__(self, *args, **kwargs)
+
+    def test_histogram_buckets(self):
+        histogram = Histogram([1, 10])
+        for value in [0.5, 1, 5, 50]:
+            histogram.observe(value)
+        self.assertEqual(list(histogram.cumulative_counts()), [(1, 2), (10, 3), (float('inf'), 4)])
+        self.assertEqual(histogram.sum, 56.5)
+
+    def test_exact_hits_and_misses(self):
+        self.manager.metrics.sample_every = 1
+        cache_name = self.check_cache_gone('metric_hits')
+        cache = NonPersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar', 'no': False })
+        cache['foo']
+        self.assertTrue('foo' in cache)
+        self.assertFalse('missing' in cache)
+        self.assertRaises(KeyError, lambda: cache['missing'])
+        self.assertIs(cache['no'], False) # Stored False values are still hits
+
+        stats = self.manager.stats()[cache_name]
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['access_seconds']['count'], 5)
+        self.assertEqual(stats['entries'], 2)
+
+    def test_sampled_hits(self):
+        self.manager.metrics = CacheMetrics(sample_every=10)
+        cache_name = self.check_cache_gone('metric_sampled')
+        cache = NonPersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' })
+        for _ in range(100):
+            cache['foo']
+        stats = self.manager.stats()[cache_name]
+        self.assertEqual(stats['hits'], 100)
+        self.assertEqual(stats['access_seconds']['count'], 10)
+
+    def test_lifecycle_metrics(self):
+        cache_name = self.check_cache_gone('metric_lifecycle')
+        cache = PersistentCache(cache_name, cache_manager=self.manager)
+        cache['foo'] = 'bar'
+        cache.save()
+        cache.load()
+
+        stats = self.manager.stats()[cache_name]
+        self.assertEqual(stats['loads'], 2)
+        self.assertEqual(stats['load_misses'], 1)
+        self.assertEqual(stats['builds'], 1)
+        self.assertEqual(stats['saves'], 2)
+        self.assertEqual(stats['save_bytes']['count'], 2)
+        self.assertEqual(stats['load_seconds']['count'], 2)
+
+    def test_async_fork_metrics(self):
+        cache_name = self.check_cache_gone('metric_fork')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' }, async=True)
+        cache.save()
+        self.wait_async_complete()
+        cache.save()
+        self.wait_async_complete()
+
+        stats = self.manager.stats()[cache_name]
+        self.assertEqual(stats['async_forks'], 2)
+        self.assertEqual(stats['fork_seconds']['count'], 2)
+        self.assertEqual(stats['async_saves_reaped'], 1)
+
+    def test_disabled_metrics(self):
+        self.manager.metrics.enabled = False
+        cache_name = self.check_cache_gone('metric_disabled')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' })
+        cache.save()
+        self.assertEqual(cache['foo'], 'bar')
+        self.assertFalse('missing' in cache)
+        self.assertEqual(self.manager.metrics.stats(), {})
+
+        # Plain lookups still reload unloaded contents
+        self.assertTrue(cache.unload())
+        self.assertTrue('foo' in cache)
+        self.assertTrue(cache.unload())
+        self.assertEqual(cache['foo'], 'bar')
+
+    def test_prometheus_text(self):
+        self.manager.metrics.sample_every = 1
+        cache_name = self.check_cache_gone('metric_prometheus')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' })
+        cache['foo']
+        cache.save()
+
+        text = self.manager.metrics.prometheus_text()
+        self.assertIn('# TYPE cacheman_hits_total counter', text)
+        self.assertIn('cacheman_hits_total{{cache="{}"}} 1'.format(cache_name), text)
+        self.assertIn('# TYPE cacheman_save_seconds histogram', text)
+        self.assertIn('cacheman_save_seconds_bucket{{cache="{}",le="+Inf"}} 1'.format(cache_name), text)
+        self.assertIn('cacheman_save_seconds_count{{cache="{}"}} 1'.format(cache_name), text)
+
+        path = os.path.join(self.manager.cache_directory, 'metrics.prom')
+        self.manager.write_metrics(path)
+        try:
+            with open(path) as metrics_file:
+                self.assertEqual(metrics_file.read(), self.manager.metrics.prometheus_text())
+        finally:
+            os.remove(path)
+
+    def test_serve_metrics(self):
+        cache_name = self.check_cache_gone('metric_served')
+        PersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' }).save()
+        server = self.manager.serve_metrics()
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+            body = urlopen(url).read().decode('utf-8')
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('cacheman_saves_total{{cache="{}"}} 1'.format(cache_name), body)
+
+if __name__ == '__main__':
+    unittest.main()
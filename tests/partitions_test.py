@@ -0,0 +1,144 @@
+# This import fixes sys.path issues
+from . import parentpath
+
+import os
+import sys
+import glob
+import time
+import unittest
+from six import StringIO
+from cacheman.cachewrap import PersistentCache
+from cacheman.partitions import build_partitions
+from cacheman.registers import ensure_directory
+from .common import CacheCommonAsserter
+
+def range_partitioner(name):
+    return [(start, start + 10) for start in range(0, 50, 10)]
+
+def range_builder(name, partition):
+    return dict((i, i * i) for i in range(*partition))
+
+def slow_first_builder(name, partition):
+    if partition == 0:
+        time.sleep(0.2)
+    return { partition: os.getpid() }
+
+def flaky_builder(name, partition):
+    '''
+    Fails the first time each partition marked flaky is built, tracked with a marker file
+    as attempts run in separate processes.
+    '''
+    flaky, value, marker_path = partition
+    if flaky and not os.path.exists(marker_path):
+        open(marker_path, 'w').close()
+        raise ValueError('flaky partition')
+    if value is None:
+        raise ValueError('broken partition')
+    return { value: os.getpid() }
+
+class SquaresCache(PersistentCache):
+    '''
+    Partitions defined as methods, which don't pickle into a pool on every python.
+    '''
+    def partitioner(self, name):
+        return range_partitioner(name)
+
+    def partition_builder(self, name, partition):
+        return range_builder(name, partition)
+
+class PartitionsTest(CacheCommonAsserter, unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        CacheCommonAsserter.__init__(self)
+        unittest.TestCase.__init__(self, *args, **kwargs)
+
+    def setUp(self):
+        CacheCommonAsserter.setUp(self)
+        ensure_directory(self.test_cache_dir)
+
+    def tearDown(self):
+        CacheCommonAsserter.tearDown(self)
+        for path in glob.glob(os.path.join(self.test_cache_dir, '*.marker')):
+            os.remove(path)
+
+    def marker(self, name):
+        return os.path.join(self.test_cache_dir, name + '.marker')
+
+    def capturing_stdout(self, func):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            result = func()
+            return result, sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_builds_partitions_in_pool(self):
+        contents, report = build_partitions('squares', range_partitioner('squares'), range_builder, processes=2)
+        self.assertEqual(contents, dict((i, i * i) for i in range(50)))
+        self.assertEqual([entry['entries'] for entry in report], [10] * 5)
+        self.assertTrue(all(entry['attempts'] == 1 and entry['error'] is None for entry in report))
+
+        inline, _ = build_partitions('squares', range_partitioner('squares'), range_builder, processes=1)
+        self.assertEqual(inline, contents)
+
+    def test_report_keeps_partition_order(self):
+        contents, report = build_partitions('slow', [0, 1, 2], slow_first_builder, processes=3)
+        self.assertEqual(sorted(contents), [0, 1, 2])
+        self.assertEqual([entry['partition'] for entry in report], [0, 1, 2])
+        self.assertGreater(report[0]['seconds'], report[1]['seconds'])
+
+    def test_unhashable_and_repeated_partitions(self):
+        contents, report = build_partitions('lists', [[0, 10], [0, 10], [10, 20]], range_builder, processes=2)
+        self.assertEqual(contents, dict((i, i * i) for i in range(20)))
+        self.assertEqual([entry['entries'] for entry in report], [10, 10, 10])
+        self.assertEqual([entry['partition'] for entry in report], [[0, 10], [0, 10], [10, 20]])
+
+    def test_unpicklable_builder_builds_inline(self):
+        (contents, report), output = self.capturing_stdout(lambda: build_partitions('inline', [1, 2],
+            lambda name, partition: { partition: os.getpid() }, processes=2))
+        self.assertEqual(contents, { 1: os.getpid(), 2: os.getpid() })
+        self.assertTrue(all(entry['error'] is None for entry in report))
+        self.assertTrue("building 'inline' partitions inline" in output)
+
+    def test_retries_failed_partitions(self):
+        partitions = [(False, 'a', self.marker('a')), (True, 'b', self.marker('b')), (False, None, self.marker('c'))]
+        contents, report = build_partitions('flaky', partitions, flaky_builder, processes=2, retries=2)
+        self.assertEqual(sorted(contents), ['a', 'b'])
+        self.assertNotEqual(contents['a'], os.getpid())
+        self.assertEqual([entry['attempts'] for entry in report], [1, 2, 3])
+        self.assertIsNone(report[1]['error'])
+        self.assertTrue('broken partition' in report[2]['error'])
+
+    def test_partitioned_cache(self):
+        cache_name = self.check_cache_gone('partitioned')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, partitioner=range_partitioner,
+            partition_builder=range_builder, build_processes=2)
+        self.assertEqual(len(cache), 50)
+        self.assertEqual(cache[7], 49)
+        cache.load()
+        self.assertEqual(cache[49], 49 * 49) # Saved after building
+
+        stats = self.manager.stats()[cache_name]
+        self.assertEqual(len(stats['partitions']), 5)
+        self.assertEqual(stats['partition_build_seconds']['count'], 5)
+
+    def test_partition_builder_method(self):
+        cache_name = self.check_cache_gone('partitioned_method')
+        cache, _ = self.capturing_stdout(lambda: SquaresCache(cache_name, cache_manager=self.manager,
+            build_processes=2))
+        self.assertEqual(len(cache), 50)
+        self.assertEqual(cache[7], 49)
+        self.assertEqual(len(cache.build_report), 5)
+
+    def test_partitioned_cache_failure(self):
+        cache_name = self.check_cache_gone('partitions_failed')
+        cache = PersistentCache(cache_name, cache_manager=self.manager, contents={ 'kept': True },
+            partitioner=lambda name: [(False, 'a', self.marker('a')), (False, None, self.marker('c'))],
+            partition_builder=flaky_builder, build_processes=1, partition_retries=1)
+        self.assertRaises(RuntimeError, cache.invalidate_and_rebuild)
+        self.assertEqual(cache.build_report[1]['attempts'], 2)
+        stats = self.manager.stats()[cache_name]
+        self.assertEqual(stats['partition_retries'], 1)
+        self.assertEqual(stats['partition_failures'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# This import fixes sys.path issues
+from . import parentpath
+
+import os
+import json
+import tempfile
+import unittest
+from cacheman import autosync, replay
+from cacheman.replay import TraceEvent
+
+class ReplayTest(unittest.TestCase):
+    def factory(self, time_checks, **kwargs):
+        return replay.time_checks_factory(time_checks, time_bucket_size=1, **kwargs)
+
+    def test_synthetic_trace(self):
+        trace = replay.synthetic_trace(100, writes_per_second=2, reads_per_second=5, seed=3)
+        self.assertEqual(trace, replay.synthetic_trace(100, writes_per_second=2, reads_per_second=5, seed=3))
+        self.assertEqual([event.time for event in trace], sorted(event.time for event in trace))
+        self.assertTrue(all(0 <= event.time < 100 for event in trace))
+        self.assertEqual(set(event.op for event in trace), set(['get', 'set', 'delete']))
+
+        bursty = replay.synthetic_trace(100, 0, 0, burst_every=40, burst_writes=10)
+        self.assertEqual(len(bursty), 20)
+
+    def test_loss_windows(self):
+        trace = [
+            TraceEvent(0, 'set', 'a', 1),
+            TraceEvent(1, 'set', 'b', 2),
+            TraceEvent(2, 'set', 'c', 3), # Third edit in the window saves
+            TraceEvent(10, 'delete', 'a', None),
+            TraceEvent(20, 'get', 'a', None),
+            TraceEvent(50, 'get', 'b', None),
+        ]
+        original_datetime = autosync.datetime
+        report = replay.replay(trace, self.factory([autosync.TimeCount(60, 3)]))
+        self.assertIs(autosync.datetime, original_datetime)
+
+        self.assertEqual(report['saves'], 1)
+        self.assertEqual(report['writes'], 3)
+        self.assertEqual(report['deletes'], 1)
+        self.assertEqual(report['reads'], 2)
+        self.assertEqual(report['read_misses'], 1)
+        self.assertTrue(report['unsaved_at_end'])
+        self.assertEqual(report['worst_loss_window'], 40) # The delete was never saved
+        self.assertEqual(report['mean_loss_window'], 21)
+        self.assertGreater(report['bytes_written'], 0)
+
+    def test_background_sync_replay(self):
+        trace = [TraceEvent(0.5, 'set', 'a', 1), TraceEvent(5, 'get', 'a', None)]
+        report = replay.replay(trace, self.factory([autosync.TimeCount(60, 1)], background_sync=True))
+        self.assertEqual(report['saves'], 1)
+        self.assertEqual(report['worst_loss_window'], 0.5)
+        self.assertFalse(report['unsaved_at_end'])
+
+    def test_compare_policies(self):
+        trace = replay.synthetic_trace(120, writes_per_second=1, reads_per_second=1, key_space=20)
+        reports = replay.compare_policies(trace, {
+            'eager': self.factory([autosync.TimeCount(60, 1)]),
+            'lazy': self.factory([autosync.TimeCount(30, 1000), autosync.TimeCount(90, 1)]),
+        })
+        self.assertGreater(reports['eager']['saves'], reports['lazy']['saves'])
+        self.assertLess(reports['eager']['worst_loss_window'], reports['lazy']['worst_loss_window'])
+        table = replay.format_reports(reports)
+        self.assertIn('worst_loss_window', table)
+        self.assertIn('eager', table)
+
+    def test_load_trace(self):
+        handle, path = tempfile.mkstemp(suffix='.jsonl')
+        try:
+            with os.fdopen(handle, 'w') as trace_file:
+                trace_file.write(json.dumps({ 't': 100.5, 'op': 'set', 'key': 'a', 'value': 1 }) + '\n\n')
+                trace_file.write(json.dumps({ 't': 102, 'op': 'get', 'key': 'a' }) + '\n')
+            self.assertEqual(list(replay.load_trace(path)),
+                [TraceEvent(0, 'set', 'a', 1), TraceEvent(1.5, 'get', 'a', None)])
+        finally:
+            os.remove(path)
+
+    def test_parse_time_checks(self):
+        self.assertEqual(replay.parse_time_checks('60:100,900:1'),
+            [autosync.TimeCount(60, 100), autosync.TimeCount(900, 1)])
+
+    def test_incremental_needs_csv(self):
+        self.assertRaises(SystemExit, replay.main,
+            ['--synthetic', '1', '--time-checks', '60:100', '--incremental'])
+
+if __name__ == '__main__':
+    unittest.main()
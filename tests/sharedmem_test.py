@@ -0,0 +1,101 @@
+# This import fixes sys.path issues
+from . import parentpath
+
+import os
+import gc
+import unittest
+from cacheman import sharedmem
+from cacheman.cacher import CacheManager
+from cacheman.sharedmem import SharedMemoryCache, SharedContents
+from .common import CacheCommonAsserter
+
+class SharedMemoryCacheTest(CacheCommonAsserter, unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        CacheCommonAsserter.__init__(self)
+        unittest.TestCase.__init__(self, *args, **kwargs)
+
+    def tearDown(self):
+        cache_names = list(self.manager.cache_by_name)
+        cache_directory = self.manager.cache_directory
+        CacheCommonAsserter.tearDown(self)
+        gc.collect() # Caches publish again as they're collected
+        for cache_name in cache_names:
+            sharedmem.unpublish_shared(cache_directory, cache_name)
+
+    def other_process_manager(self):
+        return CacheManager(self.test_cache_key, self.test_cache_base_dir)
+
+    def test_shared_contents_lookups(self):
+        cache_name = self.check_cache_gone('shared_lookups')
+        contents = dict((i, { 'value': i }) for i in range(1000))
+        contents.update({ 'text': u'unicode', 2.5: None, (1, 2): 'tuple' })
+        sharedmem.publish_shared(self.manager.cache_directory, cache_name, contents)
+        published = sharedmem.read_generation(self.manager.cache_directory, cache_name)
+        self.assertEqual(published['generation'], 1)
+        self.assertEqual(published['entries'], len(contents))
+
+        shared = SharedContents(published['segment'], published['generation'])
+        try:
+            self.assertEqual(len(shared), len(contents))
+            self.assertEqual(dict(shared.items()), contents)
+            self.assertEqual(shared[999], { 'value': 999 })
+            self.assertEqual(shared[5.0], { 'value': 5 })
+            self.assertTrue((1, 2) in shared)
+            self.assertFalse(1000 in shared)
+            self.assertRaises(KeyError, lambda: shared['missing'])
+            self.assertRaises(TypeError, shared.__setitem__, 'foo', 'bar')
+        finally:
+            shared.close()
+            sharedmem.unpublish_shared(self.manager.cache_directory, cache_name)
+
+    def test_cache_publishes_on_build(self):
+        cache_name = self.check_cache_gone('shared_build')
+        cache = SharedMemoryCache(cache_name, cache_manager=self.manager,
+            builder=lambda name: { 'foo': 'bar' })
+        self.assertTrue(isinstance(cache.contents, SharedContents))
+        self.assertEqual(cache.generation(), 1)
+        self.assertEqual(cache['foo'], 'bar')
+        self.check_cache(cache_name, True)
+
+        # Another process attaches to the same segment instead of unpickling
+        other = self.other_process_manager()
+        other_cache = other.register_custom_cache(cache_name, shared=True)
+        self.assertTrue(isinstance(other_cache, SharedMemoryCache))
+        self.assertEqual(other_cache.contents.segment_path, cache.contents.segment_path)
+        self.assertEqual(other_cache['foo'], 'bar')
+
+        self.assertEqual(cache.publish({ 'foo': 'baz' }), 2)
+        self.assertEqual(cache['foo'], 'baz')
+        self.assertEqual(other_cache['foo'], 'bar') # Still mapping its generation
+        reading = other_cache.contents # As held by a thread mid lookup
+        self.assertTrue(other_cache.refresh())
+        self.assertFalse(other_cache.refresh())
+        self.assertEqual(other_cache['foo'], 'baz')
+        self.assertEqual(reading['foo'], 'bar')
+        other.cache_by_name.clear()
+
+    def test_republishes_from_pickle(self):
+        cache_name = self.check_cache_gone('shared_pickle')
+        cache = SharedMemoryCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' })
+        cache.save()
+        # Segments don't survive reboots, but the pickle does
+        sharedmem.unpublish_shared(self.manager.cache_directory, cache_name)
+        self.assertIsNone(sharedmem.read_generation(self.manager.cache_directory, cache_name))
+
+        cache.load()
+        self.assertTrue(isinstance(cache.contents, SharedContents))
+        self.assertEqual(cache.generation(), 1)
+        self.assertEqual(dict(cache.contents), { 'foo': 'bar' })
+
+    def test_delete_unpublishes(self):
+        cache_name = self.check_cache_gone('shared_delete')
+        cache = SharedMemoryCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' })
+        cache.save()
+        segment = cache.contents.segment_path
+        cache.delete_saved_content()
+        self.assertIsNone(sharedmem.read_generation(self.manager.cache_directory, cache_name))
+        self.assertFalse(os.path.exists(segment))
+        self.assertEqual(cache['foo'], 'bar') # Mapped until it's closed
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+# This import fixes sys.path issues
+from . import parentpath
+
+import os
+import socket
+import struct
+import pickle
+import threading
+import unittest
+from six.moves import socketserver
+from cacheman.tiered import TieredCache, TieredContents, MemoryTier, DiskTier, RemoteTier, generate_tier_path
+from .common import CacheCommonAsserter
+
+class _RemoteHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            header = self.rfile.read(4)
+            if len(header) < 4:
+                return
+            op, key, value = pickle.loads(self.rfile.read(struct.unpack('>I', header)[0]))
+            self.server.requests += 1
+            if op == 'get':
+                reply = self.server.store.get(key)
+            elif op == 'get_many':
+                reply = dict((k, self.server.store[k]) for k in key if k in self.server.store)
+            elif op == 'set':
+                reply = self.server.store[key] = value
+            elif op == 'set_many':
+                reply = self.server.store.update(value)
+            else:
+                reply = self.server.store.pop(key, None)
+            data = pickle.dumps(reply)
+            self.wfile.write(struct.pack('>I', len(data)) + data)
+
+class LocalRemoteServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    '''
+    A local socket stand-in for a memcached style remote store.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), _RemoteHandler)
+        self.store = {}
+        self.requests = 0
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class LocalRemoteClient(object):
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        self.rfile = self.sock.makefile('rb')
+
+    def _request(self, op, key, value=None):
+        data = pickle.dumps((op, key, value))
+        self.sock.sendall(struct.pack('>I', len(data)) + data)
+        return pickle.loads(self.rfile.read(struct.unpack('>I', self.rfile.read(4))[0]))
+
+    def get(self, key):
+        return self._request('get', key)
+
+    def set(self, key, value):
+        self._request('set', key, value)
+
+    def delete(self, key):
+        self._request('delete', key)
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+class LocalRemoteBatchClient(LocalRemoteClient):
+    def get_many(self, keys):
+        return self._request('get_many', keys)
+
+    def set_many(self, mapping):
+        self._request('set_many', None, mapping)
+
+class BrokenClient(object):
+    def get(self, key):
+        raise socket.error('remote unreachable')
+
+    def set(self, key, value):
+        raise socket.error('remote unreachable')
+
+    def delete(self, key):
+        raise socket.error('remote unreachable')
+
+class TieredCacheTest(CacheCommonAsserter, unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        CacheCommonAsserter.__init__(self)
+        unittest.TestCase.__init__(self, *args, **kwargs)
+
+    def setUp(self):
+        CacheCommonAsserter.setUp(self)
+        self.server = LocalRemoteServer()
+        self.client = LocalRemoteClient(self.server.server_address)
+
+    def tearDown(self):
+        CacheCommonAsserter.tearDown(self)
+        self.client.close()
+        self.server.stop()
+
+    def tier_stats(self, cache):
+        return dict((stats['tier'], stats) for stats in cache.tier_stats())
+
+    def test_memory_tier_evicts_least_recent(self):
+        tier = MemoryTier(2)
+        tier.set('a', 1)
+        tier.set('b', 2)
+        tier.get('a')
+        tier.set('c', 3)
+        self.assertEqual(tier.keys(), set(['a', 'c']))
+
+    def test_reads_promote_up_tiers(self):
+        l1 = MemoryTier(10)
+        l2 = DiskTier(os.path.join(self.test_cache_dir, 'promote.l2'))
+        l3 = RemoteTier(self.client, 'promote', 'through')
+        l3.set('remote', 'value')
+        contents = TieredContents([l1, l2, l3])
+
+        self.assertEqual(contents['remote'], 'value')
+        self.assertEqual(l1.get('remote'), 'value')
+        self.assertEqual(l2.get('remote'), 'value')
+        self.assertEqual([(tier.hits, tier.misses) for tier in contents.tiers], [(0, 1), (0, 1), (1, 0)])
+
+        self.assertEqual(contents['remote'], 'value')
+        self.assertEqual(l1.hits, 1)
+        self.assertFalse('missing' in contents)
+        l2.clear()
+
+    def test_write_through_and_behind(self):
+        cache_name = self.check_cache_gone('tiered_writes')
+        cache = TieredCache(cache_name, cache_manager=self.manager, l3_client=self.client)
+        cache['foo'] = 'bar'
+        l1, l2, l3 = cache.contents.tiers
+        self.assertEqual(l2.get('foo'), 'bar') # Through to disk
+        self.assertEqual(self.server.store, {}) # Behind to the remote
+        self.assertEqual(l3.stats()['pending'], 1)
+
+        cache.save()
+        self.assertEqual(len(self.server.store), 1)
+        self.assertEqual(l3.get('foo'), 'bar')
+
+        del cache['foo']
+        self.assertFalse('foo' in cache)
+        cache.save()
+        self.assertEqual(self.server.store, {})
+        self.assertRaises(KeyError, lambda: cache['foo'])
+
+    def test_saves_flush_synchronously(self):
+        cache_name = self.check_cache_gone('tiered_async')
+        self.assertRaises(ValueError, lambda: TieredCache(cache_name, cache_manager=self.manager,
+            l3_client=self.client, async=True))
+
+        cache = TieredCache(cache_name, cache_manager=self.manager, l3_client=self.client)
+        cache.async = True
+        cache['foo'] = 'bar'
+        cache.save()
+        self.assertEqual(cache.contents.tiers[2].stats()['pending'], 0)
+        self.assertEqual(len(self.server.store), 1)
+
+    def test_disk_tier_survives_reload(self):
+        cache_name = self.check_cache_gone('tiered_reload')
+        cache = TieredCache(cache_name, cache_manager=self.manager, l1_size=2, contents={ 'a': 1, 'b': 2, 'c': 3 })
+        self.assertTrue(os.path.isdir(generate_tier_path(self.test_cache_dir, cache_name)))
+        self.assertEqual(dict(cache.items()), { 'a': 1, 'b': 2, 'c': 3 })
+
+        cache.load()
+        self.assertEqual(len(cache.contents.tiers[0].entries), 0)
+        self.assertEqual(cache['b'], 2)
+        stats = self.tier_stats(cache)
+        self.assertEqual(stats['l1']['hit_rate'], 0.0)
+        self.assertEqual(stats['l2']['hit_rate'], 1.0)
+        self.assertEqual(self.manager.stats()[cache_name]['tiers'][1]['hits'], 1)
+
+        cache.delete_saved_content()
+        self.assertFalse(os.path.isdir(generate_tier_path(self.test_cache_dir, cache_name)))
+
+    def test_builder_fills_tiers(self):
+        cache_name = self.check_cache_gone('tiered_build')
+        cache = TieredCache(cache_name, cache_manager=self.manager, builder=lambda name: { 'built': True })
+        self.assertTrue(isinstance(cache.contents, TieredContents))
+        self.assertEqual(cache.contents.tiers[1].get('built'), True)
+
+    def test_remote_shared_between_caches(self):
+        writer = TieredCache(self.check_cache_gone('tiered_shared'), cache_manager=self.manager,
+            disk_tier=False, l3_client=self.client, l3_write='through')
+        writer['key'] = 'shared'
+
+        other_client = LocalRemoteClient(self.server.server_address)
+        try:
+            writer.contents.tiers[0].clear()
+            self.assertEqual(writer['key'], 'shared')
+            self.assertEqual(self.tier_stats(writer)['l3']['hits'], 1)
+            reader = RemoteTier(other_client, writer.contents.tiers[1].namespace)
+            self.assertEqual(reader.get('key'), 'shared')
+        finally:
+            other_client.close()
+
+    def test_unreachable_remote_is_a_miss(self):
+        cache_name = self.check_cache_gone('tiered_broken')
+        cache = TieredCache(cache_name, cache_manager=self.manager, disk_tier=False, l3_client=BrokenClient(),
+            l3_write='through')
+        cache['foo'] = 'bar'
+        self.assertEqual(cache['foo'], 'bar')
+        cache.contents.tiers[0].clear()
+        self.assertFalse('foo' in cache)
+        self.assertEqual(self.tier_stats(cache)['l3']['errors'], 2)
+
+    def test_batches_per_tier(self):
+        batch_client = LocalRemoteBatchClient(self.server.server_address)
+        try:
+            cache = TieredCache(self.check_cache_gone('tiered_batch'), cache_manager=self.manager,
+                l3_client=batch_client)
+            cache.set_many(dict(('key{}'.format(i), i) for i in range(10)))
+            cache.save()
+            self.assertEqual(self.server.requests, 1) # Write-behind flushed as one set_many
+            l1, l2, l3 = cache.contents.tiers
+            self.assertEqual(l2.get('key3'), 3)
+
+            l1.clear()
+            l2.clear()
+            keys = ['key{}'.format(i) for i in range(12)]
+            self.assertEqual(cache.get_many(keys), dict(('key{}'.format(i), i) for i in range(10)))
+            self.assertEqual(self.server.requests, 2)
+            self.assertEqual((l3.hits, l3.misses), (10, 2))
+            self.assertEqual(l1.get('key5'), 5) # Promoted
+            self.assertEqual(l2.get('key5'), 5)
+
+            l1.clear()
+            l2.clear()
+            self.assertEqual(cache.delete_many(['key1', 'key2', 'missing']), 2)
+            self.assertEqual(self.server.requests, 3) # One get_many probe, deletes wait behind
+            self.assertFalse('key1' in cache)
+            # Deleted while the client is open, as teardown would go through it
+            self.manager.deregister_cache(cache.name)
+            cache.delete_saved_content()
+        finally:
+            batch_client.close()
+
+    def test_register_tiered_cache(self):
+        cache_name = self.check_cache_gone('tiered_registered')
+        self.assertRaises(ValueError, lambda: self.manager.register_custom_cache(cache_name, tiered=True,
+            l3_client=self.client))
+        cache = self.manager.register_custom_cache(cache_name, tiered=True, autosync=False, l3_client=self.client)
+        self.assertTrue(isinstance(cache, TieredCache))
+
+if __name__ == '__main__':
+    unittest.main()
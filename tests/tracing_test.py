@@ -0,0 +1,106 @@
+# This import fixes sys.path issues
+from . import parentpath
+
+import os
+import json
+import unittest
+from cacheman.cachewrap import PersistentCache
+from cacheman.tracing import Tracer, payload_size
+from .common import CacheCommonAsserter
+
+class TracingTest(CacheCommonAsserter, unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        CacheCommonAsserter.__init__(self)
+        unittest.TestCase.__init__(self, *args, **kwargs)
+
+    def build_cascade(self):
+        dependent_name = self.check_cache_gone('trace_dependent')
+        dependent = PersistentCache(dependent_name, cache_manager=self.manager,
+            builder=lambda name: dict((i, i) for i in range(5)))
+        parent_name = self.check_cache_gone('trace_parent')
+        parent = PersistentCache(parent_name, cache_manager=self.manager, dependents=[dependent],
+            builder=lambda name: { 'foo': 'bar' }, post_processor=lambda contents: None)
+        return parent, dependent
+
+    def spans(self, name, cache_name):
+        return [event for event in self.manager.tracer.events
+            if event['name'] == name and event['args']['cache'] == cache_name]
+
+    def test_payload_size(self):
+        self.assertEqual(payload_size(None, 'name', { 'a': 1 }), 1)
+        self.assertIsNone(payload_size(None, 'name', 5))
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(self.manager.tracer)
+        parent, _ = self.build_cascade()
+        parent.invalidate_and_rebuild(True)
+        self.assertIsNone(self.manager.tracer)
+
+    def test_cascade_spans(self):
+        parent, dependent = self.build_cascade()
+        tracer = self.manager.enable_tracing()
+        parent.invalidate_and_rebuild(True)
+
+        cascade = self.spans('invalidate_and_rebuild', parent.name)
+        self.assertEqual(len(cascade), 1)
+        self.assertEqual(cascade[0]['cat'], 'cascade')
+        self.assertEqual(cascade[0]['args']['depth'], 0)
+
+        parent_builds = self.spans('builder', parent.name)
+        self.assertEqual(len(parent_builds), 1)
+        self.assertEqual(parent_builds[0]['args']['depth'], 0)
+        self.assertEqual(parent_builds[0]['args']['payload_size'], 1)
+        self.assertEqual(len(self.spans('post_processor', parent.name)), 2) # On invalidate's load and the build
+
+        dependent_builds = self.spans('builder', dependent.name)
+        self.assertEqual(len(dependent_builds), 1)
+        self.assertEqual(dependent_builds[0]['args']['depth'], 1)
+        self.assertEqual(dependent_builds[0]['args']['payload_size'], 5)
+
+        # Callback spans nest inside the cascade span
+        start, end = cascade[0]['ts'], cascade[0]['ts'] + cascade[0]['dur']
+        for event in tracer.events:
+            self.assertEqual(event['ph'], 'X')
+            self.assertTrue(start <= event['ts'] <= end)
+        for name in ['loader', 'saver', 'deleter']:
+            self.assertTrue(self.spans(name, dependent.name))
+
+        parent.apply_changes({ 'foo': 'baz' })
+        self.assertEqual(len(self.spans('apply_changes', parent.name)), 1)
+        self.assertEqual(len(self.spans('apply_changes', dependent.name)), 1)
+
+    def test_failed_callback_span(self):
+        parent, _ = self.build_cascade()
+        self.manager.enable_tracing()
+        parent.validator = lambda contents: contents['missing']
+        parent.save()
+        parent.load()
+        validations = self.spans('validator', parent.name)
+        self.assertEqual(len(validations), 1)
+        self.assertIn('KeyError', validations[0]['args']['error'])
+
+    def test_write_chrome_trace(self):
+        parent, _ = self.build_cascade()
+        tracer = self.manager.enable_tracing()
+        parent.save(True)
+        path = os.path.join(self.manager.cache_directory, 'trace.json')
+        tracer.write(path)
+        try:
+            with open(path) as trace_file:
+                trace = json.load(trace_file)
+        finally:
+            os.remove(path)
+        self.assertEqual(len(trace['traceEvents']), len(tracer.events))
+        self.assertEqual(set(event['name'] for event in trace['traceEvents']), set(['save', 'saver']))
+        self.assertIs(self.manager.disable_tracing(), tracer)
+        self.assertIsNone(self.manager.tracer)
+
+    def test_max_events(self):
+        tracer = Tracer(max_events=2)
+        for i in range(5):
+            with tracer.span(str(i), 'cache'):
+                pass
+        self.assertEqual([event['name'] for event in tracer.events], ['3', '4'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,13 @@
 # This import fixes sys.path issues
 from . import parentpath
 
+import os
 import unittest
-from cacheman.cachewrap import CacheWrap, NonPersistentCache, PersistentCache
+from decimal import Decimal
+from cacheman.cachewrap import CacheWrap, NonPersistentCache, PersistentCache, REBUILD
+from cacheman.cacheutils import SetAsDictWrap
+from cacheman.bloom import BloomFilter
+from cacheman.registers import generate_bloom_path, pickle_saver
 from .common import CacheCommonAsserter
 
 class CacheWrapTest(CacheCommonAsserter, unittest.TestCase):
@@ -228,6 +233,77 @@ class CacheWrapTest(CacheCommonAsserter, unittest.TestCase):
         parent_cache.invalidate_and_rebuild(True)
         self.assertDictEqual(dependent_cache.contents, {})
 
+    def test_apply_changes(self):
+        records = { 1: 'a', 2: 'b', 3: 'c' }
+        def apply_records(name, contents, changes):
+            if changes == 'reset':
+                return REBUILD
+            for key, value in changes.items():
+                if value is None:
+                    contents.pop(key, None)
+                else:
+                    contents[key] = value
+        def apply_counts(name, contents, changes):
+            return { 'count': contents['count'] + len(changes) }
+
+        dependent_cache_name = self.check_cache_gone('changes_dependent')
+        dependent_cache = PersistentCache(dependent_cache_name, cache_manager=self.manager,
+            builder=lambda name: { 'count': 0 }, incremental_builder=apply_counts)
+        other_cache_name = self.check_cache_gone('changes_other')
+        other_cache = PersistentCache(other_cache_name, cache_manager=self.manager,
+            builder=lambda name: { 'builds': 'fresh' })
+        parent_cache_name = self.check_cache_gone('changes_parent')
+        parent_cache = PersistentCache(parent_cache_name, cache_manager=self.manager,
+            builder=lambda name: dict(records), incremental_builder=apply_records,
+            dependents=[dependent_cache, other_cache], bloom_filter=True)
+        other_cache['builds'] = 'stale'
+
+        applied = parent_cache.apply_changes({ 2: None, 4: 'd' })
+        self.assertEqual(applied, { parent_cache_name: 'incremental', dependent_cache_name: 'incremental',
+            other_cache_name: 'rebuild' })
+        self.assert_contents_equal(parent_cache, { 1: 'a', 3: 'c', 4: 'd' })
+        self.assertTrue(4 in parent_cache) # Bloom filter covers keys added in place
+        self.assert_contents_equal(dependent_cache, { 'count': 2 })
+        self.assert_contents_equal(other_cache, { 'builds': 'fresh' })
+        parent_cache.load()
+        self.assert_contents_equal(parent_cache, { 1: 'a', 3: 'c', 4: 'd' }) # Saved
+
+        self.assertEqual(parent_cache.apply_changes('reset', False), { parent_cache_name: 'rebuild' })
+        self.assert_contents_equal(parent_cache, records)
+        self.assertEqual(self.manager.stats()[parent_cache_name]['incremental_fallbacks'], 1)
+
+    def test_invalidate_keys(self):
+        prices = { 'apple': 1, 'pear': 2, 'plum': 3 }
+        parent_cache_name = self.check_cache_gone('keys_parent')
+        parent_cache = PersistentCache(parent_cache_name, cache_manager=self.manager, contents=dict(prices),
+            key_builder=lambda name, key: prices[key])
+        totals_cache_name = self.check_cache_gone('keys_totals')
+        totals_cache = PersistentCache(totals_cache_name, cache_manager=self.manager,
+            contents={ ('apple', 2): 2, ('pear', 2): 4, ('plum', 2): 6 })
+        summary_cache_name = self.check_cache_gone('keys_summary')
+        summary_cache = PersistentCache(summary_cache_name, cache_manager=self.manager,
+            builder=lambda name: { 'total': sum(prices.values()) })
+        parent_cache.add_dependent(totals_cache, lambda key: [(key, 2)])
+        self.manager.register_dependent_cache(parent_cache_name, summary_cache)
+
+        prices['apple'] = 5
+        del prices['plum']
+        report = self.manager.invalidate_cache_keys(parent_cache_name, ['apple', 'plum'])
+        self.assert_contents_equal(parent_cache, { 'apple': 5, 'pear': 2 })
+        self.assert_contents_equal(totals_cache, { ('pear', 2): 4 }) # Evicted without a key_builder
+        self.assert_contents_equal(summary_cache, { 'total': 7 })
+        self.assertEqual(report, {
+            parent_cache_name: { 'touched': 2, 'entries': 3, 'rebuilt': False },
+            totals_cache_name: { 'touched': 2, 'entries': 3, 'rebuilt': False },
+            summary_cache_name: { 'touched': 1, 'entries': 1, 'rebuilt': True }
+        })
+        parent_cache.load()
+        self.assert_contents_equal(parent_cache, { 'apple': 5, 'pear': 2 }) # Saved
+
+        report = parent_cache.invalidate_keys(['missing'], False)
+        self.assertEqual(report, { parent_cache_name: { 'touched': 0, 'entries': 2, 'rebuilt': False } })
+        self.assertEqual(self.manager.stats()[totals_cache_name]['keys_invalidated'], 2)
+
     def test_pre_processor(self):
         cache_name = self.check_cache_gone('pre_process')
         cache = PersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' },
@@ -252,5 +328,109 @@ class CacheWrapTest(CacheCommonAsserter, unittest.TestCase):
         cache.load() # Load and apply postprocessor changes
         self.assert_contents_equal(cache, { 'foo2': 'bar' })
 
+    def test_batch_operations(self):
+        cache_name = self.check_cache_gone('batch_ops')
+        cache = NonPersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' },
+            bloom_filter=True)
+        cache.set_many({ 'a': 1, 'b': 2 })
+        cache.set_many([('c', 3)])
+        self.assertEqual(cache.get_many(['a', 'c', 'foo', 'missing']), { 'a': 1, 'c': 3, 'foo': 'bar' })
+        self.assertEqual(cache.delete_many(['a', 'missing']), 1)
+        self.assert_contents_equal(cache, { 'b': 2, 'c': 3, 'foo': 'bar' })
+
+        stats = self.manager.stats()[cache_name]
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_bloom_filter_false_positive_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(i)
+        self.assertTrue(all(i in bloom for i in range(1000)))
+        false_positives = sum(1 for i in range(1000, 11000) if i in bloom)
+        self.assertLess(false_positives, 300)
+        self.assertTrue(1.0 in bloom)
+
+    def test_bloom_filter_equal_keys(self):
+        bloom = BloomFilter(100, 0.01)
+        bloom.add((1, 'x'))
+        bloom.add(('y', None))
+        self.assertTrue((1.0, 'x') in bloom)
+        self.assertTrue((1, u'x') in bloom)
+        self.assertTrue((u'y', None) in bloom)
+        self.assertTrue(bloom.exact)
+
+        bloom.add(Decimal(2))
+        self.assertFalse(bloom.exact)
+        self.assertTrue(2 in bloom) # Any key might equal the Decimal now
+
+    def test_bloom_filter_sees_writes_around_wrapper(self):
+        cache_name = self.check_cache_gone('bloom_around')
+        cache = NonPersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' },
+            bloom_filter=True)
+        self.assertFalse('new' in cache)
+        cache.contents['new'] = 1
+        self.assertTrue('new' in cache)
+        cache.contents.update({ 'other': 2 })
+        self.assertEqual(cache['other'], 2)
+
+    def test_bloom_filter_short_circuits_misses(self):
+        cache_name = self.check_cache_gone('bloom_misses')
+        cache = NonPersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' },
+            bloom_filter=True)
+        self.assertTrue('foo' in cache)
+        cache['foo2'] = 'bar2'
+        self.assertEqual(cache['foo2'], 'bar2')
+        for i in range(100):
+            self.assertFalse(i in cache)
+        self.assertRaises(KeyError, lambda: cache['missing'])
+
+        stats = cache.bloom_stats()
+        self.assertEqual(stats['checks'], 103)
+        self.assertEqual(stats['negatives'] + stats['false_positives'], 101)
+        self.assertGreater(stats['negatives'], 95)
+
+    def test_bloom_filter_tracks_replaced_contents(self):
+        cache_name = self.check_cache_gone('bloom_replaced')
+        cache = NonPersistentCache(cache_name, cache_manager=self.manager, contents={ 'foo': 'bar' },
+            bloom_filter=True)
+        self.assertFalse('new' in cache)
+        cache.contents = { 'new': 'value' }
+        self.assertTrue('new' in cache)
+        self.assertFalse('foo' in cache)
+
+    def test_bloom_filter_grows(self):
+        cache_name = self.check_cache_gone('bloom_grows')
+        cache = NonPersistentCache(cache_name, cache_manager=self.manager, contents={},
+            bloom_filter=True, bloom_capacity=10)
+        for i in range(100):
+            cache[i] = i
+        self.assertGreaterEqual(cache.bloom.capacity, 100)
+        self.assertTrue(all(i in cache for i in range(100)))
+
+    def test_bloom_filter_saved_and_loaded(self):
+        cache_name = self.check_cache_gone('bloom_saved')
+        cache = PersistentCache(cache_name, cache_manager=self.manager,
+            contents=SetAsDictWrap(set(['seen1', 'seen2'])), bloom_filter=True)
+        cache.save()
+        bloom_path = generate_bloom_path(self.manager.cache_directory, cache_name)
+        self.assertTrue(os.path.exists(bloom_path))
+        saved_bloom = cache.bloom
+
+        cache.load()
+        self.assertIsNot(cache.bloom, saved_bloom)
+        self.assertEqual(cache.bloom.bits, saved_bloom.bits)
+        self.assertTrue('seen1' in cache)
+        self.assertFalse('unseen' in cache)
+
+        # Contents replaced by another writer with as many entries don't reuse the filter
+        pickle_saver(self.manager.cache_directory, cache_name, SetAsDictWrap(set(['other1', 'other2'])))
+        cache.load()
+        self.assertTrue('other1' in cache)
+        self.assertFalse('seen1' in cache)
+
+        cache.delete_saved_content()
+        self.assertFalse(os.path.exists(bloom_path))
+
 if __name__ == '__main__':
     unittest.main()